@@ -1,33 +1,101 @@
 import dash
 from dash import dcc, html, dash_table, Input, Output, State
-import pandas as pd
-import sqlite3
 import database as db
 import io
 import os
+import base64
 import sys
+import threading
 import utils
 from dash import dcc, html
-import plotly.express as px
-import plotly.graph_objects as go
 from dash.dependencies import Input, Output
-import pandas as pd
-import numpy as np
 import invoice_layout_generator as inlay
+import snapshot
+import cache
+import reconciliation
+import mass_balance
+import buffer_forecast
+import restock_forecast
+import dispatch
+import timeseries
+import writer
+import ingest
+import meter_validation
+import metrics
+import profiler
+import logs
 import datetime
-from fill_tables import replenish_table
+
+# pandas is imported by the Excel exports that use it, polars by the dispatch plan, fill_tables
+# by initialize()
 
 strptime  = datetime.datetime.strptime
 date      = datetime.date
 timedelta = datetime.timedelta
 
 
-# Initialize database if not exist
-if os.path.exists(db.database_file):
-    print("database exist")
-else:
-    print("database is missing, creating database...")
-    replenish_table()
+# structured logs through a background writer, see logs.py
+logs.configure()
+logger    = logs.get_logger("app")
+
+
+# Database bootstrap, done once per process by initialize() rather than at import:
+# `python app.py init` runs it on its own, `python app.py` before serving, and under
+# gunicorn the first request triggers it (see gunicorn.conf.py for --preload).
+initialized     = False
+initialize_lock = threading.Lock()
+
+
+def initialize(build=True):
+    """
+    Prepares the database for serving: adds the key indexes to an existing database or
+    creates it from the YAML sheets, then serves charge, tracker and recap reads from a
+    Parquet snapshot and caches their results for every worker, and keeps the monthly
+    volume rollup of the invoice form, the per-transport mass balances, the buffer
+    depletion and transport restock forecasts, all refreshed after every write, and creates
+    the sensor trace store and the quarantine of failed meter readings. Only the first call
+    does any work.
+
+    Args:
+        build (bool): Create a missing database, build the snapshot and clear the result cache.
+                      With False, the ones prepared by `python app.py init` are attached as they
+                      are and no Polars code runs, as a process forking workers afterwards must:
+                      the Polars thread pool does not survive a fork.
+    """
+
+    global initialized
+
+    with initialize_lock:
+        if initialized:
+            return
+
+        if os.path.exists(db.database_file):
+            logger.info("database found", extra={"db_file": db.database_file})
+            # duplicate restocks are only removed by a build, which rebuilds every derived store
+            # after: attached as they are, the stores would keep the removed rows
+            for table_name in db.db_table_keys:
+                unique = db.create_key_index(db.database_file, table_name, deduplicate=(build and table_name == "restock"))
+                if table_name == "restock" and not unique:
+                    raise RuntimeError(f"no unique restock_id index on {db.database_file}, run `python app.py init` to remove duplicate restocks")
+        elif build:
+            from fill_tables import replenish_table
+
+            logger.warning("database is missing, creating database", extra={"db_file": db.database_file})
+            replenish_table()
+        else:
+            raise FileNotFoundError(f"{db.database_file} is missing, run `python app.py init` first")
+
+        db.enable_wal(db.database_file)
+        db.create_keyset_indexes(db.database_file)
+        snapshot.enable(db.database_file, rebuild=build)
+        cache.enable(db.database_file, clear=build)
+        reconciliation.enable(db.database_file, rebuild=build)
+        mass_balance.enable(db.database_file, rebuild=build)
+        buffer_forecast.enable(db.database_file, rebuild=build)
+        restock_forecast.enable(db.database_file, rebuild=build)
+        timeseries.enable(db.database_file)
+        meter_validation.enable(db.database_file)
+        initialized = True
 
 
 # Define dark theme colors
@@ -150,6 +218,18 @@ app     = dash.Dash(__name__, title='Delivery Analysis', suppress_callback_excep
 server  = app.server  
 port    = int(os.environ.get('PORT', 8050))
 
+# callback latency and SQL histograms on /metrics, slow-call profiles on /admin/profiling,
+# batch ingest for the truck-side app on /api/ingest
+metrics.instrument_server(server, app)
+profiler.instrument_server(server)
+ingest.instrument_server(server)
+
+
+@server.before_request
+def ensure_initialized():
+    if not initialized:
+        initialize()
+
 # ------------------------------------------------------------------------------------
 # LAYOUT
 # ------------------------------------------------------------------------------------
@@ -223,6 +303,23 @@ app.layout = html.Div(
                             }
                         ),
 
+                        dcc.Upload(
+                            id='restock-report-upload',
+                            children=html.Div('upload reports'),
+                            multiple=False,
+                            style={
+                                'width'             : '106%', 
+                                'height'            : 30, 
+                                'lineHeight'        : '30px',
+                                'margin-top'        : '10px',
+                                'textAlign'         : 'center',
+                                'font-size'         : '13px',
+                                'cursor'            : 'pointer',
+                                'background-color'  : '#333333',
+                                'color'             : '#bbbbbb'
+                            }
+                        ),
+
                         html.Button( 
                             'download table', 
                             id='download-restock-table', 
@@ -352,6 +449,23 @@ app.layout = html.Div(
                             }
                         ),
 
+                        dcc.Upload(
+                            id='delivery-report-upload',
+                            children=html.Div('upload reports'),
+                            multiple=False,
+                            style={
+                                'width'             : '106%', 
+                                'height'            : 30, 
+                                'lineHeight'        : '30px',
+                                'margin-top'        : '10px',
+                                'textAlign'         : 'center',
+                                'font-size'         : '13px',
+                                'cursor'            : 'pointer',
+                                'background-color'  : '#333333',
+                                'color'             : '#bbbbbb'
+                            }
+                        ),
+
                         html.Button( 
                             'download table', 
                             id='download-delivery-table', 
@@ -496,6 +610,9 @@ app.layout = html.Div(
                         ),
 
                         html.Div(style={'height': '20px'}),  # Spacer
+
+                        html.H4("Next restock", style={'font-weight': 'normal', 'color':'#dddddd'}),
+                        html.Div(id='restock-forecast', style={'font-size': '12px', 'color': '#bbbbbb', 'lineHeight': '20px'}),
                     ]
                 ),
             
@@ -523,6 +640,104 @@ app.layout = html.Div(
                 )
         ]),
 
+
+        # ----------------------------------------------------------------------------------
+        # DISPATCH PLAN
+        # ----------------------------------------------------------------------------------
+        html.H3("Dispatch Plan", style={'font-weight': 'normal', 'margin-left':'0px', 'margin-top': '60px'}),
+        html.Div(
+            [
+                html.Div(
+                    [
+                        html.Label("plan date", style=styles['label']),
+                        dcc.Input(
+                            id      = 'dispatch-date-input',
+                            type    = 'text',
+                            value   = (datetime.date.today() + datetime.timedelta(days=1)).strftime(db.date_format),
+                            style   = {**styles['input'], 'width': '100%'}
+                        ),
+
+                        html.Button(
+                            'plan dispatch',
+                            id='submit-dispatch-plan',
+                            n_clicks=0,
+                            style={
+                                'width': '106%',
+                                'height': 30,
+                                'margin-top': '10px',
+                                'border'            : 'none',
+                                'borderRadius'      : '0px',
+                                'background-color'  : '#333333',
+                                'color'             : '#bbbbbb'
+                            }
+                        ),
+                            # Route summary and errors
+                        html.Div(id='dispatch-message', style={'fontSize': '11px', 'margin-top': '10px', 'color': 'skyblue'}),
+                    ],
+                    style = {
+                        'width'         : '20%',
+                        'margin-right'  : '50px',
+                        'display'       : 'flex',
+                        'flex-direction': 'column'
+                    }
+                ),
+
+                html.Div(
+                    [
+                        dash_table.DataTable(
+                            id='dispatch-table',
+                            style_as_list_view=True,
+                            style_table = {
+                                'overflowX': 'auto',
+                                'overflowY': 'auto',
+                                'height'   : 500,
+                                'background-color': '#222222',
+                                'color': '#aaaaaa',
+                            },
+                            style_cell={
+                                'textAlign'     : 'left',
+                                'fontSize'      : 11,
+                                'padding-left'  : '10px',
+                                'padding-right'  : '10px',
+                                'height'        : 'auto',
+                                'background-color': '#222222',
+                                'color': '#aaaaaa',
+                            },
+                            style_header={
+                                'fontWeight'     : 'bold',
+                                'padding-top'    : '5px',
+                                'padding-bottom' : '5px',
+                                'fontSize'      : 11,
+                                'maxWidth'      : '150px',
+                                'whiteSpace'    : 'normal',
+                                'overflow'      : 'hidden',
+                                'textOverflow'  : 'ellipsis',
+                                'font-weight' : 'normal',
+                                'color': '#aaaaaa',
+
+                            },
+                            page_size=20
+                        ),
+
+                    ],
+                    style = {
+                        'width':'75%',
+                        'margin-top': '0px'
+                    },
+
+                )
+
+            ],
+
+            style = {
+                'margin-top'    : '10px',
+                'margin-bottom' : '10px',
+                'display'       : 'flex',
+                'flex-direction': 'row',
+                'width' : '100%',
+            }
+        ),
+
         html.H1("Create Invoice", style = {
             'textAlign'     : 'center',
             'marginBottom'  : '0px',
@@ -866,11 +1081,20 @@ app.layout = html.Div(
     [Output('delivery-table', 'data'),
      Output('delivery-table', 'columns'),
      Output('delivery-message', 'children')],
-    [Input('submit-delivery-report', 'n_clicks')],
+    [Input('submit-delivery-report', 'n_clicks'),
+     Input('delivery-report-upload', 'contents')],
     [State('delivery-report-input', 'value')],
     prevent_initial_call=False,
 )
-def execute_delivery_update(n_clicks, report):
+@metrics.timed_callback
+@profiler.profiled
+def execute_delivery_update(n_clicks, upload_contents, report):
+    # an uploaded file takes the place of the pasted block
+    if dash.ctx.triggered_id == 'delivery-report-upload' and upload_contents:
+        content_type, content_string = upload_contents.split(',', 1)
+        report = base64.b64decode(content_string).decode('utf-8', errors='replace')
+        return execute_delivery_bulk_update(report)
+
     if n_clicks == 0 or not report:
         # return [], [], "Please enter your report."
         select_all_query = "SELECT * FROM delivery"
@@ -888,13 +1112,22 @@ def execute_delivery_update(n_clicks, report):
         return data, columns, f""
     
     
+    if db.count_reports(report) > 1:
+        return execute_delivery_bulk_update(report)
+
     try:
         rowrep = db.generate_delivery_rowrep(report)
         
         if not rowrep:
             raise ValueError("duplicate delivery_id detected")
+
+        entry            = {"report": 1, "delivery_id": rowrep["delivery_id"], "status": "accepted", "reason": None}
+        rowreps, summary = meter_validation.screen_rowreps(db.database_file, [rowrep], [entry])
+        if not rowreps:
+            raise ValueError(f"reading quarantined for review, {summary[0]['reason']}")
         
-        db.insert_row_from_dict(db.database_file, "delivery", rowrep)
+        # acknowledged once committed, a rolled back insert raises here
+        writer.write(db.database_file, "delivery", [rowrep])
         
         # Execute query and fetch results into a DataFrame
         select_all_query = "SELECT * FROM delivery"
@@ -911,12 +1144,46 @@ def execute_delivery_update(n_clicks, report):
         return [], [], f"Error executing query: {str(e)}"
 
 
+def execute_delivery_bulk_update(report):
+    try:
+        rowreps, summary = db.generate_delivery_rowreps(report)
+        rowreps, summary = meter_validation.screen_rowreps(db.database_file, rowreps, summary)
+        inserted         = writer.write(db.database_file, "delivery", rowreps)["rows"]
+
+        select_all_query = "SELECT * FROM delivery"
+        df               = db.query_table_as_pandas(db.database_file, select_all_query)
+        df               = utils.remove_df_underscore(df)
+
+        # Prepare data for DataTable
+        data    = df.to_dict('records')
+        columns = [{"name": i, "id": i} for i in df.columns]
+
+        # per-report accept/reject summary
+        lines   = [html.Div(f"{inserted} of {len(summary)} reports inserted.")]
+        for item in summary:
+            if item["status"] == "accepted":
+                lines.append(html.Div(f"report {item['report']} ({item['delivery_id']}): accepted"))
+            elif item["status"] == "quarantined":
+                lines.append(html.Div(f"report {item['report']} ({item['delivery_id']}): quarantined for review, {item['reason']}", style=styles['error']))
+            else:
+                lines.append(html.Div(f"report {item['report']} ({item['delivery_id']}): rejected, {item['reason']}", style=styles['error']))
+
+        return data, columns, lines
+
+    except Exception as e:
+        return [], [], f"Error executing query: {str(e)}"
+
+
 @app.callback(
     Output("download-delivery-excel", "data"),
     Input("download-delivery-table", "n_clicks"),
     prevent_initial_call=True,
 )
+@metrics.timed_callback
+@profiler.profiled
 def generate_delivery_excel(n_clicks):
+    import pandas as pd
+
     # Create an Excel file in memory
     output = io.BytesIO()
 
@@ -977,12 +1244,20 @@ def generate_delivery_excel(n_clicks):
     [Output('restock-table', 'data'),
      Output('restock-table', 'columns'),
      Output('restock-message', 'children')],
-    [Input('submit-restock-report', 'n_clicks')],
+    [Input('submit-restock-report', 'n_clicks'),
+     Input('restock-report-upload', 'contents')],
     [State('restock-report-input', 'value')],
     prevent_initial_call=False,
 )
-def execute_restock_update(n_clicks, report):
-    if n_clicks == 0 or not report:
+@metrics.timed_callback
+@profiler.profiled
+def execute_restock_update(n_clicks, upload_contents, report):
+    # an uploaded file takes the place of the pasted block
+    if dash.ctx.triggered_id == 'restock-report-upload' and upload_contents:
+        content_type, content_string = upload_contents.split(',', 1)
+        report = base64.b64decode(content_string).decode('utf-8', errors='replace')
+
+    elif n_clicks == 0 or not report:
         # return [], [], "Please enter your report."
         select_all_query = "SELECT * FROM restock"
         df               = db.query_table_as_pandas(db.database_file, select_all_query)
@@ -998,8 +1273,9 @@ def execute_restock_update(n_clicks, report):
         return data, columns, f""
         
     try:
-        rowrep = db.generate_restock_rowrep(report)
-        db.insert_row_from_dict(db.database_file, "restock", rowrep)
+        # restock_id is the conflict key, resubmitting a restock updates it in place
+        rowreps, summary = db.generate_restock_rowreps(report)
+        written          = writer.write(db.database_file, "restock", rowreps, upsert=True)
         
         # Execute query and fetch results into a DataFrame
         select_all_query = "SELECT * FROM restock"
@@ -1009,8 +1285,19 @@ def execute_restock_update(n_clicks, report):
         # Prepare data for DataTable
         data    = df.to_dict('records')
         columns = [{"name": i, "id": i} for i in df.columns]
-        
-        return data, columns, f"Insert executed successfully. {len(data)} rows returned."
+
+        # per-report summary with batch throughput
+        lines   = [html.Div(
+            f"{written['rows']} of {len(summary)} reports written in "
+            f"{written['seconds']:.3f} s ({written['rows_per_second']:.0f} rows/s)."
+        )]
+        for item in summary:
+            if item["status"] == "rejected":
+                lines.append(html.Div(f"report {item['report']} ({item['restock_id']}): rejected, {item['reason']}", style=styles['error']))
+            else:
+                lines.append(html.Div(f"report {item['report']} ({item['restock_id']}): {item['status']}"))
+
+        return data, columns, lines
     
     except Exception as e:
         return [], [], f"Error executing query: {str(e)}"
@@ -1021,6 +1308,8 @@ def execute_restock_update(n_clicks, report):
     Input("download-restock-table", "n_clicks"),
     prevent_initial_call=True,
 )
+@metrics.timed_callback
+@profiler.profiled
 def generate_restock_excel(n_clicks):
     # Create an Excel file in memory
     output = io.BytesIO()
@@ -1043,10 +1332,11 @@ def generate_restock_excel(n_clicks):
     Input('submit-update-tracker', 'value'),
     # prevent_initial_call=True,
 )
+@metrics.timed_callback
+@profiler.profiled
 def update_transport_selector(n_clicks):
-    print("tracker summoned")
     options = db.get_transports_as_options()
-    print(options)
+    logger.debug("transport options loaded", extra={"transports": len(options)})
     return options
 
 
@@ -1055,11 +1345,98 @@ def update_transport_selector(n_clicks):
     Input('transport-selector', 'value'),
     # prevent_initial_call=True,
 )
+@metrics.timed_callback
+@profiler.profiled
 def update_tracker_graph(transport_plate_number):
     fig = db.generate_tracker_set(transport_plate_number)
     return fig
 
 
+@app.callback(
+    Output('restock-forecast', 'children'),
+    Input('transport-selector', 'value'),
+)
+@metrics.timed_callback
+@profiler.profiled
+def update_restock_forecast(transport_plate_number):
+    rows = restock_forecast.forecasts(db.database_file, plates=[transport_plate_number]).to_dicts()
+    if not rows or rows[0]["last_restock"] is None:
+        return "No restock recorded."
+
+    forecast = rows[0]
+    lines    = [
+        html.Div(f"last restock {forecast['last_restock']}: {forecast['last_load']:.0f}"),
+        html.Div(f"on board est. {forecast['on_board']:.0f} on {forecast['last_day']}"),
+    ]
+    if forecast["next_restock"] is None:
+        lines.append(html.Div(f"{forecast['restocks']} restocks, too few to forecast"))
+        return lines
+
+    days_left = forecast["days_left"]
+    lines    += [
+        html.Div(f"use {forecast['volume_per_day']:.1f} per day"),
+        html.Div(
+            f"next restock {forecast['next_restock']} "
+            + (f"({days_left} days left)" if days_left >= 0 else f"({-days_left} days overdue)"),
+            style=styles['error'] if days_left <= 1 else {'color': '#dddddd'},
+        ),
+        html.Div(f"every {forecast['interval_days']:.1f} days, due {forecast['interval_restock']}"),
+    ]
+    return lines
+
+
+# --------------------------------------------------------------------------------------------------
+# DISPATCH PLAN
+# --------------------------------------------------------------------------------------------------
+@app.callback(
+    [Output('dispatch-table', 'data'),
+     Output('dispatch-table', 'columns'),
+     Output('dispatch-message', 'children')],
+    [Input('submit-dispatch-plan', 'n_clicks')],
+    [State('dispatch-date-input', 'value')],
+    prevent_initial_call=True,
+)
+@metrics.timed_callback
+@profiler.profiled
+def update_dispatch_plan(n_clicks, plan_date):
+    import polars as pl
+
+    try:
+        plan_date = datetime.datetime.strptime(plan_date, db.date_format).date()
+    except (TypeError, ValueError):
+        return [], [], html.Div("plan date must be YYYY-MM-DD", style=styles['error'])
+
+    try:
+        stops = dispatch.plan(db.database_file, plan_date)
+    except Exception as e:
+        logger.exception("dispatch plan failed", extra={"plan_date": str(plan_date)})
+        return [], [], f"Error planning dispatch: {str(e)}"
+
+    if stops.is_empty():
+        return [], [], "No customer is due that day."
+
+    lines = []
+    for route in dispatch.route_summary(stops).iter_rows(named=True):
+        transport = route["transport_plate_number"] or "no transport left"
+        lines.append(html.Div(
+            f"{route['route']} ({transport}): {route['stops']} stops, {route['volume']:.0f} volume, "
+            f"{route['first_eta']:%H:%M} to {route['last_eta']:%H:%M}",
+            style=styles['error'] if route["transport_plate_number"] is None else None,
+        ))
+
+    df = (stops
+        .with_columns([
+            pl.col(column).dt.strftime("%Y-%m-%d %H:%M") for column in ("eta", "refill_at")
+        ])
+        .with_columns([
+            pl.col(column).round(1) for column in ("pressure", "volume", "hours_left")
+        ])
+    )
+    data    = df.to_dicts()
+    columns = [{"name": i.replace("_", " "), "id": i} for i in df.columns]
+    return data, columns, lines
+
+
 
 # Callback for form submission
 @app.callback(
@@ -1086,6 +1463,8 @@ def update_tracker_graph(transport_plate_number):
     ],
     prevent_initial_call=True
 )
+@metrics.timed_callback
+@profiler.profiled
 def update_charge_table(n_clicks, customer_id, vol_balance=0, start_date="2020-01-01", end_date="2030-01-01"):
     if n_clicks is None:
         return html.Div("Enter search criteria and click Submit to view results.")
@@ -1154,6 +1533,30 @@ def update_charge_table(n_clicks, customer_id, vol_balance=0, start_date="2020-0
     return data, columns, m1, m2, m3, m4, m5, m6, m7, m8
 
 
+# Fill the correction volume with the minimum monthly volume shortfall, it can still be edited
+@app.callback(
+    Output("minvol-balance-input", "value"),
+    [
+        Input("customer-id-input", "value"),
+        Input("start-date-input", "value"),
+        Input("end-date-input", "value"),
+    ],
+)
+@metrics.timed_callback
+@profiler.profiled
+def update_minvol_balance(customer_id, start_date, end_date):
+    if not customer_id or not start_date or not end_date:
+        return dash.no_update
+
+    try:
+        balance = reconciliation.shortfall_balance(db.database_file, customer_id, start_date, end_date)
+    except ValueError:
+        # dates are checked when the table or invoice is requested
+        return dash.no_update
+
+    return str(round(balance, 2))
+
+
 
 @app.callback(
     [
@@ -1174,6 +1577,8 @@ def update_charge_table(n_clicks, customer_id, vol_balance=0, start_date="2020-0
     ],
     prevent_initial_call=True,
 )
+@metrics.timed_callback
+@profiler.profiled
 def generate_invoice_excel(n_clicks,
                            customer_id,
                            vol_balance,
@@ -1182,12 +1587,14 @@ def generate_invoice_excel(n_clicks,
                            invoice_number,
                            week_period,
                            customer_address):
+    import pandas as pd
+
     if n_clicks is None:
-        print("No button click detected.")
+        logger.debug("invoice export without click")
         return dash.no_update
 
     if not invoice_number or not week_period or not customer_address:
-        print("Please fill in all fields.")
+        logger.info("invoice export skipped, missing fields", extra={"customer_id": customer_id})
         return dash.no_update
 
     vol_balance = float(vol_balance) if vol_balance else 0
@@ -1279,6 +1686,11 @@ def generate_invoice_excel(n_clicks,
 
 
 if __name__ == '__main__':
+    initialize()
+    if len(sys.argv) > 1 and sys.argv[1] == 'init':
+        # database and snapshot only, e.g. as a deploy step before starting gunicorn
+        sys.exit(0)
+
     if len(sys.argv) > 1 and sys.argv[1] == 'local':
         # Run locally (localhost)
         app.run(debug=True, port=8000)  # Enable debug mode
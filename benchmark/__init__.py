@@ -0,0 +1,11 @@
+"""
+Benchmarks for the hot paths of the app. The suite times every hot path against seeded
+synthetic databases and writes a JSON results file that later runs can compare against:
+
+    python -m benchmark --sizes 10k 100k --output before.json
+    python -m benchmark --sizes 10k 100k --compare before.json
+
+Single studies run as modules, e.g.
+
+    python -m benchmark.bench_report_parser
+"""
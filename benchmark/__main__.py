@@ -0,0 +1,30 @@
+import sys
+import argparse
+
+from benchmark import suite
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Times the hot paths against synthetic data.")
+    parser.add_argument("--sizes", nargs="+", default=["10k"], help="delivery rows per database, e.g. 10k 100k 1m 10m")
+    parser.add_argument("--cases", nargs="+", choices=sorted(suite.cases), help="cases to run, all by default")
+    parser.add_argument("--rounds", type=int, default=3, help="timed calls per case")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory measurement")
+    parser.add_argument("--workdir", default="benchmark-data", help="where synthetic databases are cached")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--output", default="benchmark-results.json", help="results file to write")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    document = suite.run(args.sizes, args.cases, args.rounds, not args.no_memory, args.workdir, args.seed)
+    suite.write_results(document, args.output)
+
+    if args.compare and suite.compare(document, args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+import database as db
+import buffer_forecast
+from benchmark.synthetic import make_database
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Buffer depletion forecasts over a fleet: python -m benchmark.bench_buffer_forecast [200000]
+#
+# The one-pass plan over all customers against the same plan run customer by customer, the
+# refresh of one customer after a write, and the read the dispatch board makes.
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(n_deliveries=200_000):
+    workdir = tempfile.mkdtemp()
+    db_file = os.path.join(workdir, "bench.db")
+    customers, trucks = make_database(db_file, n_deliveries, n_customers=500, n_trucks=40)
+    db.database_file  = db_file
+    db.create_keyset_indexes(db_file)
+    buffer_forecast.enable(db_file, rebuild=True)
+
+    one_pass     = buffer_forecast.forecast_plan(db_file).collect()
+    per_customer = pl.concat([buffer_forecast.forecast_plan(db_file, [customer_id]).collect() for customer_id in customers])
+    assert_frame_equal(one_pass.sort("customer_id"), per_customer.sort("customer_id"), check_exact=False, rtol=1e-9)
+
+    as_of   = datetime.datetime.strptime(one_pass["last_arrival"].max(), db.timestamp_format)
+    results = {
+        "one pass over all customers"   : best_of(lambda: buffer_forecast.forecast_plan(db_file).collect()),
+        "customer by customer"          : best_of(lambda: [buffer_forecast.forecast_plan(db_file, [customer_id]).collect() for customer_id in customers], repeat=1),
+        "refresh of one customer"       : best_of(lambda: buffer_forecast.refresh_forecasts(db_file, "delivery", [{"customer_id": customers[0]}])),
+        "dispatch board read"           : best_of(lambda: buffer_forecast.forecasts(db_file, as_of), repeat=20),
+    }
+
+    due = buffer_forecast.forecasts(db_file, as_of).filter(pl.col("hours_left") <= 48).height
+    print(f"{n_deliveries} deliveries, {len(customers)} customers, {due} due within 48 h of the last delivery")
+    for name, seconds in results.items():
+        print(f"{name:<32} {seconds * 1000:10.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
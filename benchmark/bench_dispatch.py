@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+import numpy as np
+import polars as pl
+
+import database as db
+import buffer_forecast
+import dispatch
+from benchmark.synthetic import make_database
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Next-day planning over a fleet: python -m benchmark.bench_dispatch [200000]
+#
+# The whole plan for the day after the last delivery, and the solver alone (savings, 2-opt)
+# with every customer due, against serving each customer on a trip of its own.
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def route_minutes(routes, matrix):
+    return sum(
+        2 * dispatch.depot_minutes + matrix[route[:-1], route[1:]].sum() + dispatch.service_minutes * len(route)
+        for route in routes
+    )
+
+
+def run(n_deliveries=200_000):
+    workdir = tempfile.mkdtemp()
+    db_file = os.path.join(workdir, "bench.db")
+    customers, trucks = make_database(db_file, n_deliveries, n_customers=500, n_trucks=40)
+    db.database_file  = db_file
+    db.create_keyset_indexes(db_file)
+    buffer_forecast.enable(db_file, rebuild=True)
+
+    last      = db.query_table(db_file, "SELECT max(arrival_timestamp) FROM delivery")[0][0]
+    plan_date = datetime.datetime.strptime(last, db.timestamp_format).date() + datetime.timedelta(days=1)
+    stops     = dispatch.plan(db_file, plan_date)
+
+    # the solver alone, every customer due
+    history   = dispatch.recent_deliveries(db_file, plan_date)
+    trucks    = dispatch.fleet(db_file, plan_date, history)
+    due       = buffer_forecast.forecasts(db_file).join(
+        history.group_by("customer_id").agg(pl.col("delivery_route").mode().first()), on="customer_id", how="left",
+    )
+    matrix    = dispatch.travel_matrix(due["customer_id"].to_list(), due["delivery_route"].to_list(), dispatch.travel_pairs(history))
+    volumes   = np.full(due.height, 50.0)
+
+    def solve():
+        return [
+            dispatch.two_opt(route, matrix)
+            for route in dispatch.savings_routes(matrix, volumes, trucks["capacity"].max(), dispatch.shift_hours * 60)
+        ]
+
+    routes  = solve()
+    results = {
+        "next-day plan"                         : best_of(lambda: dispatch.plan(db_file, plan_date)),
+        f"solver, {due.height} customers"       : best_of(solve),
+    }
+
+    print(f"{n_deliveries} deliveries, {len(customers)} customers, {trucks.height} transports")
+    print(f"next-day plan: {stops.height} stops on {dispatch.route_summary(stops).height} routes")
+    print(f"all customers: {len(routes)} routes, {route_minutes(routes, matrix):.0f} min against "
+          f"{route_minutes([[position] for position in range(due.height)], matrix):.0f} min one trip per customer")
+    for name, seconds in results.items():
+        print(f"{name:<36} {seconds * 1000:10.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
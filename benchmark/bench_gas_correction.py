@@ -0,0 +1,126 @@
+import sys
+import time
+import math
+
+import numpy as np
+import polars as pl
+
+import gas_correction
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# The gas correction engine on millions of readings: python -m benchmark.bench_gas_correction [10000000]
+#
+# Besides the timings, every kernel runs under sys.setprofile at two sizes. The number of
+# Python-level calls (functions and builtins) must not grow with the number of readings:
+# that is the proof no per-row Python runs, whatever the model or number of customers.
+def per_row_correction(volume, pressure, temperature):
+    # the engine's default model evaluated one reading at a time, the baseline
+    return [
+        v * (p + gas_correction.P_ATM) / gas_correction.P_ATM * 300 / (t + gas_correction.KELVIN_OFFSET) * (1 + gas_correction.CPF * p)
+        for v, p, t in zip(volume, pressure, temperature)
+    ]
+
+
+def readings(n, customers=200, seed=5):
+    rng = np.random.default_rng(seed)
+    return {
+        "std_meter_diff"        : rng.uniform(0, 500, n),
+        "delivery_pressure"     : rng.uniform(0.5, 5, n),
+        "delivery_temperature"  : rng.uniform(20, 35, n),
+        "customer_id"           : np.char.add("C", rng.integers(0, customers, n).astype(str)),
+    }
+
+
+def mixed_conditions(customers=200):
+    # a third of the customers on the Papay model at 15 °C, a third on the linear model at 15 °C
+    default = gas_correction.Conditions()
+    entries = {}
+    for index in range(customers):
+        if index % 3 == 1:
+            entries[f"C{index}"] = gas_correction.Conditions(model="papay", reference_temperature=288.15)
+        elif index % 3 == 2:
+            entries[f"C{index}"] = gas_correction.Conditions(reference_temperature=288.15)
+    return default, entries
+
+
+def python_calls(fn):
+    calls = 0
+
+    def count(frame, event, arg):
+        nonlocal calls
+        if event in ("call", "c_call"):
+            calls += 1
+
+    sys.setprofile(count)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def kernels(data, frame):
+    def polars_kernel():
+        # lazily, as in the charge and tracker plans
+        return gas_correction.with_corrected_volume(frame.lazy(), "corrected").select("corrected").collect()
+
+    def numpy_kernel():
+        return gas_correction.corrected_volumes(
+            data["std_meter_diff"], data["delivery_pressure"], data["delivery_temperature"], data["customer_id"]
+        )
+
+    return {"polars expression": polars_kernel, "numpy arrays": numpy_kernel}
+
+
+def run(n_readings=10_000_000):
+    small = n_readings // 10
+    data  = readings(n_readings)
+    frame = pl.DataFrame(data)
+    probe = readings(small)
+    probe_frame = pl.DataFrame(probe)
+
+    results = {}
+    for setup, conditions in (("default", (gas_correction.Conditions(), {})), ("per-customer mixed", mixed_conditions())):
+        gas_correction.configure(*conditions)
+        for name, kernel in kernels(data, frame).items():
+            # warm up first: imports and caches only count once
+            probe_kernel = kernels(probe, probe_frame)[name]
+            probe_kernel()
+            calls_small  = python_calls(probe_kernel)
+            calls_large  = python_calls(kernel)
+            assert calls_large == calls_small, f"{name} ({setup}) makes per-row Python calls: {calls_small} -> {calls_large}"
+            results[f"{name}, {setup}"] = (best_of(kernel), calls_large)
+
+        # both backends agree on every reading
+        expected = kernels(data, frame)["polars expression"]()["corrected"].to_numpy()
+        actual   = kernels(data, frame)["numpy arrays"]()
+        assert np.allclose(expected, actual, rtol=1e-12, atol=0)
+    gas_correction.configure()
+
+    # the per-row baseline on a sample, scaled up
+    sample  = 200_000
+    seconds = best_of(lambda: per_row_correction(
+        data["std_meter_diff"][:sample].tolist(), data["delivery_pressure"][:sample].tolist(), data["delivery_temperature"][:sample].tolist()
+    ), repeat=1) * n_readings / sample
+    results["per-row python (extrapolated)"] = (seconds, math.nan)
+
+    print(f"{n_readings} readings, 200 customers; Python calls counted at {small} and {n_readings} readings")
+    for name, (seconds, calls) in results.items():
+        calls = "" if math.isnan(calls) else f"{calls:6d} python calls"
+        print(f"{name:<40} {seconds * 1000:10.1f} ms  {n_readings / seconds / 1e6:8.1f} M readings/s  {calls}")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000)
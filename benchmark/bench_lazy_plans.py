@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+import polars as pl
+
+import database as db
+import gas_correction
+import utils
+from benchmark.synthetic import make_database
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Eager pipelines as they were before the lazy plans, kept as the baseline
+def legacy_charge_table(db_file, customer_id, start_date, end_date):
+    delivery = pl.DataFrame(db.query_table_as_pandas(db_file, "select * from delivery;"))
+    price    = db.get_applied_price(db_file, customer_id)
+
+    df = (delivery
+        .filter(pl.col("customer_id") == customer_id)
+        .select([
+            pl.col("arrival_timestamp"),
+            pl.col("customer_id"),
+            pl.col("delivery_stand_meter").map_elements(utils.safe_float, return_dtype=pl.Float64).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
+            pl.col("delivery_temperature").map_elements(utils.safe_float, return_dtype=pl.Float64)
+        ])
+        .with_columns([
+            pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.date().alias("date"),
+            pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.strftime("%A").alias('day')
+        ])
+        .drop("arrival_timestamp")
+    )
+    df = df.with_columns([pl.col("std_meter_on_arrival").diff().alias("std_meter_diff")])
+    corrected_volume_expr = (
+        pl.col("std_meter_diff") * 
+        (pl.col("delivery_pressure") + gas_correction.P_ATM) / gas_correction.P_ATM * 
+        300 / (pl.col("delivery_temperature") + 273) * 
+        (1 + gas_correction.CPF * pl.col("delivery_pressure"))
+    )
+    df = df.with_columns([
+        corrected_volume_expr.alias("charged_volume"),
+        (corrected_volume_expr * price).alias("charged_price"),
+    ])
+    start = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    end   = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+    df    = df.filter(pl.col("date").is_between(start, end))
+    return df.with_columns([pl.col("day").replace(db.day_name_map).alias("day")])
+
+
+def legacy_tracker_frames(db_file, plate_number):
+    delivery = pl.DataFrame(db.query_table_as_pandas(db_file, "select * from delivery;"))
+    deliv    = (delivery
+        .filter(pl.col("transport_plate_number") == plate_number)
+        .select([
+            pl.col("arrival_timestamp"),
+            pl.col("pre_buffer_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
+            pl.col("post_buffer_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
+            pl.col("delivery_stand_meter").map_elements(utils.safe_float, return_dtype=pl.Float64).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
+            pl.col("delivery_temperature").map_elements(utils.safe_float, return_dtype=pl.Float64),
+            pl.col("customer_id").map_elements(lambda x: db.get_liter_weight_capacity(db_file, x), return_dtype=pl.Float64).alias("liter_weight_capacity")
+        ])
+        .with_columns([pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.date().alias("date")])
+        .with_columns([
+            ((pl.col("post_buffer_pressure") - pl.col("pre_buffer_pressure"))/200.0 * pl.col("liter_weight_capacity")/4).alias("est_volume_out"),
+            ((pl.col("post_buffer_pressure").shift(1).fill_null(0) - pl.col("pre_buffer_pressure"))/200.0 * pl.col("liter_weight_capacity").shift(1).fill_null(0)/4.).alias("est_volume_consumed"),
+            pl.col("std_meter_on_arrival").diff().alias("std_meter_diff"),
+        ])
+    )
+    deliv = deliv.with_columns([(
+        pl.col("std_meter_diff") * 
+        (pl.col("delivery_pressure") + gas_correction.P_ATM) / gas_correction.P_ATM * 
+        300 / (pl.col("delivery_temperature") + 273) * 
+        (1 + gas_correction.CPF * pl.col("delivery_pressure"))
+    ).alias("charged_volume")])
+    df = deliv.select([
+        "date",
+        pl.col("est_volume_out").cum_sum().alias("volume_out_cumul"),
+        pl.col("est_volume_consumed").cum_sum().alias("volume_consumed_cumul"),
+        pl.col("charged_volume").cum_sum().alias("charged_volume_cumul"),
+    ])
+    restock = pl.DataFrame(db.query_table_as_pandas(db_file, "select * from restock;"))
+    restock = restock.filter(pl.col("transport_plate_number") == plate_number).with_columns([
+        pl.col("restock_volume").map_elements(utils.safe_float, return_dtype=pl.Float64),
+    ])
+    rf = restock[1:].select([pl.col("restock_volume").cum_sum().alias("restock_volume_cumul")])
+    return rf, df
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(n_deliveries=20_000):
+    workdir = tempfile.mkdtemp()
+    db_file = os.path.join(workdir, "bench.db")
+    customers, trucks = make_database(db_file, n_deliveries, n_customers=200, n_trucks=20)
+    db.database_file  = db_file
+
+    customer_id          = customers[0]
+    plate_number         = trucks[0]
+    start_date, end_date = "2023-01-10", "2023-01-20"
+    price                = db.get_applied_price(db_file, customer_id)
+
+    charge_plan                  = db.charge_table_plan(db_file, customer_id, start_date, end_date, price)
+    restock_plan, delivery_plan  = db.tracker_plans(db_file, plate_number)
+
+    print("=== charge_table_plan.explain() ===")
+    print(charge_plan.explain())
+    print()
+    print("=== tracker delivery_plan.explain() ===")
+    print(delivery_plan.explain())
+    print()
+
+    # sanity check: both paths agree
+    legacy = legacy_charge_table(db_file, customer_id, start_date, end_date)
+    lazy   = charge_plan.collect()
+    assert legacy["charged_volume"].fill_null(0).round(6).to_list() == lazy["charged_volume"].fill_null(0).round(6).to_list()
+
+    results = {
+        "legacy charge table (eager)"  : best_of(lambda: legacy_charge_table(db_file, customer_id, start_date, end_date)),
+        "lazy charge table"            : best_of(lambda: db.charge_table_plan(db_file, customer_id, start_date, end_date, price).collect()),
+        "legacy tracker frames (eager)": best_of(lambda: legacy_tracker_frames(db_file, plate_number), repeat=1),
+        "lazy tracker frames"          : best_of(lambda: pl.collect_all(list(db.tracker_plans(db_file, plate_number)))),
+    }
+
+    print(f"{n_deliveries} deliveries, {len(customers)} customers, {len(trucks)} trucks")
+    for name, seconds in results.items():
+        print(f"{name:<32} {seconds * 1000:10.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,164 @@
+import sys
+import time
+import random
+import datetime
+from collections import defaultdict
+
+import report_parser
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Parsers as they were before report_parser, kept verbatim as the baseline
+def legacy_parse_delivery_report(text):
+    # Split the text by newlines and remove any empty lines
+    lines = [line for line in text.strip().split('\n') if line]
+    
+    result = {}
+    
+    # Process the lines in pairs
+    for i in range(0, len(lines), 2):
+        if i + 1 < len(lines):
+            column_name = lines[i].strip()
+            value = lines[i + 1].strip()
+            
+            # Convert value to appropriate type if possible
+            if value.lower() == 'null':
+                value = None
+                    
+            result[column_name] = str(value)
+            
+    return result    
+
+
+def legacy_parse_svarga_format(text):
+    lines = text.strip().split('\n')
+    
+    # Initialize the dictionary
+    data = defaultdict(str)
+    
+    # Initialize section tracking
+    current_section = None
+    
+    for line in lines:
+        line = line.strip()
+        
+        # Skip format header and separator lines
+        if line.startswith('FORMAT SVARGA') or line.startswith('====='):
+            current_section = None
+            continue
+        
+        # Check if line contains a colon for key-value pairs
+        if ':' in line:
+            parts      = line.split(':', 1)
+            key        = parts[0].strip().strip('*')
+            value      = parts[1].strip()
+            ikey       = key.lower().strip() 
+            ivalue     = value.lower().strip()            
+
+            # Handle the top-level entries
+            if current_section is None:
+                data[ikey] = ivalue
+            else:
+                # Ensure the section exists in the dictionary
+                if current_section not in data:
+                    data[current_section] = defaultdict(str)
+                
+                data[current_section][ikey] = ivalue
+        
+        # Lines without colons could be section headers
+        elif line and not line.startswith('*') and not ':' in line:
+            current_section = line.lower().strip()
+    
+    return data
+
+
+def legacy_typed_delivery(text):
+    """
+    The legacy per-report work of generate_delivery_rowrep: parse, then convert with strptime.
+    """
+    parsed      = legacy_parse_delivery_report(text)
+    date        = datetime.datetime.strptime(parsed["delivery_date"].lower(), '%d-%b-%y')
+    clock       = datetime.datetime.strptime(parsed["delivery_arrival_time"], "%H:%M").time()
+    record      = dict(parsed)
+    record["delivery_date"]         = date.date()
+    record["delivery_arrival_time"] = clock
+    for name in ("pre_buffer_pressure", "delivery_stand_meter", "delivery_pressure",
+                 "delivery_temperature", "post_buffer_pressure", "transport_bank_pressure"):
+        record[name] = None if parsed[name] == "None" else float(parsed[name])
+    return record
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def make_delivery_reports(n, seed=7):
+    rng     = random.Random(seed)
+    start   = datetime.date(2024, 1, 1)
+    reports = []
+    for i in range(n):
+        day = start + datetime.timedelta(days=i // 20)
+        reports.append("\n".join([
+            "customer_id", f"0110{rng.randint(0, 999):03d}",
+            "delivery_route", rng.choice(["domina", "kemang", "tebet"]),
+            "transport_plate_number", rng.choice(["R4J1N", "C3R14", "G3MB1R4"]),
+            "delivery_date", day.strftime("%d-%b-%y").lower(),
+            "delivery_arrival_time", f"{rng.randint(6, 20):02d}:{rng.randint(0, 59):02d}",
+            "pre_buffer_pressure", "null" if rng.random() < 0.05 else f"{rng.uniform(10, 80):.1f}",
+            "delivery_stand_meter", f"{1000 + i * 40.5:.3f}",
+            "delivery_pressure", "1.5",
+            "delivery_temperature", f"{rng.uniform(24, 33):.1f}",
+            "post_buffer_pressure", f"{rng.uniform(100, 140):.1f}",
+            "transport_bank_pressure", f"{rng.uniform(40, 130):.1f}",
+        ]))
+    return reports
+
+
+def make_svarga_report(sections=50):
+    lines = ["FORMAT SVARGA", "====="]
+    for i in range(sections):
+        lines.append(f"**Field {i}**: Value {i}")
+        lines.append(f"Section {i}")
+        lines.extend(f"  reading {j} : {j * 1.5}" for j in range(10))
+        lines.append("* footnote")
+        lines.append("=====")
+    return "\n".join(lines)
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(n_reports=5000):
+    reports = make_delivery_reports(n_reports)
+    block   = "\n\n".join(reports)
+    svarga  = make_svarga_report()
+
+    # sanity check: both paths agree on the typed values
+    records, errors = report_parser.parse_report_block(block, report_parser.delivery_report_fields)
+    legacy          = [legacy_typed_delivery(report) for report in reports]
+    assert not any(errors)
+    assert all(
+        records[i][key] == legacy[i][key]
+        for i in range(n_reports) for key in report_parser.delivery_report_fields
+    )
+    assert dict(report_parser.parse_svarga_block(svarga)) == dict(legacy_parse_svarga_format(svarga))
+
+    results = {
+        "legacy delivery (per report + strptime)" : best_of(lambda: [legacy_typed_delivery(r) for r in reports]),
+        "report_parser delivery (one block)"      : best_of(lambda: report_parser.parse_report_block(block, report_parser.delivery_report_fields)),
+        "legacy svarga"                           : best_of(lambda: [legacy_parse_svarga_format(svarga) for _ in range(200)]),
+        "report_parser svarga"                    : best_of(lambda: [report_parser.parse_svarga_block(svarga) for _ in range(200)]),
+    }
+
+    print(f"{n_reports} delivery reports, 200 x {len(svarga.splitlines())}-line svarga reports")
+    for name, seconds in results.items():
+        print(f"{name:<42} {seconds * 1000:10.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+import database as db
+import mass_balance
+import restock_forecast
+import writer
+from benchmark.synthetic import make_database
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Restock forecasts over a fleet: python -m benchmark.bench_restock_forecast [200000]
+#
+# The one-pass plan over all transports against the same plan run transport by transport,
+# the refresh the write listener runs after one delivery or one restock, and the read of
+# the tracker panel.
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def last_delivery(db_file, customer_id):
+    row = db.query_table(db_file, """
+        SELECT arrival_timestamp, delivery_stand_meter, transport_plate_number FROM delivery
+        WHERE customer_id = ? ORDER BY arrival_timestamp DESC LIMIT 1
+    """, (customer_id,))[0]
+    return datetime.datetime.strptime(row[0], db.timestamp_format), float(row[1]), row[2]
+
+
+def run(n_deliveries=200_000):
+    workdir = tempfile.mkdtemp()
+    db_file = os.path.join(workdir, "bench.db")
+    customers, trucks = make_database(db_file, n_deliveries, n_customers=500, n_trucks=40)
+    db.database_file  = db_file
+    db.enable_wal(db_file)
+    db.create_keyset_indexes(db_file)
+    restock_forecast.enable(db_file, rebuild=True)
+
+    one_pass  = restock_forecast.forecast_plan(db_file)
+    per_plate = pl.concat([restock_forecast.forecast_plan(db_file, [plate]) for plate in trucks])
+    assert_frame_equal(one_pass.sort("transport_plate_number"), per_plate.sort("transport_plate_number"), check_exact=False, rtol=1e-9)
+
+    customer_id = customers[0]
+    writes      = iter(range(1, 1_000))
+
+    def write_delivery():
+        arrival, meter, plate = last_delivery(db_file, customer_id)
+        arrival += datetime.timedelta(hours=next(writes))
+        writer.write(db_file, "delivery", [{
+            "delivery_id"               : customer_id + arrival.strftime("%Y%m%d%H%M"),
+            "customer_id"               : customer_id,
+            "delivery_route"            : "bench",
+            "transport_plate_number"    : plate,
+            "arrival_timestamp"         : arrival.strftime(db.timestamp_format),
+            "pre_buffer_pressure"       : 40.0,
+            "delivery_stand_meter"      : meter + 45.0,
+            "delivery_pressure"         : 1.5,
+            "delivery_temperature"      : 28.0,
+            "post_buffer_pressure"      : 120.0,
+            "transport_bank_pressure"   : 90.0,
+        }])
+        writer.settle(db_file)
+
+    def write_restock():
+        date = datetime.date(2030, 1, 1) + datetime.timedelta(days=next(writes))
+        writer.write(db_file, "restock", [{
+            "restock_id"                : trucks[0] + date.strftime("%Y%m%d"),
+            "restock_date"              : date.strftime(db.date_format),
+            "transport_plate_number"    : trucks[0],
+            "restock_volume"            : 700.0,
+            "gas_station_address"       : "bench",
+        }], upsert=True)
+        writer.settle(db_file)
+
+    # the write and the mass balance refresh alone are subtracted from the timings below
+    db.write_listeners.remove(restock_forecast.refresh_predictions)
+    bare_delivery = best_of(write_delivery, repeat=5)
+    bare_restock  = best_of(write_restock, repeat=5)
+    db.write_listeners.append(restock_forecast.refresh_predictions)
+    restock_forecast.build_forecasts(db_file)
+
+    results = {
+        "one pass over all transports"      : best_of(lambda: restock_forecast.forecast_plan(db_file)),
+        "transport by transport"            : best_of(lambda: [restock_forecast.forecast_plan(db_file, [plate]) for plate in trucks], repeat=1),
+        "refresh after one delivery write"  : best_of(write_delivery, repeat=5) - bare_delivery,
+        "refresh after one restock write"   : best_of(write_restock, repeat=5) - bare_restock,
+        "tracker panel read"                : best_of(lambda: restock_forecast.forecasts(db_file, plates=[trucks[0]]), repeat=20),
+    }
+
+    # the incremental table equals a rebuild after all those writes, up to the order of the sums
+    before = restock_forecast.forecasts(db_file).sort("transport_plate_number")
+    mass_balance.refresh(db_file, rebuild=True)
+    restock_forecast.build_forecasts(db_file)
+    after  = restock_forecast.forecasts(db_file).sort("transport_plate_number")
+    assert_frame_equal(before, after, check_exact=False, rtol=1e-9)
+
+    print(f"{n_deliveries} deliveries, {len(customers)} customers, {len(trucks)} transports")
+    for name, seconds in results.items():
+        print(f"{name:<36} {seconds * 1000:10.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
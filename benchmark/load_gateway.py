@@ -0,0 +1,106 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import statistics
+from collections import Counter
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Load test of gateway.py: python -m benchmark.load_gateway --clients 1000
+#
+# Every client opens its own keep-alive connection and uploads delivery reports one at a
+# time, optionally trickling each body in slow chunks like a truck on a bad link. Latency is
+# measured from the first byte sent to the full response. Run it against a gateway writing
+# to a scratch copy of the database: every report is a new delivery.
+def delivery_report(customer_id, arrival, stand_meter, rng):
+    return "\n".join([
+        "customer_id", customer_id,
+        "delivery_route", "loadtest",
+        "transport_plate_number", rng.choice(["R4J1N", "C3R14", "G3MB1R4"]),
+        "delivery_date", arrival.strftime("%d-%b-%y").lower(),
+        "delivery_arrival_time", arrival.strftime("%H:%M"),
+        "pre_buffer_pressure", f"{rng.uniform(10, 80):.1f}",
+        "delivery_stand_meter", f"{stand_meter:.3f}",
+        "delivery_pressure", "1.5",
+        "delivery_temperature", f"{rng.uniform(24, 33):.1f}",
+        "post_buffer_pressure", f"{rng.uniform(100, 140):.1f}",
+        "transport_bank_pressure", f"{rng.uniform(40, 130):.1f}",
+    ])
+
+
+async def client(index, args, start, results):
+    rng     = random.Random(args.seed * 100_003 + index)
+    reader, stream = await asyncio.open_connection(args.host, args.port)
+    try:
+        for request in range(args.requests):
+            # clients share a pool of customers, a distinct arrival minute per upload keeps delivery_ids unique
+            arrival = start + datetime.timedelta(minutes=index * args.requests + request)
+            body    = delivery_report(f"LT{args.seed:03d}{index % args.customers:04d}", arrival, 1000 + request * 40.5, rng).encode()
+            head    = (
+                f"POST /api/ingest/delivery HTTP/1.1\r\nHost: {args.host}\r\nContent-Type: text/plain\r\n"
+                f"X-Ingest-Token: {args.token}\r\nContent-Length: {len(body)}\r\n\r\n"
+            ).encode()
+
+            sent = time.perf_counter()
+            stream.write(head)
+            for offset in range(0, len(body), args.chunk_bytes):
+                stream.write(body[offset:offset + args.chunk_bytes])
+                await stream.drain()
+                if args.chunk_delay:
+                    await asyncio.sleep(args.chunk_delay)
+
+            status  = int((await reader.readline()).split()[1])
+            length  = 0
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            payload = json.loads(await reader.readexactly(length))
+            results.append((status, time.perf_counter() - sent, payload.get("written", 0)))
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        results.append((type(e).__name__, 0.0, 0))
+    finally:
+        stream.close()
+
+
+async def run(args):
+    results = []
+    start   = datetime.datetime(2040, 1, 1) + datetime.timedelta(days=args.seed)
+    began   = time.perf_counter()
+    await asyncio.gather(*(client(index, args, start, results) for index in range(args.clients)))
+    seconds = time.perf_counter() - began
+
+    statuses  = Counter(status for status, _, _ in results)
+    latencies = sorted(latency for status, latency, _ in results if status == 200)
+    written   = sum(count for _, _, count in results)
+    print(f"{args.clients} clients x {args.requests} requests in {seconds:.2f} s, {written} reports written ({written / seconds:.0f}/s)")
+    print(f"statuses: {dict(statuses)}")
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"latency ms: p50 {quantiles[49] * 1000:.1f}  p95 {quantiles[94] * 1000:.1f}  "
+              f"p99 {quantiles[98] * 1000:.1f}  max {latencies[-1] * 1000:.1f}")
+    return 0 if statuses.get(200, 0) == len(results) else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.load_gateway", description="Simulates concurrent truck uploads against gateway.py.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8060)
+    parser.add_argument("--token", required=True, help="the gateway's GMERCHANT_INGEST_TOKEN")
+    parser.add_argument("--clients", type=int, default=1000, help="concurrent connections")
+    parser.add_argument("--requests", type=int, default=5, help="reports uploaded by every client")
+    parser.add_argument("--customers", type=int, default=50, help="customers the reports are spread over")
+    parser.add_argument("--chunk-bytes", type=int, default=64, help="body bytes written at a time")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between chunks, a slow link")
+    parser.add_argument("--seed", type=int, default=1, help="change it between runs on the same database")
+    args = parser.parse_args(argv)
+
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+import datetime
+
+import polars as pl
+
+import database as db
+import fill_tables
+import utils
+from benchmark import synthetic
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Cases: name -> (setup, max_rows, max_rounds). setup(context) prepares a size and returns
+# the zero-argument callable that is timed. Sizes above max_rows are recorded as skipped,
+# cases with max_rounds are timed at most that many times and without warmup.
+cases = {}
+
+
+def case(name, max_rows=None, max_rounds=None):
+    def register(setup):
+        cases[name] = (setup, max_rows, max_rounds)
+        return setup
+    return register
+
+
+class Context:
+    """
+    What a case needs to know about the synthetic database of one size.
+    """
+    def __init__(self, db_file, rows, customers, trucks, workdir):
+        self.db_file    = db_file
+        self.rows       = rows
+        self.customers  = customers
+        self.trucks     = trucks
+        self.workdir    = workdir
+
+    @property
+    def customer_id(self):
+        return self.customers[len(self.customers) // 2]
+
+    @property
+    def plate_number(self):
+        return self.trucks[0]
+
+    @property
+    def month(self):
+        # a full month well inside the generated span
+        start = synthetic.START.date().replace(month=2)
+        return start.strftime(db.date_format), start.replace(day=28).strftime(db.date_format)
+
+
+@case("generate_charge_table")
+def charge_table_case(context):
+    start_date, end_date = context.month
+    return lambda: db.generate_charge_table(context.db_file, context.customer_id, start_date, end_date)
+
+
+@case("generate_tracker_set")
+def tracker_set_case(context):
+    return lambda: db.generate_tracker_set(context.plate_number)
+
+
+@case("check_delivery_id_existence", max_rows=1_000_000)
+def delivery_id_existence_case(context):
+    # reads and prints every stored id, larger sizes only measure the terminal
+    delivery_id = context.customer_id + "209901010000"
+    return lambda: db.check_delivery_id_existence(delivery_id)
+
+
+@case("check_delivery_ids_existence")
+def delivery_ids_existence_case(context):
+    delivery_ids = [customer_id + "209901010000" for customer_id in context.customers[:500]]
+    return lambda: db.check_delivery_ids_existence(delivery_ids)
+
+
+@case("replenish_table", max_rows=100_000, max_rounds=1)
+def replenish_table_case(context):
+    # replenish_table reads the YAML sheets of the working directory into ./operation.db
+    directory = os.path.join(context.workdir, f"replenish-{context.rows}")
+    synthetic.write_yaml_fixtures(context.db_file, directory)
+
+    def run():
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            fill_tables.replenish_table()
+        finally:
+            os.chdir(cwd)
+    return run
+
+
+@case("excel_delivery_export", max_rows=100_000, max_rounds=1)
+def delivery_excel_case(context):
+    # xlsxwriter keeps the whole workbook in memory, a million rows takes more than 5 GB
+    def run():
+        df = db.query_table_as_pandas(context.db_file, "SELECT * FROM delivery")
+        utils.write_df_to_excel(df, io.BytesIO())
+    return run
+
+
+@case("excel_restock_export")
+def restock_excel_case(context):
+    def run():
+        df = db.query_table_as_pandas(context.db_file, "SELECT * FROM restock")
+        df = utils.remove_df_underscore(df)
+        utils.write_df_to_excel(df, io.BytesIO())
+    return run
+
+
+@case("excel_recap_export")
+def recap_excel_case(context):
+    start_date, end_date = context.month
+
+    def run():
+        res = db.generate_charge_table(context.db_file, context.customer_id, start_date, end_date)
+        utils.write_df_to_excel(res["dataframe"].to_pandas(), io.BytesIO())
+    return run
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@contextlib.contextmanager
+def quiet():
+    # keeps stray output of the measured paths off the terminal, logging is left
+    # unconfigured so only warnings reach stderr
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def time_case(fn, rounds, warmup=1):
+    """
+    Times fn like pytest-benchmark: warmup calls, then rounds timed calls.
+
+    Returns:
+        dict: {"rounds", "min", "max", "mean", "median", "stddev", "ops"}, times in seconds.
+    """
+
+    with quiet():
+        for _ in range(warmup):
+            fn()
+
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+
+    mean = statistics.mean(timings)
+    return {
+        "rounds"    : rounds,
+        "min"       : min(timings),
+        "max"       : max(timings),
+        "mean"      : mean,
+        "median"    : statistics.median(timings),
+        "stddev"    : statistics.stdev(timings) if rounds > 1 else 0.0,
+        "ops"       : 1 / mean if mean > 0 else 0.0,
+    }
+
+
+def memory_case(fn):
+    """
+    Measures one call: the Python heap peak (tracemalloc) and the growth of the process
+    peak RSS, which also covers Polars and SQLite allocations.
+
+    Returns:
+        dict: {"python_peak_bytes", "rss_peak_growth_bytes"}.
+    """
+
+    rss_before = peak_rss_bytes()
+    tracemalloc.start()
+    try:
+        with quiet():
+            fn()
+        _, python_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "python_peak_bytes"     : python_peak,
+        "rss_peak_growth_bytes" : peak_rss_bytes() - rss_before,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def run(size_labels, case_names=None, rounds=3, memory=True, workdir="benchmark-data", seed=11):
+    """
+    Runs the selected cases against a synthetic database of every size.
+
+    Args:
+        size_labels (list): Sizes such as ["10k", "100k"], see synthetic.parse_size.
+        case_names (list): Cases to run, all when None.
+        rounds (int): Timed calls per case.
+        memory (bool): Also measure memory with one extra call.
+        workdir (str): Where synthetic databases and fixtures are kept between runs.
+        seed (int): Seed of the generator.
+
+    Returns:
+        dict: The results document, see write_results.
+    """
+
+    selected = case_names or list(cases)
+    results  = []
+    for label in size_labels:
+        rows = synthetic.parse_size(label)
+        print(f"preparing {rows} deliveries in {workdir}")
+        with quiet():
+            db_file, customers, trucks = synthetic.cached_database(workdir, rows, seed)
+        context = Context(db_file, rows, customers, trucks, workdir)
+
+        # generate_tracker_set and the price lookups read the module level database
+        previous_database, db.database_file = db.database_file, db_file
+        try:
+            for name in selected:
+                setup, max_rows, max_rounds = cases[name]
+                entry = {"case": name, "size": label, "rows": rows}
+                if max_rows is not None and rows > max_rows:
+                    entry["status"] = f"skipped, above {max_rows} rows"
+                    results.append(entry)
+                    print(f"{name:<32} {label:>6}  skipped")
+                    continue
+
+                with quiet():
+                    fn = setup(context)
+                entry["status"] = "ok"
+                if max_rounds is None:
+                    entry["timing"] = time_case(fn, rounds)
+                else:
+                    entry["timing"] = time_case(fn, min(rounds, max_rounds), warmup=0)
+                if memory:
+                    entry["memory"] = memory_case(fn)
+                results.append(entry)
+
+                line = f"{name:<32} {label:>6}  mean {entry['timing']['mean'] * 1000:10.2f} ms"
+                if memory:
+                    line += f"  python peak {entry['memory']['python_peak_bytes'] / 2**20:8.1f} MiB"
+                print(line)
+        finally:
+            db.database_file = previous_database
+
+    return {
+        "created"   : datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit"    : git_commit(),
+        "python"    : platform.python_version(),
+        "polars"    : pl.__version__,
+        "platform"  : platform.platform(),
+        "seed"      : seed,
+        "results"   : results,
+    }
+
+
+def write_results(document, path):
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+    print(f"results written to {path}")
+
+
+def compare(document, baseline_path, threshold=1.25):
+    """
+    Prints the best time of every case against a previous results file. The minimum
+    is compared as it is the least sensitive to noise from other processes.
+
+    Args:
+        document (dict): Results of this run.
+        baseline_path (str): A results file written by an earlier run.
+        threshold (float): Slowdown ratio reported as a regression.
+
+    Returns:
+        list: (case, size, ratio) of the regressions.
+    """
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    previous    = {(entry["case"], entry["size"]): entry for entry in baseline["results"] if entry.get("timing")}
+    regressions = []
+    print(f"compared to {baseline_path} ({baseline.get('commit')}, {baseline.get('created')})")
+    for entry in document["results"]:
+        before = previous.get((entry["case"], entry["size"]))
+        if not entry.get("timing") or before is None:
+            continue
+
+        ratio = entry["timing"]["min"] / before["timing"]["min"]
+        flag  = "  REGRESSION" if ratio > threshold else ""
+        print(f"{entry['case']:<32} {entry['size']:>6}  x{ratio:6.2f}{flag}")
+        if ratio > threshold:
+            regressions.append((entry["case"], entry["size"], ratio))
+
+    return regressions
@@ -0,0 +1,267 @@
+import os
+import datetime
+
+import numpy as np
+import polars as pl
+
+import database as db
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Seeded synthetic operation data. Every customer is visited once per round (two days),
+# stand meters only grow, and every transport restocks every other day, so the charge,
+# tracker and ingest paths see realistic shapes at any size.
+START           = datetime.datetime(2023, 1, 1, 6, 0)
+ROUND_DAYS      = 2
+CHUNK_ROWS      = 500_000
+
+# named scales, counted in delivery rows
+sizes           = {
+    "10k"   : 10_000,
+    "100k"  : 100_000,
+    "1m"    : 1_000_000,
+    "10m"   : 10_000_000,
+}
+
+
+def parse_size(label):
+    """
+    Converts a size label such as "100k" or "1m" (or a plain number) to a row count.
+    """
+    label = str(label).lower()
+    if label in sizes:
+        return sizes[label]
+
+    scale = {"k": 1_000, "m": 1_000_000}.get(label[-1], 1)
+    return int(float(label.rstrip("km")) * scale)
+
+
+def default_fleet(n_deliveries):
+    """
+    Returns (n_customers, n_trucks) for a number of deliveries, about 500 deliveries per customer.
+    """
+    n_customers = max(50, n_deliveries // 500)
+    return n_customers, max(5, n_customers // 10)
+
+
+def customer_ids(n_customers):
+    return [f"{110000 + i:07d}" for i in range(n_customers)]
+
+
+def plate_numbers(n_trucks):
+    return [f"TRK{i:04d}" for i in range(n_trucks)]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def customer_frame(customers):
+    """
+    Returns the customer table rows, all columns as strings as stored.
+    """
+    return pl.DataFrame({
+        "customer_id"               : customers,
+        "customer_name"             : [f"Customer {customer_id}" for customer_id in customers],
+        "customer_address"          : [f"Jl. Sintetis No. {i % 200 + 1}, Jakarta" for i in range(len(customers))],
+    }).with_columns([
+        pl.lit("weekly").alias("subscription_type"),
+        pl.lit(START.strftime(db.date_format)).alias("subscription_start"),
+        pl.lit("980").alias("liter_weight_capacity"),
+        pl.lit("2500").alias("minimum_monthly_volume"),
+        pl.lit("4").alias("buffer_count"),
+        pl.lit("13500").alias("applied_price"),
+    ])
+
+
+def delivery_frames(n_deliveries, customers, trucks, seed=11):
+    """
+    Yields the delivery rows in chunks of whole rounds, as frames of the delivery table.
+
+    Args:
+        n_deliveries (int): Total number of deliveries.
+        customers (list): Customer ids, each visited once per round.
+        trucks (list): Plate numbers, rotating over the customers.
+        seed (int): Seed of the generator.
+
+    Yields:
+        pl.DataFrame: Delivery rows in arrival order, readings as floats.
+    """
+
+    rng         = np.random.default_rng(seed)
+    n_customers = len(customers)
+    n_rounds    = -(-n_deliveries // n_customers)
+    per_chunk   = max(1, CHUNK_ROWS // n_customers)
+    customer_s  = pl.Series("customer_id", customers)
+    truck_s     = pl.Series("transport_plate_number", trucks)
+
+    # customers are visited a minute apart within a round, which keeps delivery ids unique
+    visit       = np.arange(n_customers, dtype=np.int64)
+    meters      = np.zeros(n_customers)
+    emitted     = 0
+    for first in range(0, n_rounds, per_chunk):
+        rounds  = np.arange(first, min(first + per_chunk, n_rounds), dtype=np.int64)
+        shape   = (len(rounds), n_customers)
+        take    = min(rounds.size * n_customers, n_deliveries - emitted)
+
+        block   = meters + np.cumsum(rng.uniform(20, 60, shape), axis=0)
+        meters  = block[-1]
+        minutes = rounds[:, None] * ROUND_DAYS * 24 * 60 + visit[None, :]
+        index   = np.tile(visit, rounds.size)[:take]
+        trucked = ((visit[None, :] + rounds[:, None]) % len(trucks)).ravel()[:take]
+
+        def reading(low, high):
+            return rng.uniform(low, high, shape).ravel()[:take]
+
+        frame = pl.DataFrame({
+            "customer_id"               : customer_s.gather(index),
+            "delivery_route"            : pl.Series(index % 10).cast(pl.Utf8),
+            "transport_plate_number"    : truck_s.gather(trucked),
+            "arrival"                   : (np.datetime64(START, "m") + minutes.ravel()[:take]).astype("datetime64[ms]"),
+            "pre_buffer_pressure"       : reading(10, 80),
+            "delivery_stand_meter"      : block.ravel()[:take],
+            "delivery_pressure"         : np.full(take, 1.5),
+            "delivery_temperature"      : reading(24, 33),
+            "post_buffer_pressure"      : reading(100, 140),
+            "transport_bank_pressure"   : reading(40, 130),
+        })
+
+        yield frame.select([
+            db.delivery_id_expr().alias("delivery_id"),
+            pl.col("customer_id"),
+            ("route" + pl.col("delivery_route")).alias("delivery_route"),
+            pl.col("transport_plate_number"),
+            pl.col("arrival").dt.strftime(db.timestamp_format).alias("arrival_timestamp"),
+            *[pl.col(col) for col in db.delivery_numeric_columns],
+        ])
+
+        emitted += take
+        if emitted >= n_deliveries:
+            break
+
+
+def restock_frame(n_deliveries, customers, trucks, seed=11):
+    """
+    Returns the restock rows, one per transport every other day over the delivery span.
+    """
+    rng      = np.random.default_rng(seed + 1)
+    n_days   = -(-n_deliveries // len(customers)) * ROUND_DAYS + 1
+    days     = np.arange(0, n_days, 2)
+    plates   = np.repeat(np.array(trucks), days.size)
+    dates    = np.tile(np.datetime64(START.date()) + days, len(trucks))
+
+    frame = pl.DataFrame({
+        "transport_plate_number"    : plates,
+        "restock_date"              : dates,
+        "restock_volume"            : rng.uniform(500, 800, plates.size),
+    })
+    return frame.select([
+        db.restock_id_expr().alias("restock_id"),
+        pl.col("restock_date").dt.strftime(db.date_format),
+        pl.col("transport_plate_number"),
+        pl.col("restock_volume"),
+        pl.lit("Jl. Fiktif No. 12, Jakarta Timur").alias("gas_station_address"),
+    ])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def make_database(db_file, n_deliveries, n_customers=None, n_trucks=None, seed=11):
+    """
+    Creates the tables of operation.db in db_file and fills them with synthetic rows.
+
+    Args:
+        db_file (str): The path of the SQLite database to create.
+        n_deliveries (int): Number of delivery rows.
+        n_customers (int): Number of customers, see default_fleet when None.
+        n_trucks (int): Number of transports, see default_fleet when None.
+        seed (int): Seed of the generator, equal seeds give equal databases.
+
+    Returns:
+        tuple: (customers, trucks), the generated customer ids and plate numbers.
+    """
+
+    fleet_customers, fleet_trucks = default_fleet(n_deliveries)
+    customers   = customer_ids(n_customers or fleet_customers)
+    trucks      = plate_numbers(n_trucks or fleet_trucks)
+
+    for table_name in db.db_table_columns:
+        db.create_table_with_list(db_file, table_name, db.db_table_columns[table_name])
+        db.create_key_index(db_file, table_name)
+
+    db.insert_rows_from_dicts(db_file, "customer", customer_frame(customers).to_dicts())
+    for frame in delivery_frames(n_deliveries, customers, trucks, seed):
+        db.insert_rows_from_dicts(db_file, "delivery", frame.to_dicts())
+    db.insert_rows_from_dicts(db_file, "restock", restock_frame(n_deliveries, customers, trucks, seed).to_dicts())
+
+    return customers, trucks
+
+
+def cached_database(directory, n_deliveries, seed=11):
+    """
+    Returns a synthetic database for a size, generated once and reused across runs.
+
+    Args:
+        directory (str): Directory holding the generated databases.
+        n_deliveries (int): Number of delivery rows.
+        seed (int): Seed of the generator.
+
+    Returns:
+        tuple: (db_file, customers, trucks).
+    """
+
+    n_customers, n_trucks = default_fleet(n_deliveries)
+    db_file = os.path.join(directory, f"synthetic-{n_deliveries}-{seed}.db")
+    if not os.path.exists(db_file):
+        os.makedirs(directory, exist_ok=True)
+        partial = db_file + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        make_database(partial, n_deliveries, n_customers, n_trucks, seed)
+        os.replace(partial, db_file)
+
+    return db_file, customer_ids(n_customers), plate_numbers(n_trucks)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def yaml_value(value):
+    return "null" if value is None else f'"{value}"'
+
+
+def write_yaml_fixtures(db_file, directory):
+    """
+    Writes customer.yml, delivery.yml and restock.yml in the layout replenish_table reads,
+    from the rows of a database.
+
+    Args:
+        db_file (str): The database to export.
+        directory (str): Where the YAML files are written.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    customer = db.scan_table(db_file, "customer").collect()
+    delivery = (db.scan_table(db_file, "delivery").collect()
+        .with_columns(pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format).alias("arrival"))
+        .select([
+            pl.col("customer_id"),
+            pl.col("delivery_route"),
+            pl.col("transport_plate_number").alias("plate_number"),
+            pl.col("arrival").dt.strftime("%d-%b-%y").alias("delivery_date"),
+            pl.col("arrival").dt.strftime("%H.%M").alias("delivery_arrival_time"),
+            *[pl.col(col) for col in db.delivery_numeric_columns],
+        ])
+    )
+    restock  = (db.scan_table(db_file, "restock").collect()
+        .select([
+            pl.lit("").alias("restock_id"),
+            pl.col("transport_plate_number").alias("plate_number"),
+            pl.col("restock_date"),
+            pl.col("restock_volume"),
+            pl.col("gas_station_address").alias("spbg_address"),
+        ])
+    )
+
+    for name, frame in [("customer", customer), ("delivery", delivery), ("restock", restock)]:
+        with open(os.path.join(directory, f"{name}.yml"), "w") as file:
+            for row in frame.iter_rows(named=True):
+                file.write("- \n")
+                for key, value in row.items():
+                    file.write(f"  {key:<26}: {yaml_value(value)}\n")
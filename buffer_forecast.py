@@ -0,0 +1,287 @@
+import sys
+import json
+import argparse
+import datetime
+import polars as pl
+import database as db
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Customer buffer depletion forecast: python buffer_forecast.py [--days 3]
+#
+# Between two deliveries a customer's buffers drain from the post_buffer_pressure left by the
+# first to the pre_buffer_pressure found by the second. Over the last history_intervals such
+# intervals of a customer, the consumption rate is
+#
+#   rate        = sum of the pressure drops / sum of the hours between the deliveries (bar/h)
+#   rate_high   = the rate_quantile of the interval rates, a busy spell
+#
+# and the buffers reach refill_pressure rate hours (or rate_high hours, at the earliest) after
+# the last delivery. Volumes convert pressure as est_volume_consumed of the tracker graph:
+# 200 bar hold a quarter of the liter_weight_capacity.
+#
+# All customers are computed in one pass of group-wise Polars expressions, and the result is
+# kept in the buffer_forecast table, one row per customer, recomputed for the customers of every
+# delivery or customer write. forecasts() reads it and projects the pressures to a given time,
+# so the dispatch board never touches the delivery history.
+BUFFER_FORECAST_SCHEMA  = """
+CREATE TABLE IF NOT EXISTS buffer_forecast (
+    customer_id             TEXT PRIMARY KEY,
+    last_arrival            TEXT,
+    last_pressure           REAL,
+    intervals               INTEGER NOT NULL,
+    rate                    REAL,
+    rate_high               REAL,
+    volume_per_day          REAL,
+    refill_at               TEXT,
+    earliest_refill_at      TEXT
+)
+"""
+BUFFER_FORECAST_COLUMNS = ["customer_id", "last_arrival", "last_pressure", "intervals", "rate", "rate_high",
+                           "volume_per_day", "refill_at", "earliest_refill_at"]
+
+refill_pressure         = 30.0
+history_intervals       = 8
+min_intervals           = 2
+rate_quantile           = 0.9
+
+# databases whose forecasts are kept up to date by refresh_forecasts
+enabled_databases       = set()
+
+logger                  = logs.get_logger("buffer_forecast")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def hours_after(timestamp, hours):
+    """
+    Returns the timestamp expression hours (an expression, null-safe) later.
+    """
+    return pl.col(timestamp) + pl.duration(milliseconds=(hours * 3_600_000).round(0).cast(pl.Int64))
+
+
+def positive(column):
+    """
+    Returns the column where positive, else null: as a divisor it gives null instead of inf,
+    which pl.when does not prevent, the division running on every row.
+    """
+    return pl.when(pl.col(column) > 0).then(pl.col(column))
+
+
+def forecast_plan(db_file, customer_ids=None):
+    """
+    Builds the lazy plan of the buffer_forecast rows of some or all customers.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_ids (list): Optional customers to compute, all when None.
+
+    Returns:
+        pl.LazyFrame: BUFFER_FORECAST_COLUMNS, timestamps as stored strings.
+    """
+
+    if customer_ids is not None and len(customer_ids) == 1:
+        deliveries = db.scan_analytics(db_file, "delivery", {"customer_id": customer_ids[0]})
+    else:
+        deliveries = db.scan_analytics(db_file, "delivery")
+        if customer_ids is not None:
+            deliveries = deliveries.filter(pl.col("customer_id").is_in(customer_ids))
+
+    customer = (db.scan_analytics(db_file, "customer")
+        .select([
+            pl.col("customer_id"),
+            pl.col("liter_weight_capacity").cast(pl.Float64, strict=False),
+        ])
+        .unique("customer_id", keep="last", maintain_order=True)
+    )
+
+    valid = (pl.col("hours") > 0) & (pl.col("pressure_drop") >= 0)
+
+    def recent(expr):
+        return expr.filter(valid).tail(history_intervals)
+
+    rate       = pl.col("pressure_drop_sum") / pl.col("hours_sum")
+    enough     = pl.col("intervals") >= min_intervals
+    remaining  = (pl.col("last_pressure") - refill_pressure).clip(lower_bound=0)
+
+    return (deliveries
+        .select([
+            pl.col("customer_id"),
+            pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format, strict=False).alias("arrival"),
+            pl.col("pre_buffer_pressure").cast(pl.Float64, strict=False),
+            pl.col("post_buffer_pressure").cast(pl.Float64, strict=False),
+        ])
+        .filter(pl.col("arrival").is_not_null())
+        .sort(["customer_id", "arrival"], maintain_order=True)
+        .with_columns([
+            (pl.col("post_buffer_pressure").shift(1) - pl.col("pre_buffer_pressure")).over("customer_id").alias("pressure_drop"),
+            (pl.col("arrival").diff().dt.total_milliseconds() / 3_600_000).over("customer_id").alias("hours"),
+        ])
+        .group_by("customer_id", maintain_order=True)
+        .agg([
+            pl.col("arrival").last().alias("last_arrival"),
+            pl.col("post_buffer_pressure").last().alias("last_pressure"),
+            recent(pl.col("pressure_drop")).len().alias("intervals"),
+            recent(pl.col("pressure_drop")).sum().alias("pressure_drop_sum"),
+            recent(pl.col("hours")).sum().alias("hours_sum"),
+            recent(pl.col("pressure_drop") / pl.col("hours")).quantile(rate_quantile).alias("rate_high"),
+        ])
+        .join(customer, on="customer_id", how="left")
+        .with_columns([
+            pl.when(enough & (pl.col("hours_sum") > 0)).then(rate).alias("rate"),
+            pl.when(enough).then(pl.col("rate_high")).alias("rate_high"),
+        ])
+        .with_columns([
+            (pl.col("rate") * 24 * pl.col("liter_weight_capacity") / 4 / 200).alias("volume_per_day"),
+            hours_after("last_arrival", remaining / positive("rate")).alias("refill_at"),
+            hours_after("last_arrival", remaining / positive("rate_high")).alias("earliest_refill_at"),
+        ])
+        .with_columns([
+            pl.col(column).dt.strftime(db.timestamp_format) for column in ("last_arrival", "refill_at", "earliest_refill_at")
+        ])
+        .select(BUFFER_FORECAST_COLUMNS)
+    )
+
+
+def write_forecasts(db_file, frame, customer_ids=None):
+    """
+    Replaces the buffer_forecast rows of customer_ids, or all of them, in one transaction,
+    then passes the customers on to the write listeners as a buffer_forecast write, so the
+    results cached from the table (see dispatch.py) are invalidated.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        if customer_ids is None:
+            conn.execute("DELETE FROM buffer_forecast")
+        else:
+            conn.execute(
+                "DELETE FROM buffer_forecast WHERE customer_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(customer_ids)),),
+            )
+        conn.executemany(
+            f"INSERT INTO buffer_forecast ({', '.join(BUFFER_FORECAST_COLUMNS)}) VALUES ({', '.join('?' for _ in BUFFER_FORECAST_COLUMNS)})",
+            frame.rows(),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    written = frame["customer_id"].to_list() if customer_ids is None else customer_ids
+    db.notify_write(db_file, "buffer_forecast", [{"customer_id": customer_id} for customer_id in written])
+
+
+def build_forecasts(db_file):
+    frame = forecast_plan(db_file).collect()
+    write_forecasts(db_file, frame)
+    logger.info("buffer forecasts built", extra={"db_file": db_file, "customers": frame.height})
+
+
+def refresh_forecasts(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) recomputing the forecasts of the customers
+    touched by a delivery or customer write.
+    """
+
+    if db_file not in enabled_databases or table_name not in ("delivery", "customer"):
+        return
+
+    customer_ids = sorted({row["customer_id"] for row in rows if row.get("customer_id") is not None})
+    if not customer_ids:
+        return
+
+    write_forecasts(db_file, forecast_plan(db_file, customer_ids).collect(), customer_ids)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def forecasts(db_file, as_of=None, customer_ids=None):
+    """
+    Reads the forecasts, projected to as_of.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        as_of (datetime.datetime): The time to project the pressures to, now when None.
+        customer_ids (list): Optional customers to read, all when None.
+
+    Returns:
+        pl.DataFrame: BUFFER_FORECAST_COLUMNS with timestamps as datetimes, plus pressure (the
+                      estimated pressure at as_of, floored at 0) and hours_left (until refill_at,
+                      negative when overdue), soonest refill first, customers without a
+                      forecast last.
+    """
+
+    where  = "" if customer_ids is None else "WHERE customer_id IN (SELECT value FROM json_each(?))"
+    params = () if customer_ids is None else (json.dumps(list(customer_ids)),)
+    rows   = db.query_table(db_file, f"SELECT {', '.join(BUFFER_FORECAST_COLUMNS)} FROM buffer_forecast {where}", params)
+
+    schema = {column: pl.Float64 for column in BUFFER_FORECAST_COLUMNS}
+    schema.update({"customer_id": pl.Utf8, "intervals": pl.Int64})
+    schema.update({column: pl.Utf8 for column in ("last_arrival", "refill_at", "earliest_refill_at")})
+    as_of  = as_of or datetime.datetime.now()
+
+    def hours_until(column):
+        return (pl.col(column) - pl.lit(as_of)).dt.total_milliseconds() / 3_600_000
+
+    return (pl.DataFrame(rows, schema=schema, orient="row")
+        .with_columns([
+            pl.col(column).str.to_datetime(db.timestamp_format) for column in ("last_arrival", "refill_at", "earliest_refill_at")
+        ])
+        .with_columns([
+            (pl.col("last_pressure") + pl.col("rate") * hours_until("last_arrival")).clip(lower_bound=0).alias("pressure"),
+            hours_until("refill_at").alias("hours_left"),
+        ])
+        .sort("refill_at", nulls_last=True)
+    )
+
+
+def enable(db_file, rebuild=True):
+    """
+    Keeps the buffer_forecast table of db_file up to date after writes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        rebuild (bool): Recompute every forecast first, needed when writes reached the
+                        database without this module listening.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        conn.execute(BUFFER_FORECAST_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if rebuild:
+        build_forecasts(db_file)
+
+    enabled_databases.add(db_file)
+    if refresh_forecasts not in db.write_listeners:
+        db.write_listeners.append(refresh_forecasts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python buffer_forecast.py", description="Forecasts when customer buffers need a refill.")
+    parser.add_argument("--days", type=float, default=None, help="only the customers due within that many days")
+    parser.add_argument("--as-of", default=None, help=f"projection time, {db.timestamp_format}, now by default")
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    enable(args.db)
+    as_of = datetime.datetime.strptime(args.as_of, db.timestamp_format) if args.as_of else None
+    frame = forecasts(args.db, as_of)
+    if args.days is not None:
+        frame = frame.filter(pl.col("hours_left") <= args.days * 24)
+
+    columns = ["customer_id", "last_arrival", "pressure", "rate", "volume_per_day", "refill_at", "earliest_refill_at", "hours_left"]
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(frame.select(columns))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
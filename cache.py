@@ -0,0 +1,192 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import functools
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Result cache shared by every worker process, kept in a local SQLite file.
+#
+# Every table has a version number, bumped by a write listener after each committed write.
+# An entry records the versions of the tables its result was computed from and is only
+# served while they are unchanged, so a write in one worker invalidates the results of all.
+#
+#   GMERCHANT_CACHE_FILE    the cache database, "cache.db" by default
+cache_file          = os.environ.get("GMERCHANT_CACHE_FILE", "cache.db")
+max_entries         = 2_000
+
+CACHE_SCHEMA        = (
+    "CREATE TABLE IF NOT EXISTS versions (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, stamp TEXT NOT NULL, value BLOB NOT NULL, created REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS entries_created ON entries (created)",
+)
+
+# the database whose results are cached, None while the cache is disabled
+enabled_db_file     = None
+
+logger              = logs.get_logger("cache")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def connect(check_same_thread=True):
+    # the default 5 s busy timeout covers a worker writing while another one reads
+    return sqlite3.connect(cache_file, timeout=5, check_same_thread=check_same_thread)
+
+
+def table_stamp(conn, tables):
+    """
+    Returns the current versions of tables as a string like "customer=3,delivery=12".
+    """
+    placeholders = ", ".join("?" for _ in tables)
+    versions     = dict(conn.execute(
+        f"SELECT table_name, version FROM versions WHERE table_name IN ({placeholders})", tables
+    ).fetchall())
+    return ",".join(f"{table}={versions.get(table, 0)}" for table in tables)
+
+
+def bump_versions(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) invalidating every entry computed from table_name.
+    """
+    if db_file != enabled_db_file:
+        return
+
+    conn = connect()
+    try:
+        conn.execute(
+            "INSERT INTO versions VALUES (?, 1) ON CONFLICT(table_name) DO UPDATE SET version = version + 1",
+            (table_name,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def entry_key(fn, args, kwargs):
+    text = f"{fn.__module__}.{fn.__qualname__}:{args!r}:{sorted(kwargs.items())!r}"
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def load(key, tables):
+    """
+    Returns (hit, value, stamp): the cached value when its stamp matches the current
+    table versions, and the current stamp to store a fresh value under.
+    """
+    conn = connect()
+    try:
+        stamp = table_stamp(conn, tables)
+        row   = conn.execute("SELECT stamp, value FROM entries WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+
+    if row is None or row[0] != stamp:
+        return False, None, stamp
+    return True, pickle.loads(row[1]), stamp
+
+
+def store(key, stamp, value):
+    conn = connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+            (key, stamp, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time()),
+        )
+        conn.execute(
+            "DELETE FROM entries WHERE created < (SELECT created FROM entries ORDER BY created DESC LIMIT 1 OFFSET ?)",
+            (max_entries,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def cached(*tables):
+    """
+    Decorator serving the results of fn from the shared cache while the given tables are unchanged.
+
+    The results are cached for the enabled database only: fn is called directly when the
+    cache is disabled, or when its db_file argument, if it takes one, names another database.
+    Arguments and results must be picklable, every hit returns a fresh copy.
+
+    Args:
+        tables (str): The tables the result of fn is computed from.
+    """
+
+    tables = tuple(sorted(tables))
+
+    def decorate(fn):
+        parameters    = list(inspect.signature(fn).parameters)
+        db_file_index = parameters.index("db_file") if "db_file" in parameters else None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if enabled_db_file is None:
+                return fn(*args, **kwargs)
+
+            if db_file_index is not None:
+                db_file = args[db_file_index] if len(args) > db_file_index else kwargs.get("db_file")
+                if db_file != enabled_db_file:
+                    return fn(*args, **kwargs)
+
+            key = entry_key(fn, args, kwargs)
+            try:
+                hit, value, stamp = load(key, tables)
+            except (sqlite3.Error, pickle.UnpicklingError):
+                logger.exception("cache lookup failed", extra={"call": fn.__name__})
+                return fn(*args, **kwargs)
+            if hit:
+                return value
+
+            value = fn(*args, **kwargs)
+            try:
+                store(key, stamp, value)
+            except (sqlite3.Error, pickle.PicklingError):
+                logger.exception("cache store failed", extra={"call": fn.__name__})
+            return value
+
+        return wrapper
+
+    return decorate
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def enable(db_file, clear=True):
+    """
+    Caches the results computed from db_file and invalidates them after writes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        clear (bool): Drop the entries of an earlier run, which may predate writes made while
+                      no cache was listening. Call it once, before the workers start.
+    """
+
+    global enabled_db_file
+
+    import database as db
+
+    conn = connect()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in CACHE_SCHEMA:
+            conn.execute(statement)
+        if clear:
+            conn.execute("DELETE FROM entries")
+        conn.commit()
+    finally:
+        conn.close()
+
+    enabled_db_file = db_file
+    if bump_versions not in db.write_listeners:
+        db.write_listeners.append(bump_versions)
+
+    logger.info("result cache enabled", extra={"db_file": db_file, "cache_file": cache_file})
+
+
+def disable():
+    global enabled_db_file
+    enabled_db_file = None
@@ -1,6 +1,9 @@
 import database as db
+import logs
 database_file   = 'operation.db'
 
+logs.configure()
+
 # -----------------------------------------------------------------------------------------
 # create tables
 # -----------------------------------------------------------------------------------------
@@ -8,3 +11,4 @@ database_file   = 'operation.db'
 db.remove_all_tables()
 for table_name in db.db_table_columns:
     db.create_table_with_list(database_file, table_name, db.db_table_columns[table_name])
+    db.create_key_index(database_file, table_name)
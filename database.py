@@ -1,17 +1,22 @@
 import sqlite3
-import pandas as pd
 import polars as pl
-import numpy as np
+from polars.io.plugins import register_io_source
 import json
-from collections import defaultdict
 import datetime
 import re
 import os
-import yaml
+import time
+import threading
 from io import StringIO # Import StringIO
-import utils
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+import report_parser
+import metrics
+import profiler
+import cache
+import gas_correction
+import logs
+
+# pandas, PyYAML and Plotly are imported by the functions using them, so importing
+# this module (and every gunicorn worker boot) only pays for SQLite and Polars
 
 
 
@@ -20,14 +25,11 @@ pl.Config.set_float_precision(2)
 strptime            = datetime.datetime.strptime
 
 
-# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-# Define constants outside of expressions
-P_ATM               = 1.01325
-CPF                 = 0.0002
-
 # WARNING: database needs to be manually initialized
 database_file     = "operation.db"
 
+logger            = logs.get_logger("database")
+
 table_names       = [
     "delivery",
     "customer",
@@ -71,6 +73,25 @@ db_table_columns = {
 }
 
 
+# Natural key of every table, used for duplicate checks and key indexes
+db_table_keys = {
+    "delivery"   : "delivery_id",
+    "customer"   : "customer_id",
+    "restock"    : "restock_id",
+}
+
+
+# Numeric fields of a delivery report, validated before insertion
+delivery_numeric_columns = [
+    "pre_buffer_pressure",
+    "delivery_stand_meter",
+    "delivery_pressure",
+    "delivery_temperature",
+    "post_buffer_pressure",
+    "transport_bank_pressure",
+]
+
+
 # Map from English day names to Indonesian day names
 day_name_map = {
     "Monday"    : "Senin",
@@ -82,6 +103,74 @@ day_name_map = {
     "Sunday"    : "Minggu"
 }
 
+# Map from ISO weekday numbers (Monday = 1) to Indonesian day names
+weekday_name_map = {
+    1 : "Senin",
+    2 : "Selasa",
+    3 : "Rabu",
+    4 : "Kamis",
+    5 : "Jumat",
+    6 : "Sabtu",
+    7 : "Minggu"
+}
+
+
+# Storage formats, timestamps and dates are written once in these layouts
+timestamp_format    = "%Y-%m-%d %H:%M:%S"
+date_format         = "%Y-%m-%d"
+
+
+# Extension points for derived stores (see snapshot.py):
+# write_listeners are called as listener(db_file, table_name, rows) after every committed write,
+# rows holding the written rows and, after an upsert or a delete, the stored rows they replaced
+# (see stored_rows): a row moved to another date, customer or transport leaves its old partition,
+# day or customer stale otherwise. Listeners take the keys of the rows and re-read the table.
+# analytics_sources map a db_file to source(table_name, equals) returning a LazyFrame or None.
+write_listeners     = []
+analytics_sources   = {}
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def connect(db_file, **kwargs):
+    """
+    Opens a SQLite connection, kwargs are passed to sqlite3.connect. Statements run
+    through it are timed by metrics.py.
+    """
+    if metrics.enabled:
+        return sqlite3.connect(db_file, factory=metrics.InstrumentedConnection, **kwargs)
+    return sqlite3.connect(db_file, **kwargs)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Vectorized column expressions shared by the ingest and analytics paths
+def delivery_id_expr(customer_id="customer_id", arrival="arrival"):
+    """
+    Builds delivery_id as customer_id followed by the arrival datetime as YYYYMMDDHHMM.
+    """
+    return pl.col(customer_id) + pl.col(arrival).dt.strftime("%Y%m%d%H%M")
+
+
+def restock_id_expr(plate_number="transport_plate_number", date="restock_date"):
+    """
+    Builds restock_id as the plate number without blanks or colons followed by the date as YYYYMMDD.
+    """
+    return pl.col(plate_number).str.replace_all(r"[\s:]", "") + pl.col(date).dt.strftime("%Y%m%d")
+
+
+def stored_date_expr(column):
+    """
+    Parses a stored date column. Reads both ISO dates and the older "YYYY-MM-DD HH:MM:SS" layout.
+    """
+    return pl.col(column).str.slice(0, 10).str.to_date(date_format)
+
+
+def weekday_name_expr(date="date"):
+    """
+    Maps a date or datetime column to Indonesian day names.
+    """
+    return pl.col(date).dt.weekday().replace_strict(weekday_name_map, return_dtype=pl.Utf8)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 def create_table_with_schema(db_file, table_name, schema):
     """
@@ -92,7 +181,7 @@ def create_table_with_schema(db_file, table_name, schema):
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # Construct the CREATE TABLE statement
@@ -106,10 +195,10 @@ def create_table_with_schema(db_file, table_name, schema):
         # Execute the CREATE TABLE statement
         cursor.execute(create_table_sql)
         conn.commit()
-        print(f"Table {table_name} created successfully in '{db_file}'.")
+        logger.debug("table created", extra={"table": table_name, "db_file": db_file})
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
     finally:
         if conn:
             conn.close()
@@ -126,7 +215,7 @@ def create_table_with_list(db_file, table_name, columns):
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # Construct the CREATE TABLE statement
@@ -140,10 +229,72 @@ def create_table_with_list(db_file, table_name, columns):
         # Execute the CREATE TABLE statement
         cursor.execute(create_table_sql)
         conn.commit()
-        print(f"Table {table_name} created successfully in '{db_file}'.")
+        logger.debug("table created", extra={"table": table_name, "db_file": db_file})
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
+    finally:
+        if conn:
+            conn.close()
+
+
+def create_key_index(db_file, table_name, deduplicate=False):
+    """
+    Creates a unique index on the natural key of a table (see db_table_keys).
+    Falls back to a plain index when the table already holds duplicate keys,
+    unless deduplicate is set, in which case only the latest row of every key is kept
+    and the removed rows are passed to the write listeners: call it once they are enabled.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The name of the table to index.
+        deduplicate (bool): Remove older rows sharing a key before indexing.
+
+    Returns:
+        bool: True if the table ends up with a unique key index.
+    """
+
+    key_column = db_table_keys[table_name]
+    index_name = f"idx_{table_name}_{key_column}"
+    conn       = None
+
+    try:
+        conn   = connect(db_file)
+        cursor = conn.cursor()
+
+        # PRAGMA index_list rows are (seq, name, unique, origin, partial)
+        cursor.execute(f"PRAGMA index_list({table_name})")
+        indexes = {row[1]: bool(row[2]) for row in cursor.fetchall()}
+        if indexes.get(index_name):
+            return True
+
+        removed = []
+        if deduplicate:
+            columns = db_table_columns[table_name]
+            older   = f"rowid NOT IN (SELECT MAX(rowid) FROM {table_name} GROUP BY {key_column})"
+            removed = [dict(zip(columns, row)) for row in cursor.execute(f"SELECT {', '.join(columns)} FROM {table_name} WHERE {older}")]
+            cursor.execute(f"DELETE FROM {table_name} WHERE {older}")
+            if removed:
+                logger.warning("duplicate key rows removed", extra={"table": table_name, "key": key_column, "rows": len(removed)})
+            cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+        try:
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name} ({key_column})")
+            unique = True
+        except sqlite3.IntegrityError:
+            logger.warning("duplicate keys, creating non-unique index", extra={"table": table_name, "key": key_column})
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({key_column})")
+            unique = False
+        conn.commit()
+
+        # the derived stores drop the removed rows like those of any other write
+        if removed:
+            notify_write(db_file, table_name, removed)
+        return unique
+
+    except sqlite3.Error as e:
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
+        return False
     finally:
         if conn:
             conn.close()
@@ -162,7 +313,7 @@ def list_tables(db_file='operation.db'):
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # SQL query to retrieve table names
@@ -174,20 +325,89 @@ def list_tables(db_file='operation.db'):
         return tables
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"db_file": db_file, "error": str(e)})
         return []  # Return an empty list in case of an error
     finally:
         if conn:
             conn.close()
 
 
+def enable_wal(db_file):
+    """
+    Switches db_file to write-ahead logging, which persists in the file: readers are no longer
+    blocked by a writer, and a commit appends to the log instead of rewriting pages.
+    """
+    conn = connect(db_file)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+
+
+def insert_sql(table_name, keys):
+    """
+    Returns the parameterized INSERT statement of a row holding the columns keys.
+    """
+    return f"""
+        INSERT INTO {table_name} ({", ".join(keys)})
+        VALUES ({", ".join("?" * len(keys))})
+    """
+
+
+def upsert_sql(table_name, keys):
+    """
+    Returns the parameterized INSERT of a row holding the columns keys, updating the
+    row with the same table key (see db_table_keys) instead. Needs create_key_index.
+    """
+    key_column = db_table_keys[table_name]
+    updates    = ", ".join(f"{key} = excluded.{key}" for key in keys if key != key_column)
+    return f"""
+        INSERT INTO {table_name} ({", ".join(keys)})
+        VALUES ({", ".join("?" * len(keys))})
+        ON CONFLICT ({key_column}) DO UPDATE SET {updates}
+    """
+
+
+def stored_rows(conn, table_name, rows):
+    """
+    Reads the stored rows sharing a table key (see db_table_keys) with rows, within the
+    caller's transaction: the pre-image of an upsert, passed on to the write listeners.
+
+    Returns:
+        list: The stored rows as dictionaries of the db_table_columns.
+    """
+    key_column = db_table_keys[table_name]
+    keys       = [row[key_column] for row in rows if row.get(key_column) is not None]
+    if not keys:
+        return []
+
+    columns = db_table_columns[table_name]
+    cursor  = conn.execute(
+        f"SELECT {', '.join(columns)} FROM {table_name} WHERE {key_column} IN (SELECT value FROM json_each(?))",
+        (json.dumps(keys),),
+    )
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def notify_write(db_file, table_name, rows):
+    """
+    Passes committed rows to every registered write listener. A failing listener
+    is reported but never undoes or blocks the write.
+    """
+    for listener in write_listeners:
+        try:
+            listener(db_file, table_name, rows)
+        except Exception:
+            logger.exception("write listener failed", extra={"listener": listener.__name__, "table": table_name})
+
+
 def insert_row_from_dict(db_file, table_name, data_dict):
     """
     Inserts a row into a SQLite table using data from a dictionary.
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # Extract column names and values from the dictionary
@@ -204,22 +424,117 @@ def insert_row_from_dict(db_file, table_name, data_dict):
         # Execute the INSERT statement using a parameterized query
         cursor.execute(sql, values)
         conn.commit()
-        print("Row inserted successfully.")
+        logger.debug("row inserted", extra={"table": table_name})
+        notify_write(db_file, table_name, [data_dict])
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
+    finally:
+        if conn:
+            conn.close()
+
+
+@profiler.profiled
+def insert_rows_from_dicts(db_file, table_name, rows):
+    """
+    Inserts many rows into a SQLite table in a single transaction.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The name of the table to insert into.
+        rows (list): A list of dictionaries sharing the same keys.
+
+    Returns:
+        int: The number of inserted rows, 0 if the transaction was rolled back.
+    """
+
+    if not rows:
+        return 0
+
+    conn = None
+    try:
+        conn    = connect(db_file)
+        keys    = list(rows[0].keys())
+        values  = [tuple(row[key] for key in keys) for row in rows]
+        sql     = insert_sql(table_name, keys)
+
+        # the connection context manager commits once, or rolls back everything on error
+        with conn:
+            conn.executemany(sql, values)
+        logger.info("rows inserted", extra={"table": table_name, "rows": len(values)})
+        notify_write(db_file, table_name, rows)
+        return len(values)
+
+    except sqlite3.Error as e:
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+
+
+@profiler.profiled
+def upsert_rows_from_dicts(db_file, table_name, rows):
+    """
+    Inserts or updates many rows in a single transaction, using the table key
+    (see db_table_keys) as the conflict target. Re-running the same batch is a no-op.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The name of the table to write to.
+        rows (list): A list of dictionaries sharing the same keys, including the table key.
+
+    Returns:
+        dict: {"rows", "seconds", "rows_per_second"}, rows is 0 if the transaction was rolled back.
+    """
+
+    result = {"rows": 0, "seconds": 0.0, "rows_per_second": 0.0}
+    if not rows:
+        return result
+
+    # ON CONFLICT needs a unique index on the key column
+    if not create_key_index(db_file, table_name, deduplicate=True):
+        return result
+
+    conn        = None
+    try:
+        start   = time.perf_counter()
+        conn    = connect(db_file)
+        keys    = list(rows[0].keys())
+        values  = [tuple(row[key] for key in keys) for row in rows]
+        sql     = upsert_sql(table_name, keys)
+
+        with conn:
+            previous = stored_rows(conn, table_name, rows)
+            conn.executemany(sql, values)
+
+        seconds = time.perf_counter() - start
+        result  = {
+            "rows"            : len(values),
+            "seconds"         : seconds,
+            "rows_per_second" : len(values) / seconds if seconds > 0 else float(len(values)),
+        }
+        logger.info("rows upserted", extra={"table": table_name, "rows": len(values), "seconds": round(seconds, 4)})
+        notify_write(db_file, table_name, rows + previous)
+        return result
+
+    except sqlite3.Error as e:
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
+        return result
     finally:
         if conn:
             conn.close()
 
  
+@profiler.profiled
 def query_table(db_file, query, params=()):
     """
     Queries a SQLite table and returns the results as a list of tuples.
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         cursor.execute(query, params)  # Execute the query with parameters
@@ -229,16 +544,19 @@ def query_table(db_file, query, params=()):
         return results
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"query": query, "error": str(e)})
         return []  # Return an empty list in case of an error
     finally:
         if conn:
             conn.close()
 
 
+@profiler.profiled
 def query_table_as_pandas(db_file, query, params=()):
+    import pandas as pd
+
     try:
-        conn   = sqlite3.connect(db_file)
+        conn   = connect(db_file)
         cursor = conn.cursor()
         cursor.execute(query, params)  # Execute the query with parameters
 
@@ -249,7 +567,7 @@ def query_table_as_pandas(db_file, query, params=()):
         return df
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"query": query, "error": str(e)})
         return []  # Return an empty list in case of an error
     finally:
         if conn:
@@ -257,74 +575,14 @@ def query_table_as_pandas(db_file, query, params=()):
 
 
 def parse_svarga_format(text):
-    lines = text.strip().split('\n')
-    
-    # Initialize the dictionary
-    data = defaultdict(str)
-    
-    # Initialize section tracking
-    current_section = None
-    
-    for line in lines:
-        line = line.strip()
-        
-        # Skip format header and separator lines
-        if line.startswith('FORMAT SVARGA') or line.startswith('====='):
-            current_section = None
-            continue
-        
-        # Check if line contains a colon for key-value pairs
-        if ':' in line:
-            parts      = line.split(':', 1)
-            key        = parts[0].strip().strip('*')
-            value      = parts[1].strip()
-            ikey       = key.lower().strip() 
-            ivalue     = value.lower().strip()            
-
-            # Handle the top-level entries
-            if current_section is None:
-                data[ikey] = ivalue
-            else:
-                # Ensure the section exists in the dictionary
-                if current_section not in data:
-                    data[current_section] = defaultdict(str)
-                
-                data[current_section][ikey] = ivalue
-        
-        # Lines without colons could be section headers
-        elif line and not line.startswith('*') and not ':' in line:
-            current_section = line.lower().strip()
-    
-    return data
+    return report_parser.parse_svarga_block(text)
 
 
 def parse_delivery_report(text):
-    # Split the text by newlines and remove any empty lines
-    lines = [line for line in text.strip().split('\n') if line]
-    
-    result = {}
-    
-    # Process the lines in pairs
-    for i in range(0, len(lines), 2):
-        if i + 1 < len(lines):
-            column_name = lines[i].strip()
-            value = lines[i + 1].strip()
-            
-            # Convert value to appropriate type if possible
-            if value.lower() == 'null':
-                value = None
-            # elif value.replace('.', '', 1).isdigit():  # Check if it's a numeric value
-            #     # Convert to float or int as appropriate
-            #     if '.' in value:
-            #         value = float(value)
-            #     else:
-            #         value = int(value)
-                    
-            result[column_name] = str(value)
-            
-    return result    
+    return report_parser.parse_raw_report(text)
 
 
+@profiler.profiled
 def check_delivery_id_existence(delivery_id):
     res = True
     query       = "select distinct delivery_id from delivery;"
@@ -333,31 +591,20 @@ def check_delivery_id_existence(delivery_id):
     for s in sf:
         rf.append(s[0])
 
-    print(delivery_id, rf)
-    if delivery_id in rf:
-        print("delivery id in id_list")
-        res = True
-    else:
-        print("delivery id NOT in id_list")
-        res = False
+    res = delivery_id in rf
+    logger.debug("delivery id lookup", extra={"delivery_id": delivery_id, "found": res, "stored_ids": len(rf)})
     return res
 
 
 def generate_delivery_rowrep(text):
-    parsed         = parse_delivery_report(text)
-    injection_date = str(parsed["delivery_date"]).lower()
-    arrival_time   = str(parsed["delivery_arrival_time"])
-    customer_id    = str(parsed["customer_id"])
-
-    # Convert injection_date (DD/MM/YY) to datetime object
-    injection_date_datetime = datetime.datetime.strptime(injection_date, '%d-%b-%y')
+    record, errors = report_parser.parse_report(text, report_parser.delivery_report_fields)
+    if errors:
+        raise ValueError(", ".join(errors.values()))
 
-    # Convert arrival_time (HH.MM) to datetime object with injection_date
-    arrival_time_time  = datetime.datetime.strptime(arrival_time, "%H:%M").time()  # Extract the time
-    arrival_datetime   = datetime.datetime.combine(injection_date_datetime.date(), arrival_time_time) # Combine with the correct date
-    arrival_time_iso   = arrival_datetime.strftime("%Y-%m-%d %H:%M:%S")
-    injection_date_iso = injection_date_datetime.strftime("%Y-%m-%d") # Format injection date to iso    
-    delivery_report_id = customer_id + re.sub(r"[\-\s:]", "", arrival_time_iso)[:-2]
+    customer_id        = record["customer_id"]
+    arrival_datetime   = datetime.datetime.combine(record["delivery_date"], record["delivery_arrival_time"])
+    arrival_time_iso   = arrival_datetime.strftime(timestamp_format)
+    delivery_report_id = customer_id + arrival_datetime.strftime("%Y%m%d%H%M")
 
     if check_delivery_id_existence(delivery_report_id):
         return None
@@ -365,69 +612,223 @@ def generate_delivery_rowrep(text):
     rowrep = {
         "delivery_id"               : delivery_report_id,
         "customer_id"               : customer_id,
-        "delivery_route"            : parsed["delivery_route"],	
-        "transport_plate_number"    : parsed["transport_plate_number"],	 
+        "delivery_route"            : record["delivery_route"],
+        "transport_plate_number"    : record["transport_plate_number"],
         "arrival_timestamp"         : arrival_time_iso,
-        "pre_buffer_pressure"       : parsed["pre_buffer_pressure"], 	
-        "delivery_stand_meter"      : parsed["delivery_stand_meter"],
-        "delivery_pressure"         : parsed["delivery_pressure"],
-        "delivery_temperature"      : parsed["delivery_temperature"], 	
-        "post_buffer_pressure"      : parsed["post_buffer_pressure"], 	
-        "transport_bank_pressure"   : parsed["transport_bank_pressure"],
+        "pre_buffer_pressure"       : record["pre_buffer_pressure"],
+        "delivery_stand_meter"      : record["delivery_stand_meter"],
+        "delivery_pressure"         : record["delivery_pressure"],
+        "delivery_temperature"      : record["delivery_temperature"],
+        "post_buffer_pressure"      : record["post_buffer_pressure"],
+        "transport_bank_pressure"   : record["transport_bank_pressure"],
     }
 
     return rowrep
 
 
+def count_reports(text):
+    """
+    Returns the number of key/value reports in a pasted block, see report_parser.split_raw_reports.
+    """
+    return len(report_parser.split_raw_reports(text))
 
-def parse_restock_report(text):
-    # Split the text by newlines and remove any empty lines
-    lines = [line for line in text.strip().split('\n') if line]
-    
-    result = {}
-    
-    # Process the lines in pairs
-    for i in range(0, len(lines), 2):
-        if i + 1 < len(lines):
-            column_name = lines[i].strip()
-            value = lines[i + 1].strip()
-            
-            # Convert value to appropriate type if possible
-            if value.lower() == 'null':
-                value = None
-            # elif value.replace('.', '', 1).isdigit():  # Check if it's a numeric value
-            #     # Convert to float or int as appropriate
-            #     if '.' in value:
-            #         value = float(value)
-            #     else:
-            #         value = int(value)
-                    
-            result[column_name] = str(value)
-            
-    return result    
 
+def report_block_to_frame(text, fields):
+    """
+    Parses a block of reports into a typed Polars DataFrame with one row per report.
+
+    Args:
+        text (str | list): One or many reports, or their raw reports as returned by
+                           report_parser.split_raw_reports.
+        fields (dict): A field table of report_parser, its converters set the column dtypes.
+
+    Returns:
+        pl.DataFrame: The typed fields, a 1-based "report" number and the first parse
+                      error of every report in "reason" (null when the report parsed cleanly).
+    """
+
+    raws            = report_parser.split_raw_reports(text) if isinstance(text, str) else text
+    records, errors = report_parser.convert_reports(raws, fields)
+    dtypes          = {
+        report_parser.to_text        : pl.Utf8,
+        report_parser.to_float       : pl.Float64,
+        report_parser.to_report_date : pl.Date,
+        report_parser.to_iso_date    : pl.Date,
+        report_parser.to_clock_time  : pl.Time,
+    }
+    schema          = {name: dtypes[converter] for name, (converter, nullable) in fields.items()}
+
+    df = pl.DataFrame(records, schema=schema)
+    df = df.with_columns(
+        pl.Series("reason", [next(iter(error.values()), None) for error in errors], dtype=pl.Utf8)
+    ).with_row_index("report", offset=1)
+
+    return df
+
+
+@profiler.profiled
+def check_delivery_ids_existence(delivery_ids):
+    """
+    Returns the subset of delivery_ids already stored, using a single indexed query.
+    """
+    delivery_ids = [delivery_id for delivery_id in delivery_ids if delivery_id]
+    if not delivery_ids:
+        return set()
+
+    query   = "SELECT delivery_id FROM delivery WHERE delivery_id IN (SELECT value FROM json_each(?));"
+    rows    = query_table(database_file, query, (json.dumps(delivery_ids),))
+    return {row[0] for row in rows}
+
+
+@profiler.profiled
+def generate_delivery_rowreps(text):
+    """
+    Parses a block of delivery reports and validates all of them in one vectorized pass.
+
+    Args:
+        text (str | list): One or many delivery reports, or their raw reports as returned by
+                           report_parser.split_raw_reports.
+
+    Returns:
+        tuple: (rowreps, summary). rowreps holds the accepted rows ready for insertion,
+               summary holds one {"report", "delivery_id", "status", "reason"} dictionary
+               per report, in input order.
+    """
+
+    df = report_block_to_frame(text, report_parser.delivery_report_fields)
+    if df.is_empty():
+        return [], []
+
+    arrival_expr = pl.col("delivery_date").dt.combine(pl.col("delivery_arrival_time"))
+
+    df = df.with_columns(arrival_expr.alias("arrival")).with_columns([
+        pl.col("arrival").dt.strftime(timestamp_format).alias("arrival_timestamp"),
+        delivery_id_expr().alias("delivery_id"),
+    ])
+
+    existing_ids = check_delivery_ids_existence(df["delivery_id"].to_list())
+
+    # repeated ids within the batch only count among otherwise valid reports
+    valid_expr = pl.col("reason").is_null()
+    df = df.with_columns(
+        pl.when(valid_expr & pl.col("delivery_id").is_in(list(existing_ids)))
+        .then(pl.lit("duplicate delivery_id"))
+        .otherwise(pl.col("reason"))
+        .alias("reason")
+    ).with_columns(
+        pl.when(valid_expr & ~pl.col("delivery_id").is_first_distinct().over(valid_expr))
+        .then(pl.lit("duplicate delivery_id in batch"))
+        .otherwise(pl.col("reason"))
+        .alias("reason")
+    ).with_columns(
+        pl.when(valid_expr).then(pl.lit("accepted")).otherwise(pl.lit("rejected")).alias("status")
+    )
+
+    rowreps = (df
+        .filter(pl.col("status") == "accepted")
+        .select(db_table_columns["delivery"])
+        .to_dicts()
+    )
+    summary = df.select(["report", "delivery_id", "status", "reason"]).to_dicts()
+
+    return rowreps, summary
+
+
+def parse_restock_report(text):
+    return report_parser.parse_raw_report(text)
 
 
 def generate_restock_rowrep(text):
-    row             = parse_restock_report(text)
-    plate_number    = row["transport_plate_number"]
-    restock_date    = row["restock_date"]
-    restock_id      = re.sub(r"[\s:]", "", plate_number) + re.sub(r"[\-\s:]", "", restock_date)
-    restock_date    = datetime.datetime.strptime(restock_date, "%Y-%m-%d")
-    restock_volume  = float(row["restock_volume"])
+    record, errors = report_parser.parse_report(text, report_parser.restock_report_fields)
+    if errors:
+        raise ValueError(", ".join(errors.values()))
+
+    plate_number    = record["transport_plate_number"]
+    restock_date    = record["restock_date"]
+    restock_id      = re.sub(r"[\s:]", "", plate_number) + restock_date.strftime("%Y%m%d")
 
     rowrep = {
         "restock_id"              : restock_id,
         "transport_plate_number"  : plate_number,
-        "restock_date"            : restock_date,
-        "restock_volume"          : restock_volume,
-        "gas_station_address"     : row["spbg_address"]
+        "restock_date"            : restock_date.strftime(date_format),
+        "restock_volume"          : record["restock_volume"],
+        "gas_station_address"     : record["spbg_address"]
     }
 
 
     return rowrep
 
 
+def check_restock_ids_existence(restock_ids):
+    """
+    Returns the subset of restock_ids already stored, using a single indexed query.
+    """
+    restock_ids = [restock_id for restock_id in restock_ids if restock_id]
+    if not restock_ids:
+        return set()
+
+    query   = "SELECT restock_id FROM restock WHERE restock_id IN (SELECT value FROM json_each(?));"
+    rows    = query_table(database_file, query, (json.dumps(restock_ids),))
+    return {row[0] for row in rows}
+
+
+@profiler.profiled
+def generate_restock_rowreps(text):
+    """
+    Parses a block of restock reports and validates all of them in one vectorized pass.
+    Reports sharing a restock_id within the block resolve to the last one.
+
+    Args:
+        text (str | list): One or many restock reports, or their raw reports as returned by
+                           report_parser.split_raw_reports.
+
+    Returns:
+        tuple: (rowreps, summary). rowreps holds the rows ready for upsertion,
+               summary holds one {"report", "restock_id", "status", "reason"} dictionary
+               per report, in input order. status is "inserted", "updated", "superseded"
+               (by a later report of the block) or "rejected".
+    """
+
+    df = report_block_to_frame(text, report_parser.restock_report_fields)
+    if df.is_empty():
+        return [], []
+
+    df = df.with_columns([
+        restock_id_expr().alias("restock_id"),
+    ]).with_columns(
+        pl.when(pl.col("reason").is_null() & (pl.col("restock_volume") <= 0))
+        .then(pl.lit("invalid restock_volume"))
+        .otherwise(pl.col("reason"))
+        .alias("reason")
+    )
+
+    existing_ids = check_restock_ids_existence(df["restock_id"].to_list())
+
+    valid_expr  = pl.col("reason").is_null()
+    df = df.with_columns(
+        pl.when(~valid_expr).then(pl.lit("rejected"))
+        .when(~pl.col("restock_id").is_last_distinct().over(valid_expr)).then(pl.lit("superseded"))
+        .when(pl.col("restock_id").is_in(list(existing_ids))).then(pl.lit("updated"))
+        .otherwise(pl.lit("inserted"))
+        .alias("status")
+    )
+
+    rowreps = (df
+        .filter(pl.col("status").is_in(["inserted", "updated"]))
+        .select([
+            pl.col("restock_id"),
+            pl.col("transport_plate_number"),
+            pl.col("restock_date").dt.strftime(date_format),
+            pl.col("restock_volume"),
+            pl.col("spbg_address").alias("gas_station_address"),
+        ])
+        .to_dicts()
+    )
+    summary = df.select(["report", "restock_id", "status", "reason"]).to_dicts()
+
+    return rowreps, summary
+
+
 
 
 
@@ -442,6 +843,8 @@ def extract_time_only(df, datetime_column):
     Returns:
         pandas Series with only the time part
     """
+    import pandas as pd
+
     # Convert the strings to datetime objects first
     datetime_series = pd.to_datetime(df[datetime_column])
     
@@ -461,6 +864,8 @@ def get_formatted_delivery_df(df, colnames=None):
 
 
 def export_delivery_to_excel(df, filename, colnames=None):
+    import pandas as pd
+
     df['arrival_time']  = extract_time_only(df, 'arrival_time')
     df['finish_time']   = extract_time_only(df, 'finish_time')
     
@@ -518,7 +923,7 @@ def remove_table(db_file, table_name):
     """
 
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # Construct the DROP TABLE statement
@@ -527,10 +932,10 @@ def remove_table(db_file, table_name):
         # Execute the DROP TABLE statement
         cursor.execute(drop_table_sql)
         conn.commit()
-        print(f"Table {table_name} removed successfully from '{db_file}'.")
+        logger.info("table removed", extra={"table": table_name, "db_file": db_file})
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"table": table_name, "error": str(e)})
     finally:
         if conn:
             conn.close()
@@ -545,7 +950,7 @@ def remove_all_tables(db_file='operation.db'):
     """
 
     try:
-        conn    = sqlite3.connect(db_file)
+        conn    = connect(db_file)
         cursor  = conn.cursor()
 
         tablenames = list_tables(db_file)
@@ -556,38 +961,43 @@ def remove_all_tables(db_file='operation.db'):
 
         # Execute the DROP TABLE statement
         conn.commit()
-        print(f"All tables removed successfully from '{db_file}'.")
+        logger.info("all tables removed", extra={"db_file": db_file})
 
     except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+        logger.error("sqlite error", extra={"db_file": db_file, "error": str(e)})
     finally:
         if conn:
             conn.close()
 
 
 def json_to_dataframe(json_file_path):
+    import pandas as pd
+
     try:
         # Use pandas' built-in JSON reader. 
         # orient='records' is suitable for JSON structured as a list of dicts.
         df = pd.read_json(json_file_path, orient='records', dtype=str, convert_dates=False) 
 
-        print(f"Successfully loaded data from {json_file_path}")
+        logger.debug("json loaded", extra={"path": json_file_path})
         return df
 
     except FileNotFoundError:
-        print(f"Error: File not found at {json_file_path}")
+        logger.error("json file not found", extra={"path": json_file_path})
         return None
     except ValueError as e: 
         # This can catch errors if the JSON is malformed or if pandas has trouble parsing
-        print(f"Error: Could not parse JSON file {json_file_path}. Invalid JSON format or structure? Error: {e}")
+        logger.error("invalid json file", extra={"path": json_file_path, "error": str(e)})
         return None
-    except Exception as e: 
+    except Exception: 
         # Catch any other unexpected errors
-        print(f"An unexpected error occurred: {e}")
+        logger.exception("unexpected error")
         return None
 
 
 def yaml_to_dataframe_as_string(yaml_file_path):
+    import pandas as pd
+    import yaml
+
     try:
         # Read the YAML file
         with open(yaml_file_path, 'r') as file:
@@ -595,7 +1005,7 @@ def yaml_to_dataframe_as_string(yaml_file_path):
 
         # Check if the loaded data is a list of dictionaries
         if not isinstance(yaml_data, list):
-            print(f"Error: YAML file {yaml_file_path} does not contain a list of dictionaries.")
+            logger.error("yaml file is not a list of dictionaries", extra={"path": yaml_file_path})
             return None
 
         # Convert all values to strings within the YAML data
@@ -608,172 +1018,449 @@ def yaml_to_dataframe_as_string(yaml_file_path):
                     stringified_item[key] = sval if value is not None else None
                 stringified_data.append(stringified_item)
             else:
-                print(f"Warning: Skipping non-dictionary item: {item}")
+                logger.warning("skipping non-dictionary yaml item", extra={"path": yaml_file_path, "item": item})
 
         # Convert to JSON format for pandas to read. CRITICAL step!
         json_string = json.dumps(stringified_data) # Convert data directly to JSON.
         df = pd.read_json(StringIO(json_string), orient='records', dtype=str, convert_dates=False)  # Use StringIO for pandas
 
-        print(f"Successfully loaded data from {yaml_file_path} with all columns as strings.")
+        logger.debug("yaml loaded", extra={"path": yaml_file_path, "rows": len(df)})
         return df
 
     except FileNotFoundError:
-        print(f"Error: File not found at {yaml_file_path}")
+        logger.error("yaml file not found", extra={"path": yaml_file_path})
         return None
     except yaml.YAMLError as e:
-        print(f"Error: Could not parse YAML file {yaml_file_path}. Invalid YAML format? Error: {e}")
+        logger.error("invalid yaml file", extra={"path": yaml_file_path, "error": str(e)})
         return None
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+    except Exception:
+        logger.exception("unexpected error")
+        return None
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Customer dimension, held in memory per database and process, reloaded after customer writes.
+# Every lookup reads the customer version of the result cache (see cache.py), bumped by every
+# process after its customer writes only. While no cache listens to the writes of the database,
+# PRAGMA data_version stands in: it changes once any other connection has committed a write,
+# to any table. Both are read through connections kept open by the store.
+customer_float_columns  = ["liter_weight_capacity", "minimum_monthly_volume", "applied_price"]
+
+# db_file -> CustomerStore
+customer_stores         = {}
+customer_stores_lock    = threading.Lock()
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
         return None
 
 
+class Customer:
+    """
+    One customer row, with the capacity, minimum volume and price as floats (None when unset).
+    """
+    __slots__ = tuple(db_table_columns["customer"])
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, to_float(value) if name in customer_float_columns else value)
+
+    def __repr__(self):
+        return f"Customer({self.customer_id!r}, {self.customer_name!r})"
+
+
+class CustomerStore:
+    """
+    The customers of one database by customer_id, reloaded after committed writes.
+    """
+    def __init__(self, db_file):
+        self.db_file      = db_file
+        self.customers    = {}
+        self.conn         = None
+        self.cache_conn   = None
+        self.pid          = None
+        self.version      = None
+        self.lock         = threading.Lock()
+
+    def change_version(self):
+        """
+        Returns a value that changes after customer writes, see the comment above.
+        """
+        if cache.enabled_db_file != self.db_file:
+            return ("data_version", self.conn.execute("PRAGMA data_version").fetchone()[0])
+
+        if self.cache_conn is None:
+            self.cache_conn = cache.connect(check_same_thread=False)
+        return ("customer", cache.table_stamp(self.cache_conn, ("customer",)))
+
+    def current(self):
+        """
+        Returns {customer_id: Customer}, reloaded first when customers were written.
+        """
+        with self.lock:
+            # connections inherited from a forking parent process are not reused
+            if self.conn is None or self.pid != os.getpid():
+                self.conn         = connect(self.db_file, check_same_thread=False)
+                self.cache_conn   = None
+                self.pid          = os.getpid()
+                self.version      = None
+
+            try:
+                version = self.change_version()
+                if version != self.version:
+                    rows              = self.conn.execute(f"SELECT {', '.join(Customer.__slots__)} FROM customer").fetchall()
+                    self.customers    = {row[0]: Customer(row) for row in rows}
+                    self.version      = version
+                    logger.debug("customers loaded", extra={"db_file": self.db_file, "customers": len(self.customers)})
+            except sqlite3.Error as e:
+                logger.error("sqlite error", extra={"table": "customer", "db_file": self.db_file, "error": str(e)})
+
+            return self.customers
+
+
+def customer_store(db_file):
+    with customer_stores_lock:
+        store = customer_stores.get(db_file)
+        if store is None:
+            store = customer_stores[db_file] = CustomerStore(db_file)
+    return store
+
+
+def get_customer(db_file, customer_id):
+    """
+    Returns the Customer record of customer_id, None when it is unknown.
+    """
+    return customer_store(db_file).current().get(customer_id)
+
+
+def get_customers(db_file, customer_ids):
+    """
+    Looks up many customers at once.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_ids (iterable): The customers to look up.
+
+    Returns:
+        dict: {customer_id: Customer} of the known customers among customer_ids.
+    """
+    customers = customer_store(db_file).current()
+    return {customer_id: customers[customer_id] for customer_id in customer_ids if customer_id in customers}
+
+
+def get_customer_field(db_file, customer_id, field):
+    customer = get_customer(db_file, customer_id)
+    value    = getattr(customer, field) if customer is not None else None
+    if value is None:
+        logger.warning(f"no {field.replace('_', ' ')}", extra={"customer_id": customer_id})
+    return value
+
+
 def get_applied_price(db_file, customer_id):
     """
     Retrieves the applied price for a customer based on their customer_id.
     """
-    query = "SELECT applied_price FROM customer WHERE customer_id = ?"
-    try:
-        result = query_table(db_file, query, (customer_id,))
-        if result:
-            return float(result[0][0])  # Return the applied price as a float
-        else:
-            print(f"No applied price found for customer_id: {customer_id}")
-            return None
-    except Exception as e:
-        print(f"An error occurred while retrieving applied price: {e}")
-        return None
-    
+    return get_customer_field(db_file, customer_id, "applied_price")
+
 
 def get_minimum_monthly_volume(db_file, customer_id):
     """
     Retrieves the minimum monthly volume for a customer based on their customer_id.
     """
-    query = "SELECT minimum_monthly_volume FROM customer WHERE customer_id = ?"
-    try:
-        result = query_table(db_file, query, (customer_id,))
-        if result:
-            return float(result[0][0])  # Return the minimum monthly volume as a float
-        else:
-            print(f"No minimum monthly volume found for customer_id: {customer_id}")
-            return None
-    except Exception as e:
-        print(f"An error occurred while retrieving minimum monthly volume: {e}")
-        return None
-    
+    return get_customer_field(db_file, customer_id, "minimum_monthly_volume")
+
 
 def get_customer_name(db_file, customer_id):
     """
     Retrieves the customer name based on their customer_id.
     """
-    query = "SELECT customer_name FROM customer WHERE customer_id = ?"
-    try:
-        result = query_table(db_file, query, (customer_id,))
-        if result:
-            return result[0][0]  # Return the customer name
-        else:
-            print(f"No customer name found for customer_id: {customer_id}")
-            return None
-    except Exception as e:
-        print(f"An error occurred while retrieving customer name: {e}")
-        return None
-    
+    return get_customer_field(db_file, customer_id, "customer_name")
+
 
 def get_liter_weight_capacity(db_file, customer_id):
     """
     Retrieves the liter weight capacity for a customer based on their customer_id.
     """
-    query = "SELECT liter_weight_capacity FROM customer WHERE customer_id = ?"
+    return get_customer_field(db_file, customer_id, "liter_weight_capacity")
+
+
+def scan_table(db_file, table_name, where=None, params=(), batch_size=50_000):
+    """
+    Lazily scans a SQLite table as a Polars LazyFrame.
+
+    Projected columns are pushed into the SELECT and filters are applied to every
+    batch as rows stream from the cursor, so only the needed columns and rows are
+    ever materialized. where/params add an SQL-side filter for indexed lookups.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The table to scan, one of db_table_columns.
+        where (str): Optional SQL condition, e.g. "customer_id = ?".
+        params (tuple): Parameters of the where condition.
+        batch_size (int): Rows fetched per batch.
+
+    Returns:
+        pl.LazyFrame: All columns typed as strings, as stored.
+    """
+
+    schema = {col: pl.Utf8 for col in db_table_columns[table_name]}
+
+    def source(with_columns, predicate, n_rows, batch_hint):
+        # no projection means every column, an empty one (e.g. a row count) still needs one
+        columns = list(schema) if with_columns is None else (with_columns or list(schema)[:1])
+        query   = f"SELECT {', '.join(columns)} FROM {table_name}"
+        if where:
+            query += f" WHERE {where}"
+        query  += " ORDER BY rowid"
+        if n_rows is not None:
+            query += f" LIMIT {int(n_rows)}"
+
+        conn = connect(db_file)
+        try:
+            cursor  = conn.execute(query, params)
+            yielded = False
+            while True:
+                rows = cursor.fetchmany(batch_hint or batch_size)
+                if not rows and yielded:
+                    break
+
+                df = pl.DataFrame(rows, schema={col: pl.Utf8 for col in columns}, orient="row")
+                if predicate is not None:
+                    df = df.filter(predicate)
+                yield df
+
+                yielded = True
+                if not rows:
+                    break
+        finally:
+            conn.close()
+
+    return register_io_source(source, schema=schema)
+
+
+def scan_analytics(db_file, table_name, equals=None, before=None):
+    """
+    Scans a table for analytics, from a registered columnar snapshot when one exists
+    (see snapshot.py), else from SQLite through scan_table. Both sources yield the
+    stored string columns in insertion order.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The table to scan, one of db_table_columns.
+        equals (dict): Optional {column: value} equality filters.
+        before (tuple): Optional (column, value) exclusive upper bound on a stored ISO string.
+
+    Returns:
+        pl.LazyFrame: The filtered table, all columns typed as strings.
+    """
+
+    equals = equals or {}
+    source = analytics_sources.get(db_file)
+    frame  = source(table_name, equals) if source else None
+
+    if frame is not None:
+        for column, value in equals.items():
+            frame = frame.filter(pl.col(column) == value)
+        if before:
+            frame = frame.filter(pl.col(before[0]) < before[1])
+        return frame
+
+    conditions = [f"{column} = ?" for column in equals]
+    params     = list(equals.values())
+    if before:
+        conditions.append(f"{before[0]} < ?")
+        params.append(before[1])
+
+    return scan_table(db_file, table_name, " AND ".join(conditions) or None, tuple(params))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Keyset pagination over time-ordered deliveries. A page resumes after the (arrival_timestamp,
+# rowid) of the previous one through the composite indexes below, so every page costs one
+# index seek whatever its depth, and no read transaction is held between pages.
+#
+# index name -> (table, key column, time column)
+keyset_indexes = {
+    "idx_delivery_customer_arrival"     : ("delivery", "customer_id", "arrival_timestamp"),
+    "idx_delivery_transport_arrival"    : ("delivery", "transport_plate_number", "arrival_timestamp"),
+}
+
+
+def create_keyset_indexes(db_file):
+    """
+    Creates the composite indexes of keyset_indexes, SQLite appends the rowid to each.
+    """
+
+    conn = None
     try:
-        result = query_table(db_file, query, (customer_id,))
-        if result:
-            return float(result[0][0])  # Return the liter weight capacity as a float
-        else:
-            print(f"No liter weight capacity found for customer_id: {customer_id}")
-            return None
-    except Exception as e:
-        print(f"An error occurred while retrieving liter weight capacity: {e}")
-        return None
-    
+        conn = connect(db_file)
+        for index_name, (table_name, key_column, time_column) in keyset_indexes.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({key_column}, {time_column})")
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("sqlite error", extra={"db_file": db_file, "error": str(e)})
+    finally:
+        if conn:
+            conn.close()
 
-def generate_charge_table(db_file, customer_id, start_date, end_date, vol_balance=0):
+
+def keyset_page(db_file, table_name, key_column, key, time_column, start=None, end=None,
+                after=None, columns=None, limit=10_000):
     """
-    Generates a charge table for a specific customer and date range.
+    Fetches one page of the rows of a key, in time order, as an Arrow record batch.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The table to page through.
+        key_column (str): The column selecting the rows, e.g. customer_id.
+        key (str): Its value.
+        time_column (str): The stored ISO timestamp ordering the rows.
+        start (str): Optional inclusive lower bound, YYYY-MM-DD or a full timestamp.
+        end (str): Optional exclusive upper bound, in the same formats.
+        after (tuple): The cursor returned with the previous page, None for the first one.
+        columns (list): Columns to return, every column of the table when None.
+        limit (int): Maximum rows of the page.
+
+    Returns:
+        tuple: (pyarrow.RecordBatch of string columns, cursor of the next page or None after the last page).
     """
-    
-    target_customer_id  = customer_id
-    query               = "select * from delivery;"
-    delivery            = pl.DataFrame(query_table_as_pandas(db_file, query))
-    price               = get_applied_price(database_file, target_customer_id)
 
-    # Filter and transform in a single operation
-    df = (delivery
-        .filter(pl.col("customer_id") == target_customer_id)
+    import pyarrow as pa
+
+    columns    = columns or db_table_columns[table_name]
+    conditions = [f"{key_column} = ?"]
+    params     = [key]
+    if start is not None:
+        conditions.append(f"{time_column} >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{time_column} < ?")
+        params.append(end)
+    if after is not None:
+        conditions.append(f"({time_column}, rowid) > (?, ?)")
+        params.extend(after)
+
+    query = (
+        f"SELECT {', '.join(columns)}, {time_column}, rowid FROM {table_name} "
+        f"WHERE {' AND '.join(conditions)} ORDER BY {time_column}, rowid LIMIT ?"
+    )
+    params.append(limit)
+
+    conn = connect(db_file)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    values = list(zip(*rows)) if rows else [()] * (len(columns) + 2)
+    batch  = pa.RecordBatch.from_arrays(
+        [pa.array(values[i], type=pa.string()) for i in range(len(columns))],
+        names=list(columns),
+    )
+    cursor = tuple(rows[-1][-2:]) if len(rows) == limit else None
+    return batch, cursor
+
+
+def iter_keyset_batches(db_file, table_name, key_column, key, time_column, start=None, end=None,
+                        columns=None, batch_size=10_000):
+    """
+    Streams the rows of a key in time order as Arrow record batches of at most batch_size
+    rows, see keyset_page. Memory is bounded by one batch, whatever the history length.
+    """
+
+    after = None
+    while True:
+        batch, after = keyset_page(db_file, table_name, key_column, key, time_column, start, end, after, columns, batch_size)
+        if batch.num_rows:
+            yield batch
+        if after is None:
+            return
+
+
+def iter_customer_deliveries(db_file, customer_id, start=None, end=None, columns=None, batch_size=10_000):
+    """
+    Streams a customer's deliveries with arrival in [start, end) as Arrow record batches.
+    """
+    return iter_keyset_batches(db_file, "delivery", "customer_id", customer_id, "arrival_timestamp", start, end, columns, batch_size)
+
+
+def iter_transport_deliveries(db_file, plate_number, start=None, end=None, columns=None, batch_size=10_000):
+    """
+    Streams a transport's deliveries with arrival in [start, end) as Arrow record batches.
+    """
+    return iter_keyset_batches(db_file, "delivery", "transport_plate_number", plate_number, "arrival_timestamp", start, end, columns, batch_size)
+
+
+def charge_table_plan(db_file, customer_id, start_date, end_date, price):
+    """
+    Builds the lazy query plan of a customer's charge table over a date range.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_id (str): The customer to charge.
+        start_date (str): First charged date, YYYY-MM-DD.
+        end_date (str): Last charged date, YYYY-MM-DD.
+        price (float): Applied price per charged volume.
+
+    Returns:
+        pl.LazyFrame: One row per delivery in the range, see generate_charge_table.
+    """
+
+    pl_start_date = strptime(start_date, date_format).date()
+    pl_end_date   = strptime(end_date, date_format).date()
+
+    # stored timestamps are ISO strings, so the end bound is pushed into the source as a string comparison
+    until         = (pl_end_date + datetime.timedelta(days=1)).strftime(date_format)
+
+    plan = (scan_analytics(db_file, "delivery", {"customer_id": customer_id}, ("arrival_timestamp", until))
         .select([
-            pl.col("arrival_timestamp"),
             pl.col("customer_id"),
-            pl.col("delivery_stand_meter").map_elements(utils.safe_float, return_dtype=pl.Float64).alias("std_meter_on_arrival"),
-            pl.col("delivery_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("delivery_temperature").map_elements(utils.safe_float, return_dtype=pl.Float64)
+            # parse the stored timestamp once, date and day derive from it
+            pl.col("arrival_timestamp").str.to_datetime(timestamp_format).alias("arrival"),
+            pl.col("delivery_stand_meter").cast(pl.Float64, strict=False).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_temperature").cast(pl.Float64, strict=False),
         ])
+        .with_columns(pl.col("arrival").dt.date().alias("date"))
+        # the meter difference only looks back, later deliveries can be dropped before it
+        .filter(pl.col("date") <= pl_end_date)
+        .sort("arrival", maintain_order=True)
+        .with_columns(pl.col("std_meter_on_arrival").diff().alias("std_meter_diff"))
+        .filter(pl.col("date") >= pl_start_date)
+        .pipe(gas_correction.with_corrected_volume, "charged_volume")
         .with_columns([
-            pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.date().alias("date"),
-            pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.strftime("%A").alias('day')
+            (pl.col("charged_volume") * price).alias("charged_price"),
+            weekday_name_expr("date").alias("day"),
+        ])
+        .select([
+            'customer_id',
+            'date',
+            'day',
+            'charged_price',
+            'charged_volume',
+            'std_meter_on_arrival',
+            'delivery_pressure',
+            'delivery_temperature',
+            'std_meter_diff',
         ])
-        .drop("arrival_timestamp")
-    )
-
-    # Reorder columns
-    df = df.select([
-        'date',
-        'day',
-        'customer_id',
-        'std_meter_on_arrival',
-        'delivery_pressure',
-        'delivery_temperature'
-    ])
-
-    # Compute differences and derived columns in a single operation
-    df = df.with_columns([
-        pl.col("std_meter_on_arrival").diff().alias("std_meter_diff"),
-    ])
-
-    # Create a reusable expression for the complex calculation
-    corrected_volume_expr = (
-        pl.col("std_meter_diff") * 
-        (pl.col("delivery_pressure") + P_ATM) / P_ATM * 
-        300 / (pl.col("delivery_temperature") + 273) * 
-        (1 + CPF * pl.col("delivery_pressure"))
     )
 
-    # Add all computed columns in a single operation
-    df = df.with_columns([
-        corrected_volume_expr.alias("charged_volume"),
-        (corrected_volume_expr * price).alias("charged_price"),
-        (
-            pl.col("customer_id").cast(pl.Utf8) +
-            pl.col("date").cast(pl.Utf8).str.replace("-", "", literal=True, n=2) + 'C'
-        ).alias("charge_id")
-    ])
+    return plan
 
-    # Reorder columns
-    df = df.select([
-        'customer_id',
-        'date',
-        'day',
-        'charged_price',
-        'charged_volume',
-        'std_meter_on_arrival',
-        'delivery_pressure',
-        'delivery_temperature',
-        'std_meter_diff',
-    ])
 
-    # Convert the list of dates to a Polars expression for efficient filtering.
-    pl_start_date       = strptime(start_date, "%Y-%m-%d").date()
-    pl_end_date         = strptime(end_date, "%Y-%m-%d").date()
-    filter_expression   = pl.col("date").is_between(pl_start_date, pl_end_date)
-    sel_df              = df.filter(filter_expression)
+@profiler.profiled
+@cache.cached("delivery", "customer")
+def generate_charge_table(db_file, customer_id, start_date, end_date, vol_balance=0):
+    """
+    Generates a charge table for a specific customer and date range.
+    """
+    
+    target_customer_id  = customer_id
+    price               = get_applied_price(database_file, target_customer_id)
+    sel_df              = charge_table_plan(db_file, target_customer_id, start_date, end_date, price).collect()
 
     pretotal_volume    = sel_df["charged_volume"].sum()
     pretotal_price     = sel_df["charged_price"].sum()
@@ -787,11 +1474,6 @@ def generate_charge_table(db_file, customer_id, start_date, end_date, vol_balanc
     total_price_wtax           = total_price + charged_tax
 
 
-    # convert english day name to indonesian
-    sel_df = sel_df.with_columns([
-        pl.col("day").replace(day_name_map).alias("day")
-    ])
-
     res = {
         "dataframe"             : sel_df,
         "unit_price"            : price,
@@ -809,14 +1491,16 @@ def generate_charge_table(db_file, customer_id, start_date, end_date, vol_balanc
     return res
 
 
+@cache.cached("delivery")
 def get_transports_as_options():
     db_file = 'operation.db'    
     query   = "select distinct transport_plate_number FROM delivery;"
     
     try:
         result = query_table(db_file, query)
-    except Exception as e:
-        print(f"An error occurred while retrieving transports list {e}")
+    except Exception:
+        logger.exception("transport list lookup failed")
+        return []
     
     options = []
     for i, res in enumerate(result):
@@ -829,109 +1513,77 @@ def get_transports_as_options():
     return options
     
 
-def generate_tracker_set(target_plate_number):
-    db_file             = 'operation.db'
-    query               = "select * from delivery;"
-    delivery            = pl.DataFrame(query_table_as_pandas('operation.db', query))
+def tracker_plans(db_file, target_plate_number):
+    """
+    Builds the lazy query plans behind the tracker graph of one transport.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        target_plate_number (str): The transport to track.
 
-    # select by target plate number
-    filter_expression   = pl.col("transport_plate_number") == target_plate_number
+    Returns:
+        tuple: (restock_plan, delivery_plan). restock_plan yields date and restock_volume_cumul,
+               delivery_plan yields date and the cumulative delivered, consumed and charged volumes.
+    """
 
-    # select relevant column
-    deliv               = (delivery
-        .filter(filter_expression)
+    customer = (scan_analytics(db_file, "customer")
         .select([
-            pl.col("transport_plate_number"),
             pl.col("customer_id"),
-            pl.col("arrival_timestamp"),
-            pl.col("pre_buffer_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("post_buffer_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("delivery_stand_meter").map_elements(utils.safe_float, return_dtype=pl.Float64).alias("std_meter_on_arrival"),
-            pl.col("delivery_pressure").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("delivery_temperature").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("customer_id").map_elements(lambda x: get_liter_weight_capacity(db_file, x), return_dtype=pl.Float64).alias("liter_weight_capacity")
+            pl.col("liter_weight_capacity").cast(pl.Float64, strict=False),
         ])
-        .with_columns([
-            pl.col("arrival_timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.date().alias("date"),
+        .unique("customer_id", keep="last", maintain_order=True)
+    )
+
+    delivery_plan = (scan_analytics(db_file, "delivery", {"transport_plate_number": target_plate_number})
+        .select([
+            pl.col("customer_id"),
+            pl.col("arrival_timestamp").str.to_datetime(timestamp_format).alias("arrival"),
+            pl.col("pre_buffer_pressure").cast(pl.Float64, strict=False),
+            pl.col("post_buffer_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_stand_meter").cast(pl.Float64, strict=False).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_temperature").cast(pl.Float64, strict=False),
         ])
-        .drop("arrival_timestamp")
+        .join(customer, on="customer_id", how="left", maintain_order="left")
+        .sort("arrival", maintain_order=True)
         .with_columns([
+            pl.col("arrival").dt.date().alias("date"),
             ((pl.col("post_buffer_pressure") - pl.col("pre_buffer_pressure"))/200.0 * pl.col("liter_weight_capacity")/4).alias("est_volume_out"),
             ((pl.col("post_buffer_pressure").shift(1).fill_null(0) - pl.col("pre_buffer_pressure"))/200.0 * pl.col("liter_weight_capacity").shift(1).fill_null(0)/4.).alias("est_volume_consumed"),
+            pl.col("std_meter_on_arrival").diff().alias("std_meter_diff"),
+        ])
+        .pipe(gas_correction.with_corrected_volume, "charged_volume")
+        .select([
+            pl.col("date"),
+            pl.col("est_volume_out").cum_sum().alias("volume_out_cumul"),
+            pl.col("est_volume_consumed").cum_sum().alias("volume_consumed_cumul"),
+            pl.col("charged_volume").cum_sum().alias("charged_volume_cumul"),
         ])
     )
 
-    # Compute differences and derived columns in a single operation
-    deliv = deliv.with_columns([
-        pl.col("std_meter_on_arrival").diff().alias("std_meter_diff"),
-    ])
-
-    # Create a reusable expression for the complex calculation
-    corrected_volume_expr = (
-        pl.col("std_meter_diff") * 
-        (pl.col("delivery_pressure") + P_ATM) / P_ATM * 
-        300 / (pl.col("delivery_temperature") + 273) * 
-        (1 + CPF * pl.col("delivery_pressure"))
-    )
-
-    # Add all computed columns in a single operation
-    deliv = deliv.with_columns([
-        corrected_volume_expr.alias("charged_volume")
-    ])
-
-    deliv   = deliv.select([
-        "transport_plate_number",
-        "date",
-        "est_volume_out",
-        "est_volume_consumed",
-        "charged_volume",
-    ])
-
-    query               = "select * from restock;"
-    restock             = pl.DataFrame(query_table_as_pandas('operation.db', query))
-    filter_expression   = pl.col("transport_plate_number") == target_plate_number
-
-    # select relevant column
-    restock               = (restock
-        .filter(filter_expression)
+    # the first restock fills the empty transport and is not counted
+    restock_plan = (scan_analytics(db_file, "restock", {"transport_plate_number": target_plate_number})
         .select([
-            pl.col("transport_plate_number"),
-            pl.col("restock_date"),
-            pl.col("restock_volume").map_elements(utils.safe_float, return_dtype=pl.Float64),
-            pl.col("gas_station_address")
+            stored_date_expr("restock_date").alias("date"),
+            pl.col("restock_volume").cast(pl.Float64, strict=False),
         ])
-        .with_columns([
-            pl.col("restock_date").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S").dt.date().alias("date"),
+        .slice(1)
+        .select([
+            pl.col("date"),
+            pl.col("restock_volume").cum_sum().alias("restock_volume_cumul"),
         ])
-        .drop("restock_date")
     )
 
-    restock  = restock.select([
-        "transport_plate_number",
-        "date",
-        "restock_volume",
-        "gas_station_address"
-    ])
-
+    return restock_plan, delivery_plan
 
-    rf = restock[1:].with_columns([
-        pl.col("restock_volume").cum_sum().alias("restock_volume_cumul")
-    ]).select([
-        "date",
-        "restock_volume_cumul"
-    ])
 
+@profiler.profiled
+@cache.cached("delivery", "customer", "restock")
+def generate_tracker_set(target_plate_number):
+    import plotly.graph_objects as go
 
-    df = deliv.with_columns([
-        pl.col("est_volume_out").cum_sum().alias("volume_out_cumul"),
-        pl.col("est_volume_consumed").cum_sum().alias("volume_consumed_cumul"),
-        pl.col("charged_volume").cum_sum().alias("charged_volume_cumul")
-    ]).select([
-        "date",
-        "volume_out_cumul",
-        "volume_consumed_cumul",
-        "charged_volume_cumul"
-    ])
+    restock_plan, delivery_plan = tracker_plans(database_file, target_plate_number)
+    rf, df                      = pl.collect_all([restock_plan, delivery_plan])
 
 
     # Create figure
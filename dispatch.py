@@ -0,0 +1,372 @@
+import sys
+import argparse
+import datetime
+import polars as pl
+import database as db
+import buffer_forecast
+import cache
+import logs
+
+# numpy is imported by the functions that use it
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Next-day dispatch planner: python dispatch.py [--date YYYY-MM-DD]
+#
+#   due customers   those whose buffers reach the refill pressure (see buffer_forecast.py)
+#                   before the end of the plan day plus lookahead_hours, topped up to
+#                   fill_pressure, the most urgent first
+#   fleet           the transports that delivered or restocked within fleet_days, each
+#                   carrying its median restock volume per trip
+#   travel times    learned from history: the minutes between consecutive stops of a
+#                   transport on one day, less the service time, median per pair of
+#                   customers. Pairs never driven take same_route_minutes within a
+#                   delivery_route and other_route_minutes across routes, as no
+#                   coordinates are recorded
+#
+# Routes are built with the Clarke-Wright savings heuristic under the load of the largest
+# transport and the shift length, improved with 2-opt, then given, most urgent first, to
+# the free transport with enough load that served their customers most. Routes left without
+# a transport are returned unassigned.
+fill_pressure           = 200.0
+lookahead_hours         = 12
+shift_start_hour        = 6
+shift_hours             = 10
+service_minutes         = 30
+depot_minutes           = 60
+same_route_minutes      = 40
+other_route_minutes     = 90
+history_days            = 90
+fleet_days              = 60
+
+STOP_COLUMNS            = ["route", "transport_plate_number", "stop", "customer_id", "eta", "pressure",
+                           "volume", "refill_at", "hours_left"]
+
+logger                  = logs.get_logger("dispatch")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def recent_deliveries(db_file, plan_date):
+    """
+    Returns customer_id, transport_plate_number, delivery_route and arrival of the deliveries
+    of the history_days before plan_date.
+    """
+    start = datetime.datetime.combine(plan_date - datetime.timedelta(days=history_days), datetime.time())
+    end   = datetime.datetime.combine(plan_date, datetime.time())
+
+    return (db.scan_analytics(db_file, "delivery")
+        .select([
+            pl.col("customer_id"),
+            pl.col("transport_plate_number"),
+            pl.col("delivery_route"),
+            pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format, strict=False).alias("arrival"),
+        ])
+        .filter(pl.col("arrival").is_between(start, end, closed="left"))
+        .collect()
+    )
+
+
+def fleet(db_file, plan_date, history):
+    """
+    Returns the transports of the last fleet_days with their load per trip, sorted by plate.
+    """
+    start    = plan_date - datetime.timedelta(days=fleet_days)
+    restocks = (db.scan_analytics(db_file, "restock")
+        .select([
+            pl.col("transport_plate_number"),
+            db.stored_date_expr("restock_date").alias("date"),
+            pl.col("restock_volume").cast(pl.Float64, strict=False),
+        ])
+        .collect()
+    )
+    active   = pl.concat([
+        restocks.filter(pl.col("date").is_between(start, plan_date, closed="left")).select("transport_plate_number"),
+        history.filter(pl.col("arrival").dt.date() >= start).select("transport_plate_number"),
+    ]).drop_nulls().unique()
+    loads    = restocks.group_by("transport_plate_number").agg(pl.col("restock_volume").median().alias("capacity"))
+
+    return (active
+        .join(loads, on="transport_plate_number", how="left")
+        .with_columns(pl.col("capacity").fill_null(loads["capacity"].median()))
+        .sort("transport_plate_number")
+    )
+
+
+def travel_pairs(history):
+    """
+    Returns the median minutes between consecutive stops of a transport on one day, per
+    unordered pair of customers (customer_a < customer_b).
+    """
+    return (history
+        .sort(["transport_plate_number", "arrival"])
+        .with_columns([
+            pl.col("customer_id").shift(1).over("transport_plate_number", pl.col("arrival").dt.date()).alias("previous"),
+            (pl.col("arrival").diff().over("transport_plate_number", pl.col("arrival").dt.date()).dt.total_minutes() - service_minutes).alias("minutes"),
+        ])
+        .filter(
+            pl.col("previous").is_not_null() & (pl.col("previous") != pl.col("customer_id"))
+            & (pl.col("minutes") > 0) & (pl.col("minutes") < shift_hours * 60)
+        )
+        .group_by([
+            pl.min_horizontal("previous", "customer_id").alias("customer_a"),
+            pl.max_horizontal("previous", "customer_id").alias("customer_b"),
+        ])
+        .agg(pl.col("minutes").median())
+    )
+
+
+def due_customers(db_file, plan_date, history):
+    """
+    Returns the customers to serve on plan_date with their volume, most urgent first.
+    """
+    shift_start = datetime.datetime.combine(plan_date, datetime.time(shift_start_hour))
+    horizon     = shift_start + datetime.timedelta(hours=shift_hours + lookahead_hours)
+
+    routes   = (history
+        .filter(pl.col("delivery_route").is_not_null())
+        .group_by("customer_id")
+        .agg(pl.col("delivery_route").mode().first())
+    )
+    capacity = (db.scan_analytics(db_file, "customer")
+        .select([
+            pl.col("customer_id"),
+            pl.col("liter_weight_capacity").cast(pl.Float64, strict=False),
+        ])
+        .unique("customer_id", keep="last")
+        .collect()
+    )
+
+    return (buffer_forecast.forecasts(db_file, shift_start)
+        .filter(pl.col("refill_at") < horizon)
+        .join(routes, on="customer_id", how="left")
+        .join(capacity, on="customer_id", how="left")
+        .with_columns(
+            ((fill_pressure - pl.col("pressure")).clip(lower_bound=0) / 200 * pl.col("liter_weight_capacity") / 4)
+            .fill_null(0).alias("volume")
+        )
+        .sort("refill_at")
+    )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def travel_matrix(customer_ids, routes, pairs):
+    """
+    Returns the travel minutes between customers, from pairs where driven, else from routes.
+    """
+    import numpy as np
+
+    routes  = np.array([route if route is not None else "" for route in routes], dtype=object)
+    matrix  = np.where(routes[:, None] == routes[None, :], same_route_minutes, other_route_minutes).astype(np.float64)
+    index   = pl.DataFrame({"customer_id": customer_ids}).with_row_index("i")
+    known   = (pairs
+        .join(index.rename({"customer_id": "customer_a"}), on="customer_a")
+        .join(index.rename({"customer_id": "customer_b", "i": "j"}), on="customer_b")
+    )
+    i, j              = known["i"].to_numpy(), known["j"].to_numpy()
+    matrix[i, j]      = known["minutes"].to_numpy()
+    matrix[j, i]      = matrix[i, j]
+    np.fill_diagonal(matrix, 0.0)
+    return matrix
+
+
+def savings_routes(matrix, volumes, max_load, max_minutes):
+    """
+    Clarke-Wright savings: starts with one route per customer and joins route ends in
+    decreasing order of depot_minutes * 2 - matrix[i, j] while the load and duration fit.
+
+    Returns:
+        list: The routes as lists of customer positions.
+    """
+    import numpy as np
+
+    n       = len(volumes)
+    rows, columns = np.triu_indices(n, 1)
+    savings = 2 * depot_minutes - matrix[rows, columns]
+    order   = np.argsort(-savings, kind="stable")
+
+    route_of = list(range(n))
+    routes   = {position: [position] for position in range(n)}
+    loads    = {position: float(volumes[position]) for position in range(n)}
+    minutes  = {position: 2 * depot_minutes + service_minutes for position in range(n)}
+
+    for k in order:
+        if savings[k] <= 0:
+            break
+        i, j   = int(rows[k]), int(columns[k])
+        ri, rj = route_of[i], route_of[j]
+        if ri == rj or loads[ri] + loads[rj] > max_load or minutes[ri] + minutes[rj] - savings[k] > max_minutes:
+            continue
+
+        a, b = routes[ri], routes[rj]
+        if a[-1] == i and b[0] == j:
+            merged = a + b
+        elif a[0] == i and b[-1] == j:
+            merged = b + a
+        elif a[-1] == i and b[-1] == j:
+            merged = a + b[::-1]
+        elif a[0] == i and b[0] == j:
+            merged = a[::-1] + b
+        else:
+            continue
+
+        routes[ri]   = merged
+        loads[ri]   += loads.pop(rj)
+        minutes[ri] += minutes.pop(rj) - savings[k]
+        del routes[rj]
+        for position in b:
+            route_of[position] = ri
+
+    return list(routes.values())
+
+
+def two_opt(route, matrix):
+    """
+    Reverses segments of a route while that shortens it, the depot at both ends.
+    """
+    def cost(a, b):
+        return depot_minutes if a is None or b is None else matrix[a, b]
+
+    route    = list(route)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(route) - 1):
+            for j in range(i + 1, len(route)):
+                before, after = route[i - 1] if i else None, route[j + 1] if j + 1 < len(route) else None
+                delta = cost(before, route[j]) + cost(route[i], after) - cost(before, route[i]) - cost(route[j], after)
+                if delta < -1e-9:
+                    route[i:j + 1] = route[i:j + 1][::-1]
+                    improved = True
+    return route
+
+
+def assign_transports(routes, urgency, route_loads, trucks, affinity):
+    """
+    Gives every route, most urgent first, the free transport with enough load that served
+    its customers most, the smallest such one on a tie.
+
+    Returns:
+        list: The plate of every route, None when no transport is left for it.
+    """
+    plates     = [None] * len(routes)
+    free       = dict(zip(trucks["transport_plate_number"], trucks["capacity"]))
+    for position in sorted(range(len(routes)), key=lambda position: urgency[position]):
+        candidates = [plate for plate, capacity in free.items() if capacity >= route_loads[position]]
+        if not candidates:
+            continue
+        served = {plate: sum(affinity.get((customer, plate), 0) for customer in routes[position]) for plate in candidates}
+        plate  = max(candidates, key=lambda plate: (served[plate], -free[plate]))
+        plates[position] = plate
+        del free[plate]
+    return plates
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@cache.cached("delivery", "customer", "restock", "buffer_forecast")
+def plan(db_file, plan_date):
+    """
+    Plans the routes and transports of a day.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        plan_date (datetime.date): The day to plan.
+
+    Returns:
+        pl.DataFrame: STOP_COLUMNS, one row per stop in driving order. route is named after the
+                      delivery_route most of its customers had, transport_plate_number is null
+                      for the routes no transport is left for.
+    """
+    import numpy as np
+
+    history = recent_deliveries(db_file, plan_date)
+    trucks  = fleet(db_file, plan_date, history)
+    due     = due_customers(db_file, plan_date, history)
+    if due.is_empty() or trucks.is_empty():
+        return pl.DataFrame(schema={
+            "route": pl.Utf8, "transport_plate_number": pl.Utf8, "stop": pl.Int64, "customer_id": pl.Utf8,
+            "eta": pl.Datetime("us"), "pressure": pl.Float64, "volume": pl.Float64,
+            "refill_at": pl.Datetime("us"), "hours_left": pl.Float64,
+        })
+
+    customer_ids = due["customer_id"].to_list()
+    matrix       = travel_matrix(customer_ids, due["delivery_route"].to_list(), travel_pairs(history))
+    volumes      = due["volume"].to_numpy()
+    routes       = [
+        two_opt(route, matrix)
+        for route in savings_routes(matrix, volumes, trucks["capacity"].max(), shift_hours * 60)
+    ]
+
+    hours_left   = due["hours_left"].to_numpy()
+    positions    = {customer_id: position for position, customer_id in enumerate(customer_ids)}
+    affinity     = {
+        (positions[customer_id], plate): count
+        for customer_id, plate, count in history
+            .filter(pl.col("customer_id").is_in(customer_ids))
+            .group_by(["customer_id", "transport_plate_number"]).len().rows()
+    }
+    plates       = assign_transports(
+        routes, [hours_left[route].min() for route in routes], [volumes[route].sum() for route in routes], trucks, affinity,
+    )
+
+    # route names: the most common delivery_route of the stops, numbered when repeated
+    shift_start  = datetime.datetime.combine(plan_date, datetime.time(shift_start_hour))
+    names, stops = {}, []
+    for route, plate in zip(routes, plates):
+        labels = [label for label in due["delivery_route"].gather(route).to_list() if label]
+        name   = max(set(labels), key=labels.count) if labels else "route"
+        names[name] = names.get(name, 0) + 1
+        name   = name if names[name] == 1 else f"{name}-{names[name]}"
+
+        legs   = np.concatenate([[depot_minutes], matrix[route[:-1], route[1:]]]) + service_minutes * np.arange(len(route))
+        for stop, (position, minutes) in enumerate(zip(route, np.cumsum(legs)), start=1):
+            stops.append((name, plate, stop, position, shift_start + datetime.timedelta(minutes=float(minutes))))
+
+    frame = pl.DataFrame(stops, schema=["route", "transport_plate_number", "stop", "position", "eta"], orient="row")
+    return (frame
+        .join(due.with_row_index("position").with_columns(pl.col("position").cast(pl.Int64)), on="position")
+        .with_columns(
+            (pl.col("last_pressure") - pl.col("rate") * (pl.col("eta") - pl.col("last_arrival")).dt.total_minutes() / 60)
+            .clip(lower_bound=0).alias("pressure")
+        )
+        .sort([pl.col("transport_plate_number").is_null(), "transport_plate_number", "route", "stop"])
+        .select(STOP_COLUMNS)
+    )
+
+
+def route_summary(stops):
+    """
+    Returns one row per route of a plan: transport, stops, volume, first and last eta.
+    """
+    return (stops
+        .group_by(["route", "transport_plate_number"], maintain_order=True)
+        .agg([
+            pl.len().alias("stops"),
+            pl.col("volume").sum(),
+            pl.col("eta").min().alias("first_eta"),
+            pl.col("eta").max().alias("last_eta"),
+            pl.col("hours_left").min().alias("most_urgent_hours_left"),
+        ])
+    )
+
+
+def main(argv=None):
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    parser   = argparse.ArgumentParser(prog="python dispatch.py", description="Plans next-day routes and transports from the buffer forecasts.")
+    parser.add_argument("--date", default=tomorrow.strftime(db.date_format), help="the day to plan, YYYY-MM-DD, tomorrow by default")
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    buffer_forecast.enable(args.db)
+    plan_date = datetime.datetime.strptime(args.date, db.date_format).date()
+    stops     = plan(args.db, plan_date)
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(route_summary(stops))
+        print(stops)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,12 @@
 import database as db
-from importlib import reload
-import pandas as pd
-import datetime
-import re
-import utils
+import polars as pl
+import logs
 
 database_file   = 'operation.db'
+logger          = logs.get_logger("fill_tables")
 
 def replenish_table():
-    print("replenishing table")
+    logger.info("replenishing tables", extra={"db_file": database_file})
     # -----------------------------------------------------------------------------------------
     # create tables
     # -----------------------------------------------------------------------------------------
@@ -25,26 +23,23 @@ def replenish_table():
     table_name      = 'customer'
     db.remove_table(database_file, table_name)
     db.create_table_with_list(database_file, table_name, db.db_table_columns[table_name])
-    df = db.yaml_to_dataframe_as_string('customer.yml')
+    db.create_key_index(database_file, table_name)
+    df = pl.from_pandas(db.yaml_to_dataframe_as_string('customer.yml'))
 
-    for i, row in df.iterrows():
+    # dates are validated and written once as ISO dates
+    df = df.select([
+        pl.col("customer_id"),
+        pl.col("customer_name"),
+        pl.col("customer_address"),
+        pl.col("subscription_type"),
+        pl.col("subscription_start").str.to_date(db.date_format).dt.strftime(db.date_format),
+        pl.col("liter_weight_capacity"),
+        pl.col("minimum_monthly_volume"),
+        pl.col("buffer_count"),
+        pl.col("applied_price"),
+    ])
 
-        subscription_start     = row["subscription_start"]
-        subs_start_iso         = datetime.datetime.strptime(subscription_start, "%Y-%m-%d")
-
-        insertion = {
-            "customer_id"             : row["customer_id"],          
-            "customer_name"           : row["customer_name"],
-            "customer_address"        : row["customer_address"],
-            "subscription_type"       : row["subscription_type"],
-            "subscription_start"      : subs_start_iso,
-            "liter_weight_capacity"   : row["liter_weight_capacity"],
-            "minimum_monthly_volume"  : row["minimum_monthly_volume"],
-            "buffer_count"            : row["buffer_count"],
-            "applied_price"           : row["applied_price"]
-        }
-
-        db.insert_row_from_dict(database_file, "customer", insertion)
+    db.insert_rows_from_dicts(database_file, table_name, df.to_dicts())
 
 
     # check
@@ -55,41 +50,40 @@ def replenish_table():
 
 
     # -----------------------------------------------------------------------------------------
-    # delivery table    
+    # delivery table
     # -----------------------------------------------------------------------------------------
-    table_name      = 'delivery' 
+    table_name      = 'delivery'
     db.remove_table(database_file, table_name)
     db.create_table_with_list(database_file, table_name, db.db_table_columns[table_name])
+    db.create_key_index(database_file, table_name)
+
+    df              = pl.from_pandas(db.yaml_to_dataframe_as_string('delivery.yml'))
+
+    # older sheets name the transport bank reading gtm_bank_pressure
+    bank_columns    = [col for col in ["transport_bank_pressure", "gtm_bank_pressure"] if col in df.columns]
 
-    df              = db.yaml_to_dataframe_as_string('delivery.yml')
-
-    for i, row in df.iterrows():
-        customer_id           = row["customer_id"]
-        dlv_date              = row["delivery_date"]
-        arrival_time          = row["delivery_arrival_time"]    
-        dlv_date              = datetime.datetime.strptime(dlv_date, "%d-%b-%y")
-        # Convert arrival_time to iso
-        arrival_time          = datetime.datetime.strptime(arrival_time, "%H.%M").time()  # Extract the time
-        arrival_datetime      = datetime.datetime.combine(dlv_date.date(), arrival_time) # Combine with the correct date
-        arrival_time_iso      = arrival_datetime.strftime("%Y-%m-%d %H:%M:%S")    
-        delivery_id           = customer_id + re.sub(r"[\-\s:]", "", arrival_time_iso)[:-2]
-        arrival_timestamp     = arrival_time_iso
-
-        insertion = {
-            "delivery_id"            : delivery_id,
-            "customer_id"            : row["customer_id"],
-            "delivery_route"         : row["delivery_route"].lower(),
-            "transport_plate_number" : row["plate_number"],
-            "arrival_timestamp"      : arrival_timestamp,
-            "pre_buffer_pressure"    : row["pre_buffer_pressure"],
-            "delivery_stand_meter"   : row["delivery_stand_meter"],
-            "delivery_pressure"      : row["delivery_pressure"],
-            "delivery_temperature"   : row["delivery_temperature"],
-            "post_buffer_pressure"   : row["post_buffer_pressure"],
-            "transport_bank_pressure": row["transport_bank_pressure"],
-        }
-
-        db.insert_row_from_dict(database_file, "delivery", insertion)
+    def reading(expr):
+        return expr.cast(pl.Float64, strict=False).fill_nan(None)
+
+    df = df.with_columns([
+        pl.col("delivery_date").str.to_date("%d-%b-%y")
+        .dt.combine(pl.col("delivery_arrival_time").str.to_time("%H.%M"))
+        .alias("arrival"),
+    ]).select([
+        db.delivery_id_expr().alias("delivery_id"),
+        pl.col("customer_id"),
+        pl.col("delivery_route").str.to_lowercase(),
+        pl.col("plate_number").alias("transport_plate_number"),
+        pl.col("arrival").dt.strftime(db.timestamp_format).alias("arrival_timestamp"),
+        reading(pl.col("pre_buffer_pressure")),
+        reading(pl.col("delivery_stand_meter")),
+        reading(pl.col("delivery_pressure")),
+        reading(pl.col("delivery_temperature")),
+        reading(pl.col("post_buffer_pressure")),
+        pl.coalesce([reading(pl.col(col)) for col in bank_columns]).alias("transport_bank_pressure"),
+    ])
+
+    db.insert_rows_from_dicts(database_file, table_name, df.to_dicts())
 
 
     # check
@@ -99,29 +93,26 @@ def replenish_table():
 
 
     # -----------------------------------------------------------------------------------------
-    # restock table    
+    # restock table
     # -----------------------------------------------------------------------------------------
-    table_name      = 'restock' 
+    table_name      = 'restock'
     db.remove_table(database_file, table_name)
     db.create_table_with_list(database_file, table_name, db.db_table_columns[table_name])
-    df = db.yaml_to_dataframe_as_string('restock.yml')
-
-    for i, row in df.iterrows():
-        plate_number    = row["plate_number"]
-        restock_date    = row["restock_date"]
-        restock_id      = re.sub(r"[\s:]", "", plate_number) + re.sub(r"[\-\s:]", "", restock_date)
-        restock_date    = datetime.datetime.strptime(restock_date, "%Y-%m-%d")
-        restock_volume  = float(row["restock_volume"])
+    db.create_key_index(database_file, table_name)
+    df = pl.from_pandas(db.yaml_to_dataframe_as_string('restock.yml'))
 
-        insertion = {
-            "restock_id"        : restock_id,
-            "transport_plate_number"      : plate_number,
-            "restock_date"      : restock_date,
-            "restock_volume"    : restock_volume,
-            "gas_station_address"      : row["spbg_address"]
-        }
+    df = df.with_columns([
+        pl.col("plate_number").alias("transport_plate_number"),
+        pl.col("restock_date").str.to_date(db.date_format),
+    ]).select([
+        db.restock_id_expr().alias("restock_id"),
+        pl.col("restock_date").dt.strftime(db.date_format),
+        pl.col("transport_plate_number"),
+        pl.col("restock_volume").cast(pl.Float64),
+        pl.col("spbg_address").alias("gas_station_address"),
+    ])
 
-        db.insert_row_from_dict(database_file, table_name, insertion)
+    db.insert_rows_from_dicts(database_file, table_name, df.to_dicts())
 
 
     # check
@@ -132,4 +123,5 @@ def replenish_table():
 
 
 if __name__ == '__main__':
-    replenish_table()
\ No newline at end of file
+    logs.configure()
+    replenish_table()
@@ -0,0 +1,319 @@
+import os
+import json
+import threading
+import polars as pl
+import logs
+
+# numpy and pandas are imported by the functions that use them
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Gas volume correction: a stand meter volume metered at the delivery pressure (gauge, bar)
+# and temperature (°C) is converted to reference conditions:
+#
+#   corrected = volume * (pressure + P_ATM) / reference_pressure
+#                      * reference_temperature / (temperature + KELVIN_OFFSET)
+#                      * compressibility factor of the model
+#
+# Models, each written once with arithmetic operators only, so the same function evaluates
+# whole Polars columns (as expressions) and NumPy arrays:
+#
+#   linear      1 + cpf * pressure, the correction the charge tables always used
+#   papay       Z(reference) / Z(metering) with the Papay Z-factor correlation and Sutton
+#               pseudo-critical properties from the gas specific gravity: an AGA8-style
+#               compressibility approximation for lean natural gas up to about 100 bar
+#   ideal       1
+#
+# Reference conditions and model default to those of the charge tables (300 K, atmospheric
+# pressure, linear). Customers metered otherwise are listed in a JSON file:
+#
+#   GMERCHANT_GAS_CONDITIONS    "gas_conditions.json" by default, read once per process
+#
+#   {"default": {...}, "customers": {"<customer_id>": {"reference_temperature": 288.15,
+#    "reference_pressure": 1.01325, "model": "papay", "specific_gravity": 0.6, "cpf": 0.0002}}}
+#
+# Charges are cached (see cache.py): after editing the file, restart with `python app.py init`.
+P_ATM               = 1.01325
+CPF                 = 0.0002
+# the charge tables convert °C with 273, not 273.15
+KELVIN_OFFSET       = 273
+
+conditions_file     = os.environ.get("GMERCHANT_GAS_CONDITIONS", "gas_conditions.json")
+
+# numeric parameters of a model, with their defaults
+PARAMETERS          = {
+    "reference_temperature" : 300.0,
+    "reference_pressure"    : P_ATM,
+    "cpf"                   : CPF,
+    "specific_gravity"      : 0.6,
+}
+DEFAULT_MODEL       = "linear"
+
+# (default conditions, {customer_id: conditions}), loaded by load_conditions
+loaded              = None
+loaded_lock         = threading.Lock()
+
+logger              = logs.get_logger("gas_correction")
+
+
+class Conditions:
+    """
+    Reference conditions and compressibility model of one customer.
+    """
+    __slots__ = ("model",) + tuple(PARAMETERS)
+
+    def __init__(self, model=DEFAULT_MODEL, **parameters):
+        unknown = set(parameters) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f"unknown gas condition {sorted(unknown)[0]}")
+        if model not in models:
+            raise ValueError(f"unknown compressibility model {model}, use one of {sorted(models)}")
+
+        self.model = model
+        for name, default in PARAMETERS.items():
+            setattr(self, name, float(parameters.get(name, default)))
+
+    def parameters(self):
+        return {name: getattr(self, name) for name in PARAMETERS}
+
+    def constants(self):
+        """
+        Returns the parameters with the per-customer terms of the models worked out once,
+        so the kernels only compute what depends on the readings.
+        """
+        critical_temperature, critical_pressure = sutton_critical(self.specific_gravity)
+        return {
+            **self.parameters(),
+            "critical_temperature"  : critical_temperature,
+            "critical_pressure"     : critical_pressure,
+            "z_reference"           : papay_z(self.reference_pressure / critical_pressure, self.reference_temperature / critical_temperature),
+        }
+
+    def __repr__(self):
+        return f"Conditions(model={self.model!r}, " + ", ".join(f"{name}={value}" for name, value in self.parameters().items()) + ")"
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Models, on Polars expressions or NumPy arrays alike. pressure is gauge bar, temperature K,
+# constants maps the names of Conditions.constants to scalars or to columns of the same kind.
+def ideal_factor(pressure, temperature, constants):
+    return 1.0
+
+
+def linear_factor(pressure, temperature, constants):
+    return 1 + constants["cpf"] * pressure
+
+
+def sutton_critical(specific_gravity):
+    """
+    Returns the pseudo-critical (temperature K, pressure bar a) of a natural gas, by Sutton.
+    """
+    critical_temperature = (169.2 + 349.5 * specific_gravity - 74.0 * specific_gravity ** 2) / 1.8
+    critical_pressure    = (756.8 - 131.0 * specific_gravity - 3.6 * specific_gravity ** 2) * 0.0689476
+    return critical_temperature, critical_pressure
+
+
+def papay_z(reduced_pressure, reduced_temperature):
+    """
+    Papay compressibility factor at pseudo-reduced pressure and temperature.
+    """
+    return (
+        1
+        - 3.52 * reduced_pressure / 10 ** (0.9813 * reduced_temperature)
+        + 0.274 * reduced_pressure ** 2 / 10 ** (0.8157 * reduced_temperature)
+    )
+
+
+def papay_factor(pressure, temperature, constants):
+    # Z at reference conditions only depends on the customer and comes precomputed
+    return constants["z_reference"] / papay_z(
+        (pressure + P_ATM) / constants["critical_pressure"], temperature / constants["critical_temperature"]
+    )
+
+
+models              = {
+    "linear"    : linear_factor,
+    "papay"     : papay_factor,
+    "ideal"     : ideal_factor,
+}
+
+# the constants every model reads, besides the reference conditions read by correct
+model_constants     = {
+    "linear"    : ("cpf",),
+    "papay"     : ("z_reference", "critical_pressure", "critical_temperature"),
+    "ideal"     : (),
+}
+
+
+def correct(volume, pressure, temperature, constants, model):
+    """
+    Applies the correction to scalars, NumPy arrays or Polars expressions.
+
+    Args:
+        volume: Metered volume.
+        pressure: Delivery pressure, gauge bar.
+        temperature: Delivery temperature, °C.
+        constants (dict): Conditions.constants values, scalars or columns.
+        model (str): A key of models.
+    """
+    return (
+        volume
+        * (pressure + P_ATM) / constants["reference_pressure"]
+        * constants["reference_temperature"] / (temperature + KELVIN_OFFSET)
+        * models[model](pressure, temperature + KELVIN_OFFSET, constants)
+    )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def load_conditions(path=None):
+    """
+    Reads the default and per-customer conditions, see the module header. A missing file
+    leaves the charge table defaults.
+
+    Returns:
+        tuple: (default Conditions, {customer_id: Conditions})
+    """
+    path = path or conditions_file
+    if not os.path.exists(path):
+        return Conditions(), {}
+
+    with open(path, encoding="utf-8") as f:
+        document = json.load(f)
+    default   = Conditions(**document.get("default", {}))
+    customers = {
+        str(customer_id): Conditions(**{"model": default.model, **default.parameters(), **entry})
+        for customer_id, entry in document.get("customers", {}).items()
+    }
+    logger.info("gas conditions loaded", extra={"path": path, "default": default.model, "customers": len(customers)})
+    return default, customers
+
+
+def conditions():
+    """
+    Returns the (default, per-customer) conditions of this process, loaded on first use.
+    """
+    global loaded
+
+    if loaded is None:
+        with loaded_lock:
+            if loaded is None:
+                loaded = load_conditions()
+    return loaded
+
+
+def configure(default=None, customers=None):
+    """
+    Replaces the conditions of this process, e.g. configure(Conditions(model="papay")).
+    """
+    global loaded
+    with loaded_lock:
+        loaded = (default or Conditions(), dict(customers or {}))
+
+
+def customer_index_expr(customer, customers):
+    """
+    Maps the customer column to 1 + the position of the customer in customers, 0 for the others.
+    """
+    return pl.col(customer).replace_strict(
+        {customer_id: position for position, customer_id in enumerate(customers, start=1)},
+        default=0,
+        return_dtype=pl.UInt32,
+    )
+
+
+def with_corrected_volume(frame, name="charged_volume", std_meter_diff="std_meter_diff", pressure="delivery_pressure",
+                          temperature="delivery_temperature", customer="customer_id"):
+    """
+    Adds the stand meter difference corrected to the reference conditions of each row's customer.
+
+    Without per-customer conditions this is the bare arithmetic of the default model. Otherwise
+    the customer column is hashed once into an index, the constants of every customer are
+    gathered by it into helper columns, and each model in use is one branch of a when/then
+    chain over them. Materializing the constants first keeps the branches plain column
+    arithmetic, about twice as fast as gathering inside them.
+
+    Args:
+        frame (pl.LazyFrame | pl.DataFrame): Holds the volume, pressure, temperature and customer columns.
+        name (str): The column to add, null where an input is null.
+
+    Returns:
+        The frame with the name column added.
+    """
+
+    default, customers = conditions()
+    volume, pressure, temperature = pl.col(std_meter_diff), pl.col(pressure), pl.col(temperature)
+    if not customers:
+        return frame.with_columns(correct(volume, pressure, temperature, default.constants(), default.model).alias(name))
+
+    entries = [default] + list(customers.values())
+    table   = [entry.constants() for entry in entries]
+    used    = sorted({entry.model for entry in entries})
+    names   = sorted({"reference_pressure", "reference_temperature"}.union(*(model_constants[model] for model in used)))
+    helpers = {constant: f"_gas_{constant}" for constant in names}
+    index   = pl.col("_gas_index")
+
+    gathered = [
+        pl.lit(pl.Series(constant, [row[constant] for row in table], dtype=pl.Float64)).gather(index).alias(helpers[constant])
+        for constant in names
+    ]
+    if len(used) > 1:
+        gathered.append(pl.lit(pl.Series("model", [used.index(entry.model) for entry in entries], dtype=pl.UInt8)).gather(index).alias("_gas_model"))
+
+    columns = {constant: pl.col(helper) for constant, helper in helpers.items()}
+    expr    = correct(volume, pressure, temperature, columns, used[0])
+    if len(used) > 1:
+        expr = pl.when(pl.col("_gas_model") == 0).then(expr)
+        for position, model in enumerate(used[1:], start=1):
+            expr = expr.when(pl.col("_gas_model") == position).then(correct(volume, pressure, temperature, columns, model))
+
+    return (frame
+        .with_columns(customer_index_expr(customer, customers).alias("_gas_index"))
+        .with_columns(gathered)
+        .with_columns(expr.alias(name))
+        .drop(["_gas_index", *helpers.values()] + (["_gas_model"] if len(used) > 1 else []))
+    )
+
+
+def corrected_volumes(volume, pressure, temperature, customer_ids=None):
+    """
+    NumPy counterpart of with_corrected_volume, e.g. for sensor traces (see timeseries.py).
+
+    Args:
+        volume, pressure, temperature (array-like): Metered volume, gauge bar and °C.
+        customer_ids (array-like): Optional customer of every reading, or one customer_id for all.
+
+    Returns:
+        np.ndarray: The corrected volumes as float64, NaN where an input is NaN.
+    """
+    import numpy as np
+
+    volume      = np.asarray(volume, dtype=np.float64)
+    pressure    = np.asarray(pressure, dtype=np.float64)
+    temperature = np.asarray(temperature, dtype=np.float64)
+
+    default, customers = conditions()
+    if customer_ids is None or not customers:
+        return correct(volume, pressure, temperature, default.constants(), default.model)
+    if isinstance(customer_ids, str):
+        entry = customers.get(customer_ids, default)
+        return correct(volume, pressure, temperature, entry.constants(), entry.model)
+
+    # constants worked out per distinct customer, then broadcast through the codes
+    import pandas as pd
+
+    # missing customers get a code of their own, the -1 sentinel would index the last customer
+    codes, unique = pd.factorize(np.asarray(customer_ids), use_na_sentinel=False)
+    entries       = [customers.get(customer_id, default) for customer_id in unique]
+    table         = [entry.constants() for entry in entries]
+    used          = sorted({entry.model for entry in entries})
+    model_codes   = np.array([used.index(entry.model) for entry in entries])[codes]
+
+    result = np.full(volume.shape, np.nan)
+    for position, model in enumerate(used):
+        rows         = np.flatnonzero(model_codes == position) if len(used) > 1 else slice(None)
+        row_codes    = codes[rows]
+        names        = ("reference_pressure", "reference_temperature") + model_constants[model]
+        constants    = {name: np.array([row[name] for row in table])[row_codes] for name in names}
+        result[rows] = correct(volume[rows], pressure[rows], temperature[rows], constants, model)
+    return result
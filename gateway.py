@@ -0,0 +1,348 @@
+import os
+import sys
+import hmac
+import json
+import time
+import asyncio
+import sqlite3
+import argparse
+import database as db
+import snapshot
+import cache
+import reconciliation
+import mass_balance
+import buffer_forecast
+import restock_forecast
+import ingest
+import meter_validation
+import writer
+import report_parser
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Ingest gateway for trucks on slow links: python gateway.py [--port 8060]
+#
+# A separate asyncio process next to app.py. A slow upload only holds a coroutine here, not
+# a gunicorn worker. It takes the same URLs as the app:
+#
+#   POST /api/ingest/delivery       text reports as pasted in the forms (text/plain), or
+#   POST /api/ingest/restock        JSON/NDJSON records as for ingest.py
+#   GET  /health                    queue depth and flush statistics
+#
+# Requests are queued, and a flush task takes whatever queued up within flush_interval,
+# up to max_batch records. It validates them in one pass (generate_delivery_rowreps,
+# generate_restock_rowreps, or ingest.validate) and writes them in one transaction. A request
+# is answered once its records are committed. When max_pending requests are waiting, a new one
+# waits enqueue_timeout for room and is then refused with 503 and Retry-After, so memory stays
+# bounded while the database catches up.
+#
+# The snapshot, result cache, rollup, mass balances, buffer and restock forecasts prepared
+# by `python app.py init` are refreshed from here too. GMERCHANT_INGEST_TOKEN is required in
+# X-Ingest-Token, as on the app.
+max_pending         = 2_000
+max_batch           = 5_000
+flush_interval      = 0.02
+enqueue_timeout     = 2.0
+read_timeout        = 30.0
+idle_timeout        = 60.0
+max_body_bytes      = 4 * 1024 * 1024
+
+REASONS             = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                       405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+logger              = logs.get_logger("gateway")
+
+
+class Pending:
+    """
+    One queued request: its payload, record count and the future answering it.
+    """
+    __slots__ = ("table_name", "kind", "payload", "size", "future")
+
+    def __init__(self, table_name, kind, payload, size, future):
+        self.table_name = table_name
+        self.kind       = kind
+        self.payload    = payload
+        self.size       = size
+        self.future     = future
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def flush_reports(db_file, table_name, items):
+    """
+    Validates and writes the text reports of many requests as one block.
+
+    Returns:
+        list: One (written, summary) per item, summary numbered from 1 within each request.
+    """
+
+    generate      = db.generate_delivery_rowreps if table_name == "delivery" else db.generate_restock_rowreps
+    upsert        = table_name == "restock"
+
+    # every payload is split on its own: joined as text, a malformed one (a dangling key)
+    # would run into the next and shift the reports of every later request
+    raws          = [report_parser.split_raw_reports(item.payload) for item in items]
+    block         = [raw for payload in raws for raw in payload]
+
+    def write():
+        rowreps, summary = generate(block)
+        if table_name == "delivery":
+            rowreps, summary = meter_validation.screen_rowreps(db_file, rowreps, summary)
+        writer.write(db_file, table_name, rowreps, upsert=upsert)
+        return summary
+
+    try:
+        summary = write()
+    except sqlite3.IntegrityError:
+        # a delivery stored by the app since the validation
+        summary = write()
+
+    results = []
+    offset  = 0
+    for payload in raws:
+        part    = [{**entry, "report": entry["report"] - offset} for entry in summary[offset:offset + len(payload)]]
+        written = sum(entry["status"] in ("accepted", "inserted", "updated") for entry in part)
+        results.append((written, part))
+        offset += len(payload)
+    return results
+
+
+def flush_records(db_file, table_name, items):
+    """
+    Validates and writes the JSON records of many requests as one ingest.ingest batch.
+
+    Returns:
+        list: One (written, records) per item, records numbered from 1 within each request.
+    """
+
+    result  = ingest.ingest(db_file, table_name, [record for item in items for record in item.payload])
+    results = []
+    offset  = 0
+    for item in items:
+        part    = [{**entry, "record": entry["record"] - offset} for entry in result["records"][offset:offset + item.size]]
+        written = sum(entry["status"] in ("inserted", "updated") for entry in part)
+        results.append((written, part))
+        offset += item.size
+    return results
+
+
+class Gateway:
+    """
+    Queue of pending requests and the task flushing it to db_file.
+    """
+
+    def __init__(self, db_file):
+        self.db_file    = db_file
+        self.queue      = asyncio.Queue(max_pending)
+        self.flushes    = 0
+        self.records    = 0
+        self.refused    = 0
+
+    async def submit(self, table_name, kind, payload, size):
+        """
+        Queues a request and waits until its records are committed.
+
+        Returns:
+            tuple: (written, statuses), or None when the queue stayed full.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.queue.put(Pending(table_name, kind, payload, size, future)), enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.refused += 1
+            return None
+        return await future
+
+    async def flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch    = [await self.queue.get()]
+            records  = batch[0].size
+            deadline = loop.time() + flush_interval
+            while records < max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                records += batch[-1].size
+
+            # Polars and SQLite run in a thread, the event loop keeps accepting uploads meanwhile
+            await asyncio.to_thread(self.flush, batch, loop)
+
+    def flush(self, batch, loop):
+        groups = {}
+        for item in batch:
+            groups.setdefault((item.table_name, item.kind), []).append(item)
+
+        start = time.perf_counter()
+        for (table_name, kind), items in groups.items():
+            try:
+                if kind == "reports":
+                    results = flush_reports(self.db_file, table_name, items)
+                else:
+                    results = flush_records(self.db_file, table_name, items)
+                for item, result in zip(items, results):
+                    loop.call_soon_threadsafe(item.future.set_result, result)
+            except Exception as e:
+                logger.exception("flush failed", extra={"table": table_name, "requests": len(items)})
+                for item in items:
+                    loop.call_soon_threadsafe(item.future.set_exception, e)
+
+        self.flushes += 1
+        self.records += sum(item.size for item in batch)
+        logger.info("flushed", extra={
+            "requests"  : len(batch),
+            "records"   : sum(item.size for item in batch),
+            "seconds"   : round(time.perf_counter() - start, 4),
+            "queued"    : self.queue.qsize(),
+        })
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    async def route(self, method, path, headers, body):
+        """
+        Answers one request.
+
+        Returns:
+            tuple: (status, JSON-serializable payload, extra headers)
+        """
+
+        path = path.split("?", 1)[0]
+        if path == "/health" and method == "GET":
+            return 200, {"queued": self.queue.qsize(), "flushes": self.flushes, "records": self.records, "refused": self.refused}, {}
+
+        table_name = path.rsplit("/", 1)[-1]
+        if not path.startswith("/api/ingest/") or table_name not in ingest.numeric_columns:
+            return 404, {"error": "not found"}, {}
+        if method != "POST":
+            return 405, {"error": "POST only"}, {}
+
+        token = os.environ.get("GMERCHANT_INGEST_TOKEN")
+        if not token:
+            return 404, {"error": "not found"}, {}
+        if not hmac.compare_digest(headers.get("x-ingest-token", ""), token):
+            return 403, {"error": "forbidden"}, {}
+
+        content_type = headers.get("content-type", "")
+        try:
+            if content_type.startswith("text/plain"):
+                kind, payload = "reports", body.decode("utf-8")
+                size          = db.count_reports(payload)
+            else:
+                kind, payload = "records", ingest.parse_body(body, content_type)
+                size          = len(payload)
+        except (ValueError, UnicodeDecodeError) as e:
+            return 400, {"error": str(e)}, {}
+        if size == 0:
+            return 400, {"error": "no report or record"}, {}
+        if size > max_batch:
+            return 413, {"error": f"at most {max_batch} records per request"}, {}
+
+        try:
+            result = await self.submit(table_name, kind, payload, size)
+        except Exception as e:
+            return 503, {"error": str(e)}, {"Retry-After": "5"}
+        if result is None:
+            return 503, {"error": "ingest queue full"}, {"Retry-After": "1"}
+
+        written, statuses = result
+        return 200, {"table": table_name, "received": size, "written": written, "records": statuses}, {}
+
+    async def handle(self, reader, stream):
+        """
+        Serves the HTTP/1.1 requests of one connection, kept alive until the client closes it
+        or stays idle. Bodies need a Content-Length.
+        """
+
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), idle_timeout)
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), read_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > max_body_bytes:
+                    status, payload, extra = 413, {"error": f"at most {max_body_bytes} bytes per request"}, {}
+                    headers["connection"] = "close"
+                else:
+                    body = await asyncio.wait_for(reader.readexactly(length), read_timeout) if length else b""
+                    status, payload, extra = await self.route(method, path, headers, body)
+
+                data      = json.dumps(payload, default=str).encode()
+                keepalive = headers.get("connection", "").lower() != "close"
+                head      = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json",
+                             f"Content-Length: {len(data)}", f"Connection: {'keep-alive' if keepalive else 'close'}"]
+                head     += [f"{name}: {value}" for name, value in extra.items()]
+                stream.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await stream.drain()
+                if not keepalive:
+                    break
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            stream.close()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def attach(db_file):
+    """
+    Refreshes the snapshot, result cache, monthly volume rollup, mass balances, buffer and
+    restock forecasts prepared by `python app.py init` after the gateway's writes, as the
+    app workers do, and quarantines deliveries failing the meter reading checks.
+    """
+    db.database_file = db_file
+    db.enable_wal(db_file)
+    db.create_key_index(db_file, "delivery")
+    meter_validation.enable(db_file)
+    snapshot.enable(db_file, rebuild=False)
+    cache.enable(db_file, clear=False)
+    reconciliation.enable(db_file, rebuild=False)
+    mass_balance.enable(db_file, rebuild=False)
+    buffer_forecast.enable(db_file, rebuild=False)
+    restock_forecast.enable(db_file, rebuild=False)
+    # after the listeners are enabled, so the derived stores drop the duplicate restocks it removes
+    db.create_key_index(db_file, "restock", deduplicate=True)
+
+
+async def serve(host, port, db_file):
+    gateway = Gateway(db_file)
+    server  = await asyncio.start_server(gateway.handle, host, port, backlog=4096, limit=max_body_bytes)
+    flusher = asyncio.create_task(gateway.flush_loop())
+    logger.info("gateway listening", extra={"host": host, "port": port, "db_file": db_file})
+    async with server:
+        await server.serve_forever()
+    flusher.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python gateway.py", description="Asyncio ingest gateway for delivery and restock uploads.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GATEWAY_PORT", 8060)))
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database to write to")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    attach(args.db)
+    try:
+        asyncio.run(serve(args.host, args.port, args.db))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
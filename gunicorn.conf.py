@@ -0,0 +1,44 @@
+import os
+import gc
+import sys
+import importlib
+import subprocess
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# gunicorn -c gunicorn.conf.py
+#
+# The app is imported and initialized once in the master process, then the workers are
+# forked from it: imported modules, the database bootstrap and the snapshot are shared
+# copy-on-write instead of being rebuilt by every worker. Results are shared through the
+# SQLite result cache (see cache.py), so adding workers adds no cold-cache work.
+wsgi_app        = "app:server"
+bind            = f"0.0.0.0:{os.environ.get('PORT', 8050)}"
+workers         = int(os.environ.get("WEB_CONCURRENCY", 2))
+preload_app     = True
+
+
+def on_starting(server):
+    import app
+
+    # the database, snapshot and cache are prepared in a child process: the master must not
+    # run any Polars code, whose thread pool would be missing in the forked workers
+    subprocess.run([sys.executable, app.__file__, "init"], check=True)
+    app.initialize(build=False)
+
+    # modules the app imports lazily are imported once here instead of by every worker
+    for module in ("pandas", "plotly.graph_objects"):
+        importlib.import_module(module)
+
+    # objects of the master are moved out of the collector's reach, so collections in
+    # the workers do not write to, and copy, the memory pages they share with the master
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import logs
+
+    # the log writer thread of the master is not running in the forked worker
+    logs.configure()
@@ -0,0 +1,329 @@
+import os
+import hmac
+import json
+import time
+import sqlite3
+import polars as pl
+import database as db
+import meter_validation
+import writer
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Batch ingest over HTTP for the truck-side app.
+#
+#   POST /api/ingest/delivery       a JSON array of records, {"records": [...]}, or NDJSON
+#   POST /api/ingest/restock        (one record per line, Content-Type application/x-ndjson)
+#
+# Records hold the columns of db_table_columns, the table key may be left out and is then
+# derived like the report forms do. Every record is validated in one vectorized pass and
+# the accepted ones are written as one submission of the group-commit writer. Deliveries
+# failing the meter reading checks of meter_validation.py are quarantined instead. Posting a
+# batch again is harmless: stored deliveries are reported as "exists", restocks are updated.
+# A stored restock given another restock_date or transport is reported as "moved", with the
+# day and transport it left in the reason, and logged, so the change can be audited.
+#
+#   GMERCHANT_INGEST_TOKEN      required in X-Ingest-Token or ?token=, the routes answer 404 without it
+max_records         = 50_000
+
+# fields that must parse as numbers, and fields that may be left empty: the readings of a
+# delivery may be null, as in the reports (see report_parser.delivery_report_fields)
+numeric_columns     = {
+    "delivery"  : db.delivery_numeric_columns,
+    "restock"   : ["restock_volume"],
+}
+optional_columns    = {
+    "delivery"  : {"delivery_id", "delivery_route", *db.delivery_numeric_columns},
+    "restock"   : {"restock_id", "gas_station_address"},
+}
+
+logger              = logs.get_logger("ingest")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def parse_body(body, content_type=""):
+    """
+    Decodes a request body into a list of records.
+
+    Raises:
+        ValueError: The body is neither a JSON array, a {"records": [...]} object nor NDJSON.
+    """
+
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    try:
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        # NDJSON sent without its content type
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    if isinstance(payload, dict):
+        payload = payload.get("records")
+    if not isinstance(payload, list):
+        raise ValueError("expected a JSON array of records, {\"records\": [...]} or NDJSON")
+    return payload
+
+
+def records_to_frame(table_name, records):
+    """
+    Lays records out as a text frame with one column per table column, a 1-based
+    "record" number and the first structural error of every record in "reason".
+    """
+
+    columns  = db.db_table_columns[table_name]
+    known    = set(columns)
+    required = [column for column in columns if column not in optional_columns[table_name]]
+    values   = {column: [] for column in columns}
+    reasons  = []
+
+    for record in records:
+        reason = None
+        if not isinstance(record, dict):
+            reason, record = "record is not an object", {}
+        else:
+            unknown = [key for key in record if key not in known]
+            missing = [column for column in required if record.get(column) in (None, "")]
+            if unknown:
+                reason = f"unknown field {unknown[0]}"
+            elif missing:
+                reason = f"missing {missing[0]}"
+        reasons.append(reason)
+        for column in columns:
+            value = record.get(column)
+            values[column].append(None if value in (None, "") else str(value))
+
+    frame = pl.DataFrame(values, schema={column: pl.Utf8 for column in columns})
+    return frame.with_columns(pl.Series("reason", reasons, dtype=pl.Utf8)).with_row_index("record", offset=1)
+
+
+def invalid_expr(condition, reason):
+    """
+    Sets reason on the rows of a still valid record where condition holds.
+    """
+    return (
+        pl.when(pl.col("reason").is_null() & condition)
+        .then(pl.lit(reason))
+        .otherwise(pl.col("reason"))
+        .alias("reason")
+    )
+
+
+def existing_keys(db_file, table_name, keys):
+    """
+    Returns the subset of keys already stored in table_name, using a single indexed query.
+    """
+    keys = [key for key in keys if key]
+    if not keys:
+        return set()
+
+    key_column = db.db_table_keys[table_name]
+    rows       = db.query_table(
+        db_file,
+        f"SELECT {key_column} FROM {table_name} WHERE {key_column} IN (SELECT value FROM json_each(?))",
+        (json.dumps(keys),),
+    )
+    return {row[0] for row in rows}
+
+
+def stored_restocks(db_file, restock_ids):
+    """
+    Returns the stored restock_date (as a date) and transport_plate_number of restock_ids,
+    prefixed "stored_", in one indexed query.
+    """
+    rows = db.query_table(db_file, """
+        SELECT restock_id, substr(restock_date, 1, 10), transport_plate_number FROM restock
+        WHERE restock_id IN (SELECT value FROM json_each(?))
+    """, (json.dumps([restock_id for restock_id in restock_ids if restock_id]),))
+
+    return pl.DataFrame(
+        rows, orient="row",
+        schema={"restock_id": pl.Utf8, "stored_restock_date": pl.Utf8, "stored_transport_plate_number": pl.Utf8},
+    ).with_columns(pl.col("stored_restock_date").str.to_date(db.date_format, strict=False))
+
+
+def validate(db_file, table_name, records):
+    """
+    Validates a batch of records in one vectorized pass.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): "delivery" or "restock".
+        records (list): Decoded records, see parse_body.
+
+    Returns:
+        pl.DataFrame: The typed table columns with "record", "status" and "reason". status is
+                      "inserted", "updated" (a stored restock, restocks are upserted), "moved" (a
+                      stored restock given another restock_date or transport, upserted too),
+                      "exists" (a stored delivery, left as it is), "superseded" (by a later record
+                      of the batch), "quarantined" (a delivery failing the meter reading checks)
+                      or "rejected".
+    """
+
+    key_column = db.db_table_keys[table_name]
+    df         = records_to_frame(table_name, records)
+
+    # a number that fails to parse is null after the cast while its text was not
+    for column in numeric_columns[table_name]:
+        df = df.with_columns(invalid_expr(
+            pl.col(column).is_not_null() & pl.col(column).cast(pl.Float64, strict=False).is_null(), f"invalid {column}"
+        ))
+    df = df.with_columns([pl.col(column).cast(pl.Float64, strict=False) for column in numeric_columns[table_name]])
+
+    if table_name == "delivery":
+        df = df.with_columns(
+            pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format, strict=False).alias("arrival")
+        ).with_columns(
+            invalid_expr(pl.col("arrival").is_null(), "invalid arrival_timestamp")
+        ).with_columns(
+            pl.coalesce(pl.col("delivery_id"), db.delivery_id_expr()).alias("delivery_id")
+        )
+    else:
+        df = df.with_columns(
+            pl.col("restock_date").str.to_date(db.date_format, strict=False).alias("date")
+        ).with_columns([
+            invalid_expr(pl.col("date").is_null(), "invalid restock_date"),
+        ]).with_columns([
+            invalid_expr(pl.col("restock_volume") <= 0, "invalid restock_volume"),
+            pl.coalesce(pl.col("restock_id"), db.restock_id_expr(date="date")).alias("restock_id"),
+        ])
+
+    stored     = list(existing_keys(db_file, table_name, df.filter(pl.col("reason").is_null())[key_column].to_list()))
+    valid_expr = pl.col("reason").is_null()
+
+    if table_name == "delivery":
+        # a delivery is never overwritten: a stored one is acknowledged, a repeat in the batch rejected
+        df = df.with_columns(
+            pl.when(~valid_expr).then(pl.lit("rejected"))
+            .when(pl.col(key_column).is_in(stored)).then(pl.lit("exists"))
+            .when(~pl.col(key_column).is_first_distinct().over(valid_expr)).then(pl.lit("rejected"))
+            .otherwise(pl.lit("inserted"))
+            .alias("status")
+        ).with_columns(
+            pl.when((pl.col("status") == "rejected") & valid_expr)
+            .then(pl.lit("duplicate delivery_id in batch"))
+            .otherwise(pl.col("reason"))
+            .alias("reason")
+        )
+
+        df = meter_validation.screen(db_file, df, pl.col("status") == "inserted").with_columns([
+            pl.when(pl.col("check_name").is_not_null()).then(pl.lit("quarantined")).otherwise(pl.col("status")).alias("status"),
+            pl.coalesce(pl.col("check_reason"), pl.col("reason")).alias("reason"),
+        ])
+    else:
+        # restocks resolve to the last record of a key, as in generate_restock_rowreps
+        moved = (
+            (pl.col("date") != pl.col("stored_restock_date"))
+            | (pl.col("transport_plate_number") != pl.col("stored_transport_plate_number"))
+        )
+        df = df.join(stored_restocks(db_file, stored), on="restock_id", how="left").with_columns(
+            pl.when(~valid_expr).then(pl.lit("rejected"))
+            .when(~pl.col(key_column).is_last_distinct().over(valid_expr)).then(pl.lit("superseded"))
+            .when(pl.col(key_column).is_in(stored) & moved).then(pl.lit("moved"))
+            .when(pl.col(key_column).is_in(stored)).then(pl.lit("updated"))
+            .otherwise(pl.lit("inserted"))
+            .alias("status")
+        ).with_columns(
+            pl.when(pl.col("status") == "moved")
+            .then(pl.format("moved from {} {}", pl.col("stored_transport_plate_number"), pl.col("stored_restock_date").dt.strftime(db.date_format)))
+            .otherwise(pl.col("reason"))
+            .alias("reason")
+        )
+
+    return df
+
+
+def ingest(db_file, table_name, records):
+    """
+    Validates a batch of records and writes the valid ones in one all-or-nothing submission.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): "delivery" or "restock".
+        records (list): Decoded records, see parse_body.
+
+    Returns:
+        dict: {"table", "received", "written", "quarantined", "rejected", "moved", "seconds", "records"}, records holding
+              one {"record", <table key>, "status", "reason"} dictionary per record, in input order.
+    """
+
+    start      = time.perf_counter()
+    key_column = db.db_table_keys[table_name]
+    upsert     = table_name == "restock"
+
+    def accepted(df):
+        return df.filter(pl.col("status").is_in(["inserted", "updated", "moved"])).select(db.db_table_columns[table_name]).to_dicts()
+
+    def write(df):
+        if table_name == "delivery":
+            meter_validation.quarantine(db_file, df.filter(pl.col("status") == "quarantined"))
+        return writer.write(db_file, table_name, accepted(df), upsert=upsert)
+
+    df = validate(db_file, table_name, records)
+    try:
+        ack = write(df)
+    except sqlite3.IntegrityError:
+        # a concurrent batch stored some of the same deliveries since the validation
+        df  = validate(db_file, table_name, records)
+        ack = write(df)
+
+    result = {
+        "table"         : table_name,
+        "received"      : df.height,
+        "written"       : ack["rows"],
+        "quarantined"   : df.filter(pl.col("status") == "quarantined").height,
+        "rejected"      : df.filter(pl.col("status") == "rejected").height,
+        "moved"         : df.filter(pl.col("status") == "moved").height,
+        "seconds"       : round(time.perf_counter() - start, 4),
+        "records"       : df.select(["record", key_column, "status", "reason"]).to_dicts(),
+    }
+    logger.info("batch ingested", extra={k: result[k] for k in ("table", "received", "written", "quarantined", "rejected", "moved", "seconds")})
+    if result["moved"]:
+        moved = df.filter(pl.col("status") == "moved").select([key_column, "restock_date", "transport_plate_number", "reason"])
+        logger.warning("restocks moved", extra={"table": table_name, "restocks": moved.to_dicts()})
+    return result
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def instrument_server(server):
+    """
+    Adds the ingest URLs to a Flask server:
+
+        POST /api/ingest/delivery
+        POST /api/ingest/restock
+
+    The routes answer 404 unless GMERCHANT_INGEST_TOKEN is set, and 403 without the token.
+    A body that does not decode answers 400, more than max_records records 413.
+    """
+
+    import flask
+
+    def authorized():
+        token = os.environ.get("GMERCHANT_INGEST_TOKEN")
+        if not token:
+            flask.abort(404)
+        given = flask.request.args.get("token") or flask.request.headers.get("X-Ingest-Token", "")
+        if not hmac.compare_digest(given, token):
+            flask.abort(403)
+
+    @server.route("/api/ingest/<table_name>", methods=["POST"])
+    def ingest_batch(table_name):
+        authorized()
+        if table_name not in numeric_columns:
+            flask.abort(404)
+
+        try:
+            records = parse_body(flask.request.get_data(), flask.request.content_type or "")
+        except (ValueError, UnicodeDecodeError) as e:
+            return flask.jsonify({"error": str(e)}), 400
+        if len(records) > max_records:
+            return flask.jsonify({"error": f"at most {max_records} records per batch"}), 413
+
+        try:
+            return flask.jsonify(ingest(db.database_file, table_name, records))
+        except sqlite3.Error as e:
+            logger.error("batch ingest failed", extra={"table": table_name, "records": len(records), "error": str(e)})
+            return flask.jsonify({"error": str(e)}), 503
@@ -1,9 +1,8 @@
-import openpyxl
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from openpyxl.drawing.image import Image
 from datetime import datetime
 import os
-import pandas as pd
+import logs
+
+logger = logs.get_logger("invoice_layout_generator")
 
 
 
@@ -237,5 +236,5 @@ def generate_invoice(writer, invoice_data):
     
     worksheet.write('G1', "", normal_format)
 
-    print(f"Invoice generated")
+    logger.info("invoice generated", extra={"invoice_number": invoice_data.get("invoice_number"), "customer_id": invoice_data.get("customer_id")})
 
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Structured, level-gated logging for every module of the app.
+#
+#   GMERCHANT_LOG_LEVEL     DEBUG, INFO (default), WARNING, ...
+#   GMERCHANT_LOG_SAMPLE    fraction of records below WARNING that are kept, 1.0 by default
+#   GMERCHANT_LOG_FORMAT    json (default), one object per line, or text
+#
+# Records are handed to a queue and written by a listener thread, so a request never
+# waits on the log stream. Disabled levels cost one isEnabledFor check.
+ROOT_LOGGER     = "gmerchant"
+
+# attributes every LogRecord has, anything else was passed through extra=
+RECORD_FIELDS   = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+listener        = None
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def record_extras(record):
+    return {key: value for key, value in vars(record).items() if key not in RECORD_FIELDS}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below a level, and every record at or above it.
+    """
+    def __init__(self, rate, below=logging.WARNING):
+        super().__init__()
+        self.rate  = rate
+        self.below = below
+
+    def filter(self, record):
+        return record.levelno >= self.below or self.rate >= 1.0 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object, with the extra= fields as top-level keys.
+    """
+    def format(self, record):
+        entry = {
+            "time"      : self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level"     : record.levelname,
+            "logger"    : record.name,
+            "message"   : record.getMessage(),
+        }
+        entry.update(record_extras(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats a record as a line of text, followed by its extra= fields as key=value pairs.
+    """
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+    def format(self, record):
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+        line           = self.formatMessage(record)
+
+        extras = " ".join(f"{key}={value}" for key, value in record_extras(record).items())
+        if extras:
+            line += f" {extras}"
+
+        exception = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exception:
+            line += f"\n{exception}"
+        return line
+
+
+class PreparedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the record unformatted, so the listener's formatter
+    still sees the message arguments and extra= fields.
+    """
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg     = record.message
+        record.args    = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(level=None, sample_rate=None, fmt=None, stream=None):
+    """
+    Routes the gmerchant loggers through a queue to a stream, replacing an earlier configuration.
+
+    Args:
+        level (str): Minimum level, GMERCHANT_LOG_LEVEL or INFO when None.
+        sample_rate (float): Fraction of records below WARNING kept, GMERCHANT_LOG_SAMPLE or 1.0 when None.
+        fmt (str): "json" or "text", GMERCHANT_LOG_FORMAT or json when None.
+        stream: Where records are written, stderr when None.
+    """
+
+    global listener
+
+    level       = (level or os.environ.get("GMERCHANT_LOG_LEVEL", "INFO")).upper()
+    sample_rate = float(sample_rate if sample_rate is not None else os.environ.get("GMERCHANT_LOG_SAMPLE", 1.0))
+    fmt         = fmt or os.environ.get("GMERCHANT_LOG_FORMAT", "json")
+
+    shutdown()
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+
+    records       = queue.SimpleQueue()
+    queue_handler = PreparedQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.handlers.clear()
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+
+def shutdown():
+    """
+    Writes out the queued records and stops the listener thread.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,505 @@
+import sys
+import json
+import argparse
+import polars as pl
+import database as db
+import gas_correction
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Per-truck mass balance: python mass_balance.py [--plate R4J1N]
+#
+# Every transport carries what it restocks to its customers. Its running balance is
+#
+#   balance = restocked - charged - expected_loss,      expected_loss = loss_rate * charged
+#
+# i.e. the gas the transport should still carry, plus whatever went missing. Two tables are
+# kept up to date after every write, so the balance is never recomputed from the raw tables:
+#
+#   delivery_balance    one row per delivery: its charged volume (as in the charge table, the
+#                       corrected stand meter difference to the customer's previous delivery)
+#                       and the volume its buffer pressures say left the transport
+#   truck_ledger        one row per transport and day with restocks and deliveries
+#
+# A delivery or customer write recomputes the delivery_balance rows of the customers written
+# and keeps those that changed, a restock write none. Only the ledger days holding a changed
+# row or restock are then re-aggregated, with one indexed GROUP BY, plus after a restock
+# write the days whose restocks no longer match the restock table (a restock upserted to
+# another day or transport). The alerts are rolling sums over the ledger of all transports
+# at once, window_days long:
+#
+#   unaccounted     restocked - charged - expected_loss above unaccounted_fraction of the
+#                   restocked volume, over windows holding min_restocks restocks, so the load
+#                   carried across the window bounds is small against the volume restocked
+#   transfer_loss   buffer volume out - charged above transfer_fraction of the volume out:
+#                   gas leaving the transport without reaching the customer's meter
+DELIVERY_BALANCE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS delivery_balance (
+        delivery_id             TEXT PRIMARY KEY,
+        customer_id             TEXT,
+        transport_plate_number  TEXT,
+        date                    TEXT,
+        charged_volume          REAL,
+        est_volume_out          REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_delivery_balance_customer ON delivery_balance (customer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_delivery_balance_transport ON delivery_balance (transport_plate_number, date)",
+)
+TRUCK_LEDGER_SCHEMA     = """
+CREATE TABLE IF NOT EXISTS truck_ledger (
+    transport_plate_number  TEXT NOT NULL,
+    date                    TEXT NOT NULL,
+    restocks                INTEGER NOT NULL,
+    restocked_volume        REAL NOT NULL,
+    deliveries              INTEGER NOT NULL,
+    charged_volume          REAL NOT NULL,
+    est_volume_out          REAL NOT NULL,
+    PRIMARY KEY (transport_plate_number, date)
+)
+"""
+DELIVERY_BALANCE_COLUMNS = ["delivery_id", "customer_id", "transport_plate_number", "date", "charged_volume", "est_volume_out"]
+TRUCK_LEDGER_COLUMNS    = ["transport_plate_number", "date", "restocks", "restocked_volume", "deliveries", "charged_volume", "est_volume_out"]
+
+loss_rate               = 0.02
+window_days             = 30
+min_restocks            = 3
+min_deliveries          = 5
+unaccounted_fraction    = 0.10
+transfer_fraction       = 0.10
+
+# databases whose tables are kept up to date by refresh_balances
+enabled_databases       = set()
+
+logger                  = logs.get_logger("mass_balance")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def delivery_balance_plan(db_file, customer_ids=None):
+    """
+    Builds the lazy plan of the delivery_balance rows of some or all customers.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_ids (list): Optional customers to compute, all when None.
+
+    Returns:
+        pl.LazyFrame: DELIVERY_BALANCE_COLUMNS.
+    """
+
+    if customer_ids is not None and len(customer_ids) == 1:
+        deliveries = db.scan_analytics(db_file, "delivery", {"customer_id": customer_ids[0]})
+    else:
+        deliveries = db.scan_analytics(db_file, "delivery")
+        if customer_ids is not None:
+            deliveries = deliveries.filter(pl.col("customer_id").is_in(customer_ids))
+
+    customer = (db.scan_analytics(db_file, "customer")
+        .select([
+            pl.col("customer_id"),
+            pl.col("liter_weight_capacity").cast(pl.Float64, strict=False),
+        ])
+        .unique("customer_id", keep="last", maintain_order=True)
+    )
+
+    return (deliveries
+        .select([
+            pl.col("delivery_id"),
+            pl.col("customer_id"),
+            pl.col("transport_plate_number"),
+            pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format).alias("arrival"),
+            pl.col("pre_buffer_pressure").cast(pl.Float64, strict=False),
+            pl.col("post_buffer_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_stand_meter").cast(pl.Float64, strict=False).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_temperature").cast(pl.Float64, strict=False),
+        ])
+        .join(customer, on="customer_id", how="left", maintain_order="left")
+        .sort(["customer_id", "arrival"], maintain_order=True)
+        .with_columns([
+            pl.col("std_meter_on_arrival").diff().over("customer_id").alias("std_meter_diff"),
+            # the same estimate as the tracker graph
+            ((pl.col("post_buffer_pressure") - pl.col("pre_buffer_pressure"))/200.0 * pl.col("liter_weight_capacity")/4).alias("est_volume_out"),
+        ])
+        .pipe(gas_correction.with_corrected_volume, "charged_volume")
+        .select([
+            pl.col("delivery_id"),
+            pl.col("customer_id"),
+            pl.col("transport_plate_number"),
+            pl.col("arrival").dt.strftime(db.date_format).alias("date"),
+            pl.col("charged_volume").fill_null(0),
+            pl.col("est_volume_out").fill_null(0),
+        ])
+    )
+
+
+def write_delivery_balance(conn, frame, customer_ids=None):
+    """
+    Replaces the delivery_balance rows of customer_ids, or all of them, within the caller's
+    transaction. Of the rows of customer_ids, only those that changed are written: a new
+    delivery changes its own row and the next one of its customer, the others come out equal.
+
+    Returns:
+        pl.DataFrame: transport_plate_number and date of the rows removed, added or changed,
+                      None when all rows were replaced.
+    """
+
+    insert = (
+        f"INSERT OR REPLACE INTO delivery_balance ({', '.join(DELIVERY_BALANCE_COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in DELIVERY_BALANCE_COLUMNS)})"
+    )
+    if customer_ids is None:
+        conn.execute("DELETE FROM delivery_balance")
+        conn.executemany(insert, frame.rows())
+        return None
+
+    stored = pl.DataFrame(
+        conn.execute(
+            f"SELECT {', '.join(DELIVERY_BALANCE_COLUMNS)} FROM delivery_balance WHERE customer_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(customer_ids)),),
+        ).fetchall(),
+        schema=frame.schema, orient="row",
+    )
+    removed = stored.join(frame, on=DELIVERY_BALANCE_COLUMNS, how="anti", nulls_equal=True)
+    added   = frame.join(stored, on=DELIVERY_BALANCE_COLUMNS, how="anti", nulls_equal=True)
+
+    conn.execute(
+        "DELETE FROM delivery_balance WHERE delivery_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(removed["delivery_id"].to_list()),),
+    )
+    conn.executemany(insert, added.rows())
+    return pl.concat([removed, added]).select(["transport_plate_number", "date"])
+
+
+def restock_plan(db_file, plates=None):
+    """
+    Builds the lazy plan of the restocks per transport and day. Restocks are read from SQLite,
+    not from the snapshot: the ledger is reconciled against them (see stale_restock_days).
+
+    Returns:
+        pl.LazyFrame: transport_plate_number, date (YYYY-MM-DD), restocks and restocked_volume.
+    """
+
+    if plates is None:
+        restocks = db.scan_table(db_file, "restock")
+    else:
+        restocks = db.scan_table(db_file, "restock", "transport_plate_number IN (SELECT value FROM json_each(?))", (json.dumps(list(plates)),))
+
+    return (restocks
+        .select([
+            pl.col("transport_plate_number"),
+            db.stored_date_expr("restock_date").dt.strftime(db.date_format).alias("date"),
+            pl.col("restock_volume").cast(pl.Float64, strict=False).fill_null(0),
+        ])
+        .group_by(["transport_plate_number", "date"])
+        .agg([
+            pl.len().alias("restocks"),
+            pl.col("restock_volume").sum().alias("restocked_volume"),
+        ])
+    )
+
+
+def write_ledger(conn, db_file, days=None):
+    """
+    Re-aggregates the truck_ledger rows of some or all days within the caller's transaction.
+
+    Args:
+        conn (sqlite3.Connection): The connection holding the transaction.
+        db_file (str): The path to the SQLite database file.
+        days (pl.DataFrame): transport_plate_number and date of the rows, all when None.
+    """
+
+    if days is None:
+        where, params = "", ()
+    else:
+        days   = days.drop_nulls().unique()
+        where  = """
+            WHERE (transport_plate_number, date) IN (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+            )
+        """
+        params = (json.dumps(days.rows()),)
+
+    rows = conn.execute(f"""
+        SELECT transport_plate_number, date, COUNT(*), SUM(charged_volume), SUM(est_volume_out)
+        FROM delivery_balance {where}
+        GROUP BY transport_plate_number, date
+    """, params).fetchall()
+
+    deliveries = pl.DataFrame(
+        rows, orient="row",
+        schema={"transport_plate_number": pl.Utf8, "date": pl.Utf8, "deliveries": pl.Int64, "charged_volume": pl.Float64, "est_volume_out": pl.Float64},
+    )
+    restocks   = restock_plan(db_file, None if days is None else days["transport_plate_number"].unique().to_list()).collect()
+    if days is not None:
+        restocks = restocks.join(days, on=["transport_plate_number", "date"], how="semi")
+
+    ledger = (restocks
+        .join(deliveries, on=["transport_plate_number", "date"], how="full", coalesce=True)
+        .filter(pl.col("transport_plate_number").is_not_null())
+        .with_columns([pl.col(column).fill_null(0) for column in TRUCK_LEDGER_COLUMNS[2:]])
+        .select(TRUCK_LEDGER_COLUMNS)
+    )
+
+    conn.execute(f"DELETE FROM truck_ledger {where}", params)
+    conn.executemany(
+        f"INSERT INTO truck_ledger ({', '.join(TRUCK_LEDGER_COLUMNS)}) VALUES ({', '.join('?' for _ in TRUCK_LEDGER_COLUMNS)})",
+        ledger.rows(),
+    )
+
+
+def stale_restock_days(db_file, plates):
+    """
+    Returns the ledger days whose restocks no longer match the restock table, e.g. the day a
+    restock was upserted away from. Days are compared for plates and for the transports whose
+    restock totals changed, the only ones a restock can have left.
+
+    Returns:
+        pl.DataFrame: transport_plate_number and date of the days.
+    """
+
+    totals = db.query_table(db_file, """
+        SELECT transport_plate_number FROM (
+            SELECT transport_plate_number, SUM(restocks) AS restocks, SUM(restocked_volume) AS volume
+            FROM truck_ledger WHERE restocks > 0 GROUP BY transport_plate_number
+        ) AS ledger
+        LEFT JOIN (
+            SELECT transport_plate_number, COUNT(*) AS restocks, TOTAL(CAST(restock_volume AS REAL)) AS volume
+            FROM restock GROUP BY transport_plate_number
+        ) AS current USING (transport_plate_number)
+        WHERE current.restocks IS NOT ledger.restocks OR ABS(current.volume - ledger.volume) > 1e-6
+    """)
+    plates = sorted(set(plates) | {row[0] for row in totals})
+    if not plates:
+        return pl.DataFrame(schema={"transport_plate_number": pl.Utf8, "date": pl.Utf8})
+
+    rows   = db.query_table(db_file, """
+        SELECT transport_plate_number, date, restocks, restocked_volume FROM truck_ledger
+        WHERE restocks > 0 AND transport_plate_number IN (SELECT value FROM json_each(?))
+    """, (json.dumps(plates),))
+    stored = pl.DataFrame(
+        rows, orient="row",
+        schema={"transport_plate_number": pl.Utf8, "date": pl.Utf8, "restocks": pl.Int64, "restocked_volume": pl.Float64},
+    )
+
+    return (stored
+        .join(restock_plan(db_file, plates).collect(), on=["transport_plate_number", "date"], how="left", suffix="_now")
+        .filter(
+            pl.col("restocks_now").is_null()
+            | (pl.col("restocks") != pl.col("restocks_now"))
+            | ((pl.col("restocked_volume") - pl.col("restocked_volume_now")).abs() > 1e-6)
+        )
+        .select(["transport_plate_number", "date"])
+    )
+
+
+def refresh(db_file, customer_ids=None, days=None, rebuild=False):
+    """
+    Recomputes the delivery_balance rows of customer_ids, and the ledger days they change
+    or days lists, in one transaction. With rebuild, everything is recomputed.
+
+    Returns:
+        list: The plates whose ledger changed, None after a rebuild.
+    """
+
+    frame = None
+    if rebuild or customer_ids:
+        frame = delivery_balance_plan(db_file, None if rebuild else customer_ids).collect()
+
+    conn = db.connect(db_file)
+    try:
+        if rebuild:
+            write_delivery_balance(conn, frame)
+            write_ledger(conn, db_file)
+        else:
+            changed = [days] if days is not None else []
+            if customer_ids:
+                changed.append(write_delivery_balance(conn, frame, customer_ids))
+            days = pl.concat(changed)
+            write_ledger(conn, db_file, days)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return None if rebuild else sorted(days["transport_plate_number"].drop_nulls().unique())
+
+
+def refresh_balances(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) updating the balances touched by a
+    delivery, customer or restock write, and logging the alerts of their transports. The
+    transports whose ledger changed are passed on to the listeners as a truck_ledger write.
+    """
+
+    if db_file not in enabled_databases or table_name not in ("delivery", "customer", "restock"):
+        return
+
+    customer_ids, days = None, None
+    if table_name == "restock":
+        days = pl.DataFrame(
+            [(row["transport_plate_number"], str(row["restock_date"])[:10]) for row in rows if row.get("transport_plate_number")],
+            schema={"transport_plate_number": pl.Utf8, "date": pl.Utf8}, orient="row",
+        )
+        # an upsert may move a restock to another day or transport, which its row does not tell
+        days = pl.concat([days, stale_restock_days(db_file, days["transport_plate_number"].unique().to_list())])
+        if days.is_empty():
+            return
+    else:
+        customer_ids = sorted({row["customer_id"] for row in rows if row.get("customer_id") is not None})
+        if not customer_ids:
+            return
+
+    touched = refresh(db_file, customer_ids, days)
+    if touched:
+        # the tables derived from the ledger (see restock_forecast.py) listen to its writes
+        db.notify_write(db_file, "truck_ledger", [{"transport_plate_number": plate} for plate in touched])
+        for alert in alerts(db_file, touched).to_dicts():
+            logger.warning("mass balance alert", extra=alert)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def ledger(db_file, plates=None):
+    """
+    Reads the ledger of some or all transports with their running balance.
+
+    Returns:
+        pl.DataFrame: TRUCK_LEDGER_COLUMNS with date as a date, expected_loss and balance,
+                      sorted by transport and date.
+    """
+
+    where  = "" if plates is None else "WHERE transport_plate_number IN (SELECT value FROM json_each(?))"
+    params = () if plates is None else (json.dumps(list(plates)),)
+    rows   = db.query_table(db_file, f"SELECT {', '.join(TRUCK_LEDGER_COLUMNS)} FROM truck_ledger {where}", params)
+
+    schema = {column: pl.Float64 for column in TRUCK_LEDGER_COLUMNS}
+    schema.update({"transport_plate_number": pl.Utf8, "date": pl.Utf8, "restocks": pl.Int64, "deliveries": pl.Int64})
+
+    return (pl.DataFrame(rows, schema=schema, orient="row")
+        .with_columns([
+            pl.col("date").str.to_date(db.date_format),
+            (pl.col("charged_volume") * loss_rate).alias("expected_loss"),
+        ])
+        .sort(["transport_plate_number", "date"])
+        .with_columns(
+            (pl.col("restocked_volume") - pl.col("charged_volume") - pl.col("expected_loss"))
+            .cum_sum().over("transport_plate_number").alias("balance")
+        )
+    )
+
+
+def windows(frame):
+    """
+    Adds the window_days rolling sums of a ledger and the alerts they raise, per transport.
+    """
+
+    def rolling(column):
+        return pl.col(column).rolling_sum_by("date", window_size=f"{window_days}d").over("transport_plate_number")
+
+    unaccounted = pl.col("window_restocked") - pl.col("window_charged") * (1 + loss_rate)
+    transfer    = pl.col("window_volume_out") - pl.col("window_charged")
+
+    return (frame
+        .with_columns([
+            rolling("restocks").alias("window_restocks"),
+            rolling("restocked_volume").alias("window_restocked"),
+            rolling("deliveries").alias("window_deliveries"),
+            rolling("charged_volume").alias("window_charged"),
+            rolling("est_volume_out").alias("window_volume_out"),
+        ])
+        .with_columns([
+            unaccounted.alias("unaccounted_volume"),
+            transfer.alias("transfer_loss_volume"),
+            ((pl.col("window_restocks") >= min_restocks)
+             & (unaccounted > unaccounted_fraction * pl.col("window_restocked"))).alias("unaccounted_alert"),
+            ((pl.col("window_deliveries") >= min_deliveries)
+             & (transfer > transfer_fraction * pl.col("window_volume_out"))).alias("transfer_loss_alert"),
+        ])
+    )
+
+
+def alerts(db_file, plates=None, history=False):
+    """
+    Evaluates the alerts of the module header over the ledger of all (or some) transports at once.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        plates (list): Optional transports to evaluate, all when None.
+        history (bool): Return every alerting day, instead of the alerts of each transport's last day.
+
+    Returns:
+        pl.DataFrame: transport_plate_number, date, alert ("unaccounted" or "transfer_loss"),
+                      volume and the window sums.
+    """
+
+    frame = windows(ledger(db_file, plates))
+    if not history:
+        frame = frame.filter(pl.col("date") == pl.col("date").max().over("transport_plate_number"))
+
+    columns = ["transport_plate_number", "date", "window_restocked", "window_charged", "window_volume_out"]
+    return pl.concat([
+        frame.filter(pl.col("unaccounted_alert")).select(columns + [pl.lit("unaccounted").alias("alert"), pl.col("unaccounted_volume").alias("volume")]),
+        frame.filter(pl.col("transfer_loss_alert")).select(columns + [pl.lit("transfer_loss").alias("alert"), pl.col("transfer_loss_volume").alias("volume")]),
+    ]).sort(["transport_plate_number", "date", "alert"])
+
+
+def balances(db_file):
+    """
+    Returns the last ledger day of every transport with its running balance and window sums.
+    """
+    return (windows(ledger(db_file))
+        .filter(pl.col("date") == pl.col("date").max().over("transport_plate_number"))
+        .select(["transport_plate_number", "date", "balance", "window_restocked", "window_charged",
+                 "unaccounted_volume", "transfer_loss_volume"])
+    )
+
+
+def enable(db_file, rebuild=True):
+    """
+    Keeps the delivery_balance and truck_ledger tables of db_file up to date after writes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        rebuild (bool): Recompute both tables first, needed when writes reached the
+                        database without this module listening.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        for statement in DELIVERY_BALANCE_SCHEMA + (TRUCK_LEDGER_SCHEMA,):
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if rebuild:
+        refresh(db_file, rebuild=True)
+        logger.info("mass balance built", extra={"db_file": db_file})
+
+    enabled_databases.add(db_file)
+    if refresh_balances not in db.write_listeners:
+        db.write_listeners.append(refresh_balances)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python mass_balance.py", description="Per-transport mass balances and loss alerts.")
+    parser.add_argument("--plate", action="append", help="a transport to show, all by default")
+    parser.add_argument("--history", action="store_true", help="every alerting day, not only the last one")
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    enable(args.db)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(balances(args.db).filter(pl.col("transport_plate_number").is_in(args.plate) if args.plate else pl.lit(True)))
+        print(alerts(args.db, args.plate, history=args.history))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+import sys
+import json
+import argparse
+import datetime
+import polars as pl
+import database as db
+import writer
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Meter reading validation of incoming deliveries.
+#
+# delivery_stand_meter is cumulative, the charged volume of a delivery is its difference with
+# the customer's previous reading. Before a batch of deliveries is written, every reading is
+# checked against the previous one of its customer: within the batch, or for the first one of
+# a customer the last stored reading before it, fetched for all customers of the batch with a
+# single query seeking idx_delivery_customer_arrival. A reading is flagged as
+#
+#   regression      lower than the previous reading
+#   rollover        lower, but the previous one near meter_capacity and this one near zero
+#   jump            more than max_delivery_volume above the previous reading
+#   outlier         a pressure or temperature outside its limits
+#
+# Flagged deliveries are not written but kept in delivery_quarantine for review, and never
+# count as a previous reading: the reading after a mistyped one is compared with the last
+# good one. Review them with
+#
+#   python meter_validation.py list
+#   python meter_validation.py release <quarantine_id> ...     writes them to delivery as they are
+#   python meter_validation.py discard <quarantine_id> ...
+QUARANTINE_SCHEMA       = (
+    f"""
+    CREATE TABLE IF NOT EXISTS delivery_quarantine (
+        quarantine_id           INTEGER PRIMARY KEY,
+        {", ".join(f"{column} TEXT" for column in db.db_table_columns["delivery"])},
+        check_name              TEXT NOT NULL,
+        reason                  TEXT NOT NULL,
+        previous_stand_meter    REAL,
+        quarantined_at          TEXT NOT NULL,
+        review                  TEXT NOT NULL DEFAULT 'pending',
+        reviewed_at             TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_delivery_quarantine_review ON delivery_quarantine (review, delivery_id)",
+)
+
+# (low, high) of the plausible readings, inclusive
+limits                  = {
+    "delivery_pressure"         : (0.0, 25.0),
+    "delivery_temperature"      : (-20.0, 60.0),
+    "pre_buffer_pressure"       : (0.0, 300.0),
+    "post_buffer_pressure"      : (0.0, 300.0),
+    "transport_bank_pressure"   : (0.0, 300.0),
+}
+
+# stand meters wrap to zero past meter_capacity; a drop from the top rollover_margin of the
+# range into the bottom one is a rollover rather than a regression
+meter_capacity          = 100_000.0
+rollover_margin         = 0.1
+max_delivery_volume     = 5_000.0
+
+# a flag changes what the next reading is compared with, passes repeat until no flag changes
+max_passes              = 5
+
+logger                  = logs.get_logger("meter_validation")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def enable(db_file):
+    """
+    Creates the delivery_quarantine table and the index the previous readings are looked up with.
+    """
+    conn = db.connect(db_file)
+    try:
+        for statement in QUARANTINE_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+    db.create_keyset_indexes(db_file)
+
+
+def last_readings(db_file, firsts):
+    """
+    Fetches the last stored reading of every customer before its first delivery in a batch.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        firsts (pl.DataFrame): customer_id and arrival_timestamp, one row per customer.
+
+    Returns:
+        pl.DataFrame: customer_id and stored_stand_meter, for the customers with a stored reading.
+    """
+
+    query = """
+        WITH batch (customer_id, arrival_timestamp) AS (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+        )
+        SELECT batch.customer_id, CAST(delivery.delivery_stand_meter AS REAL)
+        FROM batch JOIN delivery ON delivery.rowid = (
+            SELECT rowid FROM delivery
+            WHERE customer_id = batch.customer_id AND arrival_timestamp < batch.arrival_timestamp
+              AND delivery_stand_meter IS NOT NULL AND delivery_stand_meter != ''
+            ORDER BY arrival_timestamp DESC
+            LIMIT 1
+        )
+    """
+    pairs = json.dumps(firsts.select(["customer_id", "arrival_timestamp"]).rows())
+    rows  = db.query_table(db_file, query, (pairs,))
+    return pl.DataFrame(rows, schema={"customer_id": pl.Utf8, "stored_stand_meter": pl.Float64}, orient="row")
+
+
+def outlier_expr():
+    """
+    Returns the first reading outside its limits as a reason, null when all are within.
+    """
+    return pl.coalesce([
+        pl.when(~pl.col(column).is_between(low, high))
+        .then(pl.format(f"{column} {{}} outside [{low:g}, {high:g}]", pl.col(column)))
+        for column, (low, high) in limits.items()
+    ])
+
+
+def sequence_exprs():
+    """
+    Returns the check_name and reason of the meter sequence checks against "previous_stand_meter".
+    """
+
+    meter    = pl.col("delivery_stand_meter")
+    previous = pl.col("previous_stand_meter")
+    volume   = meter - previous
+    rollover = (previous >= meter_capacity * (1 - rollover_margin)) & (meter <= meter_capacity * rollover_margin)
+
+    check = (
+        pl.when(volume < 0).then(pl.when(rollover).then(pl.lit("rollover")).otherwise(pl.lit("regression")))
+        .when(volume > max_delivery_volume).then(pl.lit("jump"))
+    )
+    reason = (
+        pl.when(volume < 0).then(pl.when(rollover)
+            .then(pl.format("stand meter rolled over from {} to {}", previous, meter))
+            .otherwise(pl.format("stand meter went back from {} to {}", previous, meter)))
+        .when(volume > max_delivery_volume).then(pl.format("stand meter jumped from {} to {}", previous, meter))
+    )
+    return check, reason
+
+
+def screen(db_file, df, candidate):
+    """
+    Runs the checks of the module header on a batch of deliveries in vectorized passes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        df (pl.DataFrame): Deliveries with customer_id, arrival_timestamp and the numeric
+                           columns as Float64.
+        candidate (pl.Expr): The rows to check, the others are left out of every comparison.
+
+    Returns:
+        pl.DataFrame: df with "check_name", "check_reason" (null for the rows passing or not
+                      checked) and "previous_stand_meter", in the same order.
+    """
+
+    df      = df.with_row_index("_row").with_columns(candidate.fill_null(False).alias("_candidate"))
+    checked = df.filter(pl.col("_candidate")).sort(["customer_id", "arrival_timestamp", "_row"])
+
+    firsts  = checked.group_by("customer_id", maintain_order=True).agg(pl.col("arrival_timestamp").first())
+    checked = checked.join(last_readings(db_file, firsts), on="customer_id", how="left").with_columns([
+        outlier_expr().alias("_outlier"),
+        pl.lit(None, dtype=pl.Utf8).alias("check_name"),
+    ])
+
+    check, reason = sequence_exprs()
+    for _ in range(max_passes):
+        # the previous good reading of the customer in the batch, else the stored one
+        previous = (
+            pl.when(pl.col("check_name").is_null()).then(pl.col("delivery_stand_meter"))
+            .shift(1).forward_fill().over("customer_id")
+            .fill_null(pl.col("stored_stand_meter"))
+        )
+        flagged = checked.with_columns(previous.alias("previous_stand_meter")).with_columns([
+            pl.when(pl.col("_outlier").is_not_null()).then(pl.lit("outlier")).otherwise(check).alias("check_name"),
+            pl.coalesce(pl.col("_outlier"), reason).alias("check_reason"),
+        ])
+        stable  = flagged["check_name"].eq_missing(checked["check_name"]).all()
+        checked = flagged
+        if stable:
+            break
+
+    columns = ["_row", "previous_stand_meter", "check_name", "check_reason"]
+    return (df
+        .join(checked.select(columns), on="_row", how="left")
+        .sort("_row")
+        .drop(["_row", "_candidate"])
+    )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def pending_delivery_ids(db_file, delivery_ids):
+    """
+    Returns the subset of delivery_ids waiting for review, using a single indexed query.
+    """
+    delivery_ids = [delivery_id for delivery_id in delivery_ids if delivery_id]
+    if not delivery_ids:
+        return set()
+
+    query = """
+        SELECT delivery_id FROM delivery_quarantine
+        WHERE review = 'pending' AND delivery_id IN (SELECT value FROM json_each(?))
+    """
+    return {row[0] for row in db.query_table(db_file, query, (json.dumps(delivery_ids),))}
+
+
+def quarantine(db_file, df):
+    """
+    Stores flagged deliveries for review, those already waiting for it are left as they are.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        df (pl.DataFrame): Flagged rows of screen, with the delivery columns.
+
+    Returns:
+        int: The number of rows stored.
+    """
+
+    pending = pending_delivery_ids(db_file, df["delivery_id"].to_list())
+    now     = datetime.datetime.now().strftime(db.timestamp_format)
+    rows    = (df
+        .filter(~pl.col("delivery_id").is_in(list(pending)) & pl.col("delivery_id").is_first_distinct())
+        .select(
+            [pl.col(column).cast(pl.Utf8) for column in db.db_table_columns["delivery"]]
+            + [pl.col("check_name"), pl.col("check_reason").alias("reason"), pl.col("previous_stand_meter"),
+               pl.lit(now).alias("quarantined_at")]
+        )
+        .to_dicts()
+    )
+    if not rows:
+        return 0
+
+    written = writer.write(db_file, "delivery_quarantine", rows)["rows"]
+    logger.warning("deliveries quarantined", extra={"rows": written, "checks": dict(df["check_name"].value_counts().rows())})
+    return written
+
+
+def screen_rowreps(db_file, rowreps, summary):
+    """
+    Applies the stage to the output of database.generate_delivery_rowreps, quarantining the
+    flagged rows.
+
+    Returns:
+        tuple: (rowreps, summary), without the flagged rows and with their summary status
+               set to "quarantined".
+    """
+
+    if not rowreps:
+        return rowreps, summary
+
+    schema = {column: (pl.Float64 if column in db.delivery_numeric_columns else pl.Utf8) for column in db.db_table_columns["delivery"]}
+    df     = screen(db_file, pl.DataFrame(rowreps, schema=schema, strict=False), pl.lit(True))
+    if df["check_name"].null_count() == df.height:
+        return rowreps, summary
+
+    flagged = df.filter(pl.col("check_name").is_not_null())
+    quarantine(db_file, flagged)
+
+    reasons = dict(zip(flagged["delivery_id"], flagged["check_reason"]))
+    rowreps = [rowrep for rowrep in rowreps if rowrep["delivery_id"] not in reasons]
+    summary = [
+        {**entry, "status": "quarantined", "reason": reasons[entry["delivery_id"]]}
+        if entry["status"] == "accepted" and entry["delivery_id"] in reasons else entry
+        for entry in summary
+    ]
+    return rowreps, summary
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def pending(db_file):
+    """
+    Returns the deliveries waiting for review, oldest first, as a Polars DataFrame.
+    """
+    columns = ["quarantine_id"] + db.db_table_columns["delivery"] + ["check_name", "reason", "previous_stand_meter", "quarantined_at"]
+    rows    = db.query_table(db_file, f"""
+        SELECT {", ".join(columns)} FROM delivery_quarantine WHERE review = 'pending' ORDER BY quarantine_id
+    """)
+    return pl.DataFrame(rows, schema=columns, orient="row")
+
+
+def review(db_file, quarantine_ids, decision):
+    """
+    Releases or discards quarantined deliveries. Released ones are written to delivery as
+    they are, in the same commit as their review.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        quarantine_ids (list): Ids of pending rows, the others are ignored.
+        decision (str): "released" or "discarded".
+
+    Returns:
+        int: The number of rows reviewed.
+    """
+
+    if decision not in ("released", "discarded"):
+        raise ValueError(f"unknown review decision {decision}")
+
+    columns = db.db_table_columns["delivery"]
+    rows    = db.query_table(db_file, f"""
+        SELECT quarantine_id, {", ".join(columns)} FROM delivery_quarantine
+        WHERE review = 'pending' AND quarantine_id IN (SELECT value FROM json_each(?))
+    """, (json.dumps([int(quarantine_id) for quarantine_id in quarantine_ids]),))
+    if not rows:
+        return 0
+
+    conn = None
+    try:
+        conn = db.connect(db_file, timeout=writer.busy_timeout)
+        if decision == "released":
+            conn.executemany(db.insert_sql("delivery", columns), [row[1:] for row in rows])
+        conn.executemany(
+            "UPDATE delivery_quarantine SET review = ?, reviewed_at = ? WHERE quarantine_id = ?",
+            [(decision, datetime.datetime.now().strftime(db.timestamp_format), row[0]) for row in rows],
+        )
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+    if decision == "released":
+        db.notify_write(db_file, "delivery", [dict(zip(columns, row[1:])) for row in rows])
+    logger.info("quarantine reviewed", extra={"decision": decision, "rows": len(rows)})
+    return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python meter_validation.py", description="Reviews quarantined delivery readings.")
+    parser.add_argument("action", choices=["list", "release", "discard"])
+    parser.add_argument("quarantine_ids", nargs="*", type=int)
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    enable(args.db)
+    if args.action == "list":
+        columns = ["quarantine_id", "delivery_id", "arrival_timestamp", "delivery_stand_meter", "check_name", "reason"]
+        with pl.Config(tbl_rows=-1, fmt_str_lengths=80):
+            print(pending(args.db).select(columns))
+        return 0
+
+    reviewed = review(args.db, args.quarantine_ids, "released" if args.action == "release" else "discarded")
+    print(f"{reviewed} of {len(args.quarantine_ids)} deliveries {args.action}d")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import os
+import re
+import time
+import bisect
+import sqlite3
+import threading
+import functools
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# In-process histograms of callback and SQL activity, exposed in the Prometheus text
+# format on /metrics. Every worker process keeps its own registry.
+# Set GMERCHANT_METRICS=0 to turn recording off.
+enabled             = os.environ.get("GMERCHANT_METRICS", "1") != "0"
+
+SECONDS_BUCKETS     = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS        = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+BYTES_BUCKETS       = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# name -> (help text, buckets, label name)
+histogram_specs     = {
+    "callback_seconds"          : ("Dash callback run time", SECONDS_BUCKETS, "callback"),
+    "callback_response_bytes"   : ("Dash callback response size", BYTES_BUCKETS, "callback"),
+    "sql_statement_seconds"     : ("SQLite execute time, first step included", SECONDS_BUCKETS, "statement"),
+    "sql_fetch_seconds"         : ("SQLite fetch time per fetch call", SECONDS_BUCKETS, "statement"),
+    "sql_rows"                  : ("Rows fetched per call, or written per executemany", ROWS_BUCKETS, "statement"),
+    "sql_payload_bytes"         : ("Text and blob bytes fetched per call, or bound per write", BYTES_BUCKETS, "statement"),
+}
+
+# name -> {label value: [bucket counts..., +Inf count, sum]}
+histograms          = {name: {} for name in histogram_specs}
+registry_lock       = threading.Lock()
+
+
+def observe(name, label, value):
+    """
+    Records one value in a histogram of histogram_specs.
+
+    Args:
+        name (str): The histogram name.
+        label (str): The value of its label, e.g. the callback name.
+        value (float): The observed value.
+    """
+
+    if not enabled:
+        return
+
+    buckets = histogram_specs[name][1]
+    with registry_lock:
+        series = histograms[name].get(label)
+        if series is None:
+            series = histograms[name][label] = [0] * (len(buckets) + 2)
+        series[bisect.bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+
+def reset():
+    with registry_lock:
+        for series in histograms.values():
+            series.clear()
+
+
+def render():
+    """
+    Renders every histogram in the Prometheus text exposition format.
+
+    Returns:
+        str: Cumulative bucket, sum and count lines of each series.
+    """
+
+    lines = []
+    with registry_lock:
+        for name, (help_text, buckets, label_name) in histogram_specs.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for label, series in sorted(histograms[name].items()):
+                label  = label.replace("\\", "\\\\").replace('"', '\\"')
+                cumul  = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], series[:-1]):
+                    cumul += count
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumul}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {series[-1]}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {cumul}')
+
+    return "\n".join(lines) + "\n"
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Dash callbacks
+def timed_callback(fn):
+    """
+    Decorator recording the run time of a Dash callback, placed under @app.callback.
+    Failed and prevented updates are timed as well.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            observe("callback_seconds", fn.__name__, time.perf_counter() - start)
+
+    return wrapper
+
+
+def instrument_server(server, dash_app=None):
+    """
+    Adds the /metrics endpoint to a Flask server, and records the response size of
+    every Dash callback request, labelled with the callback function when dash_app is given.
+
+    Args:
+        server (flask.Flask): The server, app.server for Dash.
+        dash_app (dash.Dash): The Dash app whose callbacks are served.
+    """
+
+    import flask
+
+    @server.after_request
+    def record_callback_response(response):
+        if enabled and flask.request.path.endswith("/_dash-update-component"):
+            payload = flask.request.get_json(silent=True) or {}
+            output  = payload.get("output", "unknown")
+            entry   = dash_app.callback_map.get(output, {}) if dash_app is not None else {}
+            label   = getattr(entry.get("callback"), "__name__", output)
+            observe("callback_response_bytes", label, response.calculate_content_length() or 0)
+        return response
+
+    @server.route("/metrics")
+    def metrics_endpoint():
+        return flask.Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SQLite statements
+STATEMENT_PATTERN   = re.compile(
+    r"^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|REPLACE|UPDATE|DELETE|CREATE|DROP|PRAGMA|ALTER|BEGIN|COMMIT|ROLLBACK)\b"
+    r"(?:.*?\b(?:FROM|INTO|UPDATE|TABLE|INDEX|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([\w\"]+))?",
+    re.IGNORECASE | re.DOTALL,
+)
+PRAGMA_PATTERN      = re.compile(r"^\s*PRAGMA\s+(\w+)", re.IGNORECASE)
+PAYLOAD_SAMPLE      = 100
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    """
+    Reduces a statement to its verb and main table, e.g. "SELECT delivery", to keep label counts small.
+    """
+    match = STATEMENT_PATTERN.match(sql)
+    if not match:
+        return "OTHER"
+
+    pragma = PRAGMA_PATTERN.match(sql)
+    if pragma:
+        return f"PRAGMA {pragma.group(1).lower()}"
+
+    verb, table = match.groups()
+    return f"{verb.upper()} {table.strip(chr(34))}" if table else verb.upper()
+
+
+def payload_bytes(rows):
+    """
+    Estimates the text and blob bytes of rows from the first PAYLOAD_SAMPLE of them,
+    so large fetches are not walked value by value.
+    """
+    sample = rows[:PAYLOAD_SAMPLE]
+    if not sample:
+        return 0
+
+    size = sum(len(value) for row in sample for value in row if isinstance(value, (str, bytes)))
+    return size * len(rows) // len(sample)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor recording execute and fetch times, rows and payload bytes per statement.
+    """
+
+    label = "OTHER"
+
+    def execute(self, sql, parameters=()):
+        self.label = statement_label(sql)
+        start      = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe("sql_statement_seconds", self.label, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.label = statement_label(sql)
+        seq_of_parameters = list(seq_of_parameters)
+        start      = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe("sql_statement_seconds", self.label, time.perf_counter() - start)
+            if enabled:
+                observe("sql_rows", self.label, len(seq_of_parameters))
+                observe("sql_payload_bytes", self.label, payload_bytes(seq_of_parameters))
+
+    def record_fetch(self, rows, start):
+        if not enabled:
+            return rows
+        observe("sql_fetch_seconds", self.label, time.perf_counter() - start)
+        observe("sql_rows", self.label, len(rows))
+        observe("sql_payload_bytes", self.label, payload_bytes(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self.record_fetch(super().fetchall(), start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows  = super().fetchmany(self.arraysize if size is None else size)
+        return self.record_fetch(rows, start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row   = super().fetchone()
+        self.record_fetch([row] if row is not None else [], start)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, and its execute shortcuts, are InstrumentedCursor.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
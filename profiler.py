@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import hmac
+import threading
+import functools
+import collections
+import datetime
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Opt-in sampling profiler for callbacks and database entry points.
+#
+# While a profiled call runs, a sampler thread records the call's stack every few
+# milliseconds. Calls slower than the threshold are saved as collapsed stacks, the input
+# format of flamegraph.pl and speedscope, and can be downloaded from /admin/profiling.
+#
+#   GMERCHANT_PROFILE                1 to profile from startup
+#   GMERCHANT_PROFILE_THRESHOLD_MS   slowest calls kept, 500 by default
+#   GMERCHANT_PROFILE_INTERVAL_MS    sampling interval, 5 by default
+#   GMERCHANT_PROFILE_DIR            where profiles are saved, "profiles" by default
+#   GMERCHANT_ADMIN_TOKEN            enables the admin URL, passed as ?token= or X-Admin-Token
+#
+# The admin toggle is stored in the profile directory, so every gunicorn worker follows it.
+profile_dir         = os.environ.get("GMERCHANT_PROFILE_DIR", "profiles")
+interval            = float(os.environ.get("GMERCHANT_PROFILE_INTERVAL_MS", 5)) / 1000
+max_profiles        = 100
+settings_ttl        = 1.0
+
+default_settings    = {
+    "enabled"       : os.environ.get("GMERCHANT_PROFILE", "0") == "1",
+    "threshold_ms"  : float(os.environ.get("GMERCHANT_PROFILE_THRESHOLD_MS", 500)),
+}
+
+logger              = logs.get_logger("profiler")
+
+# thread id -> Recording of the call being profiled on that thread
+active              = {}
+active_lock         = threading.Lock()
+sampler             = None
+cached_settings     = (0.0, dict(default_settings))
+
+
+class Recording:
+    def __init__(self, name):
+        self.name    = name
+        self.start   = time.perf_counter()
+        self.stacks  = collections.Counter()
+        self.samples = 0
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def settings_path():
+    return os.path.join(profile_dir, "_settings.json")
+
+
+def settings():
+    """
+    Returns {"enabled", "threshold_ms"}, from the admin toggle when one was saved.
+    Re-read at most once per settings_ttl seconds.
+    """
+    global cached_settings
+
+    read_at, current = cached_settings
+    if time.monotonic() - read_at < settings_ttl:
+        return current
+
+    current = dict(default_settings)
+    try:
+        with open(settings_path()) as file:
+            current.update(json.load(file))
+    except (OSError, ValueError):
+        pass
+
+    cached_settings = (time.monotonic(), current)
+    return current
+
+
+def save_settings(**changes):
+    """
+    Stores the admin toggle for every worker sharing the profile directory.
+    """
+    global cached_settings
+
+    current = dict(settings())
+    current.update(changes)
+    os.makedirs(profile_dir, exist_ok=True)
+    temp_path = f"{settings_path()}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(current, file)
+    os.replace(temp_path, settings_path())
+
+    cached_settings = (time.monotonic(), current)
+    return current
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def stack_key(frame):
+    """
+    Renders a frame and its callers as a collapsed stack, outermost call first.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_loop():
+    this_thread = threading.get_ident()
+    while True:
+        time.sleep(interval)
+        with active_lock:
+            targets = list(active.items())
+        if not targets:
+            continue
+
+        frames = sys._current_frames()
+        for thread_id, recording in targets:
+            frame = frames.get(thread_id)
+            if frame is not None and thread_id != this_thread:
+                recording.stacks[stack_key(frame)] += 1
+                recording.samples += 1
+
+
+def ensure_sampler():
+    global sampler
+    with active_lock:
+        if sampler is None or not sampler.is_alive():
+            sampler = threading.Thread(target=sample_loop, name="profiler-sampler", daemon=True)
+            sampler.start()
+
+
+def save_profile(recording, seconds):
+    """
+    Writes a recording as a collapsed-stack file and drops the oldest files above max_profiles.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    name  = f"{stamp}-{recording.name}-{int(seconds * 1000)}ms.collapsed"
+    with open(os.path.join(profile_dir, name), "w") as file:
+        for stack, count in recording.stacks.most_common():
+            file.write(f"{stack} {count}\n")
+
+    logger.info("slow call profiled", extra={"call": recording.name, "seconds": round(seconds, 3), "profile": name})
+
+    for old in list_profiles()[max_profiles:]:
+        os.remove(os.path.join(profile_dir, old["file"]))
+
+
+def profiled(fn):
+    """
+    Decorator sampling the stacks of fn while profiling is enabled. Calls nested in
+    an already profiled call on the same thread are part of the outer profile.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        thread_id = threading.get_ident()
+        if thread_id in active or not settings()["enabled"]:
+            return fn(*args, **kwargs)
+
+        ensure_sampler()
+        recording = Recording(fn.__name__)
+        with active_lock:
+            active[thread_id] = recording
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with active_lock:
+                active.pop(thread_id, None)
+            seconds = time.perf_counter() - recording.start
+            if seconds * 1000 >= settings()["threshold_ms"] and recording.samples:
+                try:
+                    save_profile(recording, seconds)
+                except OSError:
+                    logger.exception("profile could not be saved", extra={"call": recording.name})
+
+    return wrapper
+
+
+def list_profiles():
+    """
+    Returns the saved profiles, newest first, as {"file", "bytes"} dictionaries.
+    """
+    if not os.path.isdir(profile_dir):
+        return []
+
+    names = sorted((name for name in os.listdir(profile_dir) if name.endswith(".collapsed")), reverse=True)
+    return [{"file": name, "bytes": os.path.getsize(os.path.join(profile_dir, name))} for name in names]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def instrument_server(server):
+    """
+    Adds the admin URL to a Flask server:
+
+        /admin/profiling                      status and saved profiles
+        /admin/profiling?enable=1&threshold_ms=200
+        /admin/profiling/<file>               download one collapsed-stack profile
+
+    The routes answer 404 unless GMERCHANT_ADMIN_TOKEN is set, and 403 without the token.
+    """
+
+    import flask
+
+    def authorized():
+        token = os.environ.get("GMERCHANT_ADMIN_TOKEN")
+        if not token:
+            flask.abort(404)
+        given = flask.request.args.get("token") or flask.request.headers.get("X-Admin-Token", "")
+        if not hmac.compare_digest(given, token):
+            flask.abort(403)
+
+    @server.route("/admin/profiling")
+    def profiling_status():
+        authorized()
+        changes = {}
+        if "enable" in flask.request.args:
+            changes["enabled"] = flask.request.args["enable"] in ("1", "true", "on")
+        if "threshold_ms" in flask.request.args:
+            changes["threshold_ms"] = float(flask.request.args["threshold_ms"])
+        current = save_settings(**changes) if changes else settings()
+        return flask.jsonify({**current, "profiles": list_profiles()})
+
+    @server.route("/admin/profiling/<name>")
+    def profiling_download(name):
+        authorized()
+        if name not in {profile["file"] for profile in list_profiles()}:
+            flask.abort(404)
+        return flask.send_from_directory(os.path.abspath(profile_dir), name, as_attachment=True, mimetype="text/plain")
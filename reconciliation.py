@@ -0,0 +1,242 @@
+import json
+import datetime
+import polars as pl
+import database as db
+import gas_correction
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Minimum monthly volume reconciliation.
+#
+# The monthly_volume rollup holds, for every customer and month with deliveries, the charged
+# volume (computed as in the charge table) against the customer's minimum_monthly_volume, and
+# the shortfall topping the month up to that minimum. The rows of a customer are recomputed
+# after each delivery or customer write, so the invoice form reads its correction volume
+# from a handful of rows instead of a pass over the recap exports.
+MONTHLY_VOLUME_SCHEMA   = """
+CREATE TABLE IF NOT EXISTS monthly_volume (
+    customer_id             TEXT NOT NULL,
+    month                   TEXT NOT NULL,
+    deliveries              INTEGER NOT NULL,
+    charged_volume          REAL NOT NULL,
+    minimum_monthly_volume  REAL,
+    shortfall_volume        REAL NOT NULL,
+    PRIMARY KEY (customer_id, month)
+)
+"""
+MONTHLY_VOLUME_COLUMNS  = ["customer_id", "month", "deliveries", "charged_volume", "minimum_monthly_volume", "shortfall_volume"]
+MONTH_FORMAT            = "%Y-%m"
+
+# databases whose rollup is kept up to date by refresh_rollup
+enabled_databases       = set()
+
+logger                  = logs.get_logger("reconciliation")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def monthly_volume_plan(db_file, customer_ids=None):
+    """
+    Builds the lazy plan of the charged volume of every customer and month.
+
+    A delivery is charged the corrected stand meter difference to the customer's previous
+    delivery, across month boundaries, exactly like charge_table_plan.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_ids (list): Optional customers to compute, all when None.
+
+    Returns:
+        pl.LazyFrame: customer_id, month (YYYY-MM), deliveries and charged_volume.
+    """
+
+    if customer_ids is not None and len(customer_ids) == 1:
+        deliveries = db.scan_analytics(db_file, "delivery", {"customer_id": customer_ids[0]})
+    else:
+        deliveries = db.scan_analytics(db_file, "delivery")
+        if customer_ids is not None:
+            deliveries = deliveries.filter(pl.col("customer_id").is_in(customer_ids))
+
+    return (deliveries
+        .select([
+            pl.col("customer_id"),
+            pl.col("arrival_timestamp").str.to_datetime(db.timestamp_format).alias("arrival"),
+            pl.col("delivery_stand_meter").cast(pl.Float64, strict=False).alias("std_meter_on_arrival"),
+            pl.col("delivery_pressure").cast(pl.Float64, strict=False),
+            pl.col("delivery_temperature").cast(pl.Float64, strict=False),
+        ])
+        .sort(["customer_id", "arrival"], maintain_order=True)
+        .with_columns(pl.col("std_meter_on_arrival").diff().over("customer_id").alias("std_meter_diff"))
+        .pipe(gas_correction.with_corrected_volume, "charged_volume")
+        .with_columns(pl.col("arrival").dt.strftime(MONTH_FORMAT).alias("month"))
+        .group_by(["customer_id", "month"], maintain_order=True)
+        .agg([
+            pl.len().alias("deliveries"),
+            pl.col("charged_volume").sum(),
+        ])
+    )
+
+
+def compute_rollup(db_file, customer_ids=None):
+    """
+    Computes the monthly_volume rows of some or all customers.
+
+    Returns:
+        pl.DataFrame: MONTHLY_VOLUME_COLUMNS, the shortfall is 0 for customers without a minimum.
+    """
+
+    frame     = monthly_volume_plan(db_file, customer_ids).collect()
+    customers = db.get_customers(db_file, frame["customer_id"].unique().to_list())
+    minimums  = {customer_id: customer.minimum_monthly_volume for customer_id, customer in customers.items()}
+
+    return (frame
+        .with_columns(
+            pl.col("customer_id").replace_strict(minimums, default=None, return_dtype=pl.Float64).alias("minimum_monthly_volume")
+        )
+        .with_columns(
+            (pl.col("minimum_monthly_volume") - pl.col("charged_volume")).clip(lower_bound=0).fill_null(0).alias("shortfall_volume")
+        )
+        .select(MONTHLY_VOLUME_COLUMNS)
+    )
+
+
+def write_rollup(db_file, frame, customer_ids=None):
+    """
+    Replaces the monthly_volume rows of customer_ids, or the whole rollup, in one transaction.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        if customer_ids is None:
+            conn.execute("DELETE FROM monthly_volume")
+        else:
+            conn.execute(
+                "DELETE FROM monthly_volume WHERE customer_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(customer_ids)),),
+            )
+        conn.executemany(
+            f"INSERT INTO monthly_volume ({', '.join(MONTHLY_VOLUME_COLUMNS)}) VALUES ({', '.join('?' for _ in MONTHLY_VOLUME_COLUMNS)})",
+            frame.rows(),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def build_rollup(db_file):
+    frame = compute_rollup(db_file)
+    write_rollup(db_file, frame)
+    logger.info("monthly volume rollup built", extra={"db_file": db_file, "rows": frame.height})
+
+
+def refresh_rollup(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) recomputing the months of the customers
+    touched by a delivery or customer write. A delivery also changes the charged volume
+    of the customer's next delivery, so the customer is recomputed as a whole.
+    """
+
+    if db_file not in enabled_databases or table_name not in ("delivery", "customer"):
+        return
+
+    customer_ids = sorted({row["customer_id"] for row in rows if row.get("customer_id") is not None})
+    if not customer_ids:
+        return
+
+    write_rollup(db_file, compute_rollup(db_file, customer_ids), customer_ids)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def monthly_volumes(db_file, customer_id):
+    """
+    Returns the rollup rows of a customer as {month: row dictionary}.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(MONTHLY_VOLUME_COLUMNS)} FROM monthly_volume WHERE customer_id = ? ORDER BY month",
+            (customer_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return {row[1]: dict(zip(MONTHLY_VOLUME_COLUMNS, row)) for row in rows}
+
+
+def month_end(month_start):
+    next_month = (month_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return next_month - datetime.timedelta(days=1)
+
+
+def shortfall_balance(db_file, customer_id, start_date, end_date, today=None):
+    """
+    Computes the correction volume of an invoice: the shortfall of every month of the
+    subscription that ends within [start_date, end_date] and is over. A month without
+    deliveries is short of its whole minimum.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        customer_id (str): The invoiced customer.
+        start_date (str): First invoiced date, YYYY-MM-DD.
+        end_date (str): Last invoiced date, YYYY-MM-DD.
+        today (datetime.date): Months ending after it are not charged, the current date when None.
+
+    Returns:
+        float: The volume to add to the charged volume, 0 for unknown customers.
+    """
+
+    customer = db.get_customer(db_file, customer_id)
+    if customer is None or not customer.minimum_monthly_volume:
+        return 0.0
+
+    start   = datetime.datetime.strptime(start_date, db.date_format).date()
+    end     = min(datetime.datetime.strptime(end_date, db.date_format).date(), today or datetime.date.today())
+    try:
+        start = max(start, datetime.datetime.strptime(customer.subscription_start, db.date_format).date().replace(day=1))
+    except (TypeError, ValueError):
+        pass
+
+    volumes = monthly_volumes(db_file, customer_id)
+    balance = 0.0
+    month   = start.replace(day=1)
+    while month_end(month) <= end:
+        row      = volumes.get(month.strftime(MONTH_FORMAT))
+        balance += row["shortfall_volume"] if row else customer.minimum_monthly_volume
+        month    = month_end(month) + datetime.timedelta(days=1)
+
+    return balance
+
+
+def enable(db_file, rebuild=True):
+    """
+    Keeps the monthly_volume rollup of db_file up to date after writes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        rebuild (bool): Recompute the whole rollup first, needed when writes reached the
+                        database without this module listening.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        conn.execute(MONTHLY_VOLUME_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if rebuild:
+        build_rollup(db_file)
+
+    enabled_databases.add(db_file)
+    if refresh_rollup not in db.write_listeners:
+        db.write_listeners.append(refresh_rollup)
+
+
+if __name__ == '__main__':
+    logs.configure()
+    enable(db.database_file)
@@ -0,0 +1,262 @@
+import re
+import datetime
+from collections import defaultdict
+from functools import lru_cache
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Precompiled patterns, shared by every call
+SEPARATOR_PATTERN   = re.compile(r"[-=]{3,}")
+REPORT_DATE_PATTERN = re.compile(r"(\d{1,2})-([A-Za-z]{3})-(\d{2})")
+CLOCK_PATTERN       = re.compile(r"(\d{1,2})[:.](\d{2})")
+SVARGA_HEADERS      = ('FORMAT SVARGA', '=====')
+
+NULL_VALUES         = {"null", "none", ""}
+
+month_abbr_map      = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Typed converters, each raises ValueError on malformed input
+def to_text(value):
+    return value
+
+
+def to_float(value):
+    return float(value)
+
+
+@lru_cache(maxsize=4096)
+def to_report_date(value):
+    """
+    Converts a DD-Mon-YY report date (e.g. 30-Nov-24) to a date, like strptime's %d-%b-%y.
+    """
+    match = REPORT_DATE_PATTERN.fullmatch(value)
+    if not match:
+        raise ValueError(f"expected DD-Mon-YY, got {value!r}")
+
+    day, month, year = match.groups()
+    month_number     = month_abbr_map.get(month.lower())
+    if month_number is None:
+        raise ValueError(f"unknown month {month!r}")
+
+    # %y convention: 69-99 map to 19xx, 00-68 map to 20xx
+    year = int(year)
+    year = year + 1900 if year >= 69 else year + 2000
+    return datetime.date(year, month_number, int(day))
+
+
+def to_iso_date(value):
+    return datetime.date.fromisoformat(value)
+
+
+@lru_cache(maxsize=4096)
+def to_clock_time(value):
+    """
+    Converts an HH:MM (or HH.MM) arrival time to a time.
+    """
+    match = CLOCK_PATTERN.fullmatch(value)
+    if not match:
+        raise ValueError(f"expected HH:MM, got {value!r}")
+    return datetime.time(int(match.group(1)), int(match.group(2)))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Field tables: report key -> (converter, nullable)
+delivery_report_fields = {
+    "customer_id"               : (to_text, False),
+    "delivery_route"            : (to_text, False),
+    "transport_plate_number"    : (to_text, False),
+    "delivery_date"             : (to_report_date, False),
+    "delivery_arrival_time"     : (to_clock_time, False),
+    "pre_buffer_pressure"       : (to_float, True),
+    "delivery_stand_meter"      : (to_float, True),
+    "delivery_pressure"         : (to_float, True),
+    "delivery_temperature"      : (to_float, True),
+    "post_buffer_pressure"      : (to_float, True),
+    "transport_bank_pressure"   : (to_float, True),
+}
+
+restock_report_fields = {
+    "transport_plate_number"    : (to_text, False),
+    "restock_date"              : (to_iso_date, False),
+    "restock_volume"            : (to_float, False),
+    "spbg_address"              : (to_text, False),
+}
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def split_raw_reports(text):
+    """
+    Walks a block of key/value reports once and returns one {key: raw value} dict per report.
+    Keys and values sit on alternating non-empty lines. A report ends at a separator line
+    ("---" or "===") or where one of its keys appears a second time.
+
+    Args:
+        text (str): One or many reports.
+
+    Returns:
+        list: A list of dictionaries of stripped raw strings, in input order.
+    """
+
+    reports = []
+    current = {}
+    key     = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if key is None:
+            if line[0] in "-=" and SEPARATOR_PATTERN.fullmatch(line):
+                if current:
+                    reports.append(current)
+                    current = {}
+                continue
+
+            if line in current:
+                reports.append(current)
+                current = {}
+            key = line
+        else:
+            current[key] = line
+            key          = None
+
+    if current:
+        reports.append(current)
+
+    return reports
+
+
+def convert_report(raw, fields):
+    """
+    Applies the typed converters of a field table to one raw report.
+
+    Args:
+        raw (dict): {key: raw value} as returned by split_raw_reports.
+        fields (dict): A field table such as delivery_report_fields.
+
+    Returns:
+        tuple: (record, errors). record maps every field to its typed value (None for
+               null or invalid values), errors maps failing fields to a message.
+    """
+
+    record = {}
+    errors = {}
+    for name, (converter, nullable) in fields.items():
+        value = raw.get(name)
+        if value is None:
+            record[name] = None
+            errors[name] = f"missing {name}"
+            continue
+
+        if value.lower() in NULL_VALUES:
+            record[name] = None
+            if not nullable:
+                errors[name] = f"missing {name}"
+            continue
+
+        try:
+            record[name] = converter(value)
+        except ValueError:
+            record[name] = None
+            errors[name] = f"invalid {name}"
+
+    return record, errors
+
+
+def parse_report_block(text, fields):
+    """
+    Parses a block of reports into typed records in a single pass over the text.
+
+    Args:
+        text (str): One or many reports.
+        fields (dict): A field table such as delivery_report_fields.
+
+    Returns:
+        tuple: (records, errors), two lists aligned with the reports of the block.
+    """
+
+    return convert_reports(split_raw_reports(text), fields)
+
+
+def convert_reports(raws, fields):
+    """
+    Applies convert_report to many raw reports.
+
+    Returns:
+        tuple: (records, errors), two lists aligned with raws.
+    """
+
+    records = []
+    errors  = []
+    for raw in raws:
+        record, error = convert_report(raw, fields)
+        records.append(record)
+        errors.append(error)
+
+    return records, errors
+
+
+def parse_report(text, fields):
+    """
+    Parses a single report into a typed record, see parse_report_block.
+    """
+    raws = split_raw_reports(text)
+    return convert_report(raws[0] if raws else {}, fields)
+
+
+def parse_raw_report(text):
+    """
+    Parses a single report into {key: value} strings, with "None" for null values.
+    This is the untyped shape of the original parse_delivery_report and parse_restock_report.
+    """
+    raws = split_raw_reports(text)
+    if not raws:
+        return {}
+    return {key: "None" if value.lower() == "null" else value for key, value in raws[0].items()}
+
+
+def parse_svarga_block(text):
+    """
+    Parses the FORMAT SVARGA key: value layout in a single pass. Lines without a colon
+    open a section, header and separator lines close it.
+
+    Args:
+        text (str): The SVARGA formatted text.
+
+    Returns:
+        dict: Top-level {key: value} entries, with one nested dict per section.
+              Keys and values are lower-cased.
+    """
+
+    data            = defaultdict(str)
+    current_section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith(SVARGA_HEADERS):
+            current_section = None
+            continue
+
+        head, colon, value = line.partition(':')
+        if colon:
+            ikey   = head.strip().strip('*').strip().lower()
+            ivalue = value.strip().lower()
+            if current_section is None:
+                data[ikey] = ivalue
+            else:
+                if current_section not in data:
+                    data[current_section] = defaultdict(str)
+                data[current_section][ikey] = ivalue
+
+        elif not line.startswith('*'):
+            current_section = line.lower()
+
+    return data
@@ -0,0 +1,250 @@
+import sys
+import json
+import argparse
+import datetime
+import polars as pl
+import database as db
+import mass_balance
+import buffer_forecast
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Transport restock forecast: python restock_forecast.py [--days 3]
+#
+# A transport leaves the gas station with the volume it restocked and gives it out as charged
+# volume plus the expected loss of mass_balance.py. From the truck_ledger of a transport, over
+# the restocks since its history_restocks-th last one:
+#
+#   volume_per_day  the charged volume and expected loss per day since the first of them
+#   on_board        the last restocked volume less what left the transport since that restock
+#   next_restock    the last ledger day plus on_board / volume_per_day days
+#   interval_days   the mean days between those restocks, interval_restock the last restock
+#                   plus interval_days: the habit, against next_restock the need
+#
+# The ledger is kept current by mass_balance.py, so every transport is computed in one pass
+# of group-wise Polars expressions over it, never over the raw tables. The results are kept
+# in the restock_forecast table, one row per transport, recomputed for the transports whose
+# ledger a write changed, as mass_balance.py reports them. forecasts() reads it, the tracker
+# shows the selected transport's.
+RESTOCK_FORECAST_SCHEMA  = """
+CREATE TABLE IF NOT EXISTS restock_forecast (
+    transport_plate_number  TEXT PRIMARY KEY,
+    last_restock            TEXT,
+    last_load               REAL,
+    last_day                TEXT,
+    restocks                INTEGER NOT NULL,
+    interval_days           REAL,
+    volume_per_day          REAL,
+    on_board                REAL,
+    next_restock            TEXT,
+    interval_restock        TEXT
+)
+"""
+RESTOCK_FORECAST_COLUMNS = ["transport_plate_number", "last_restock", "last_load", "last_day", "restocks", "interval_days",
+                            "volume_per_day", "on_board", "next_restock", "interval_restock"]
+
+history_restocks        = 8
+min_restocks            = 2
+
+# databases whose forecasts are kept up to date by refresh_predictions
+enabled_databases       = set()
+
+logger                  = logs.get_logger("restock_forecast")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def days_after(date, days):
+    """
+    Returns the date expression days (an expression, null-safe, rounded down) later.
+    """
+    return pl.col(date) + pl.duration(days=days.floor().cast(pl.Int64))
+
+
+def forecast_plan(db_file, plates=None):
+    """
+    Computes the restock_forecast rows of some or all transports.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        plates (list): Optional transports to compute, all when None.
+
+    Returns:
+        pl.DataFrame: RESTOCK_FORECAST_COLUMNS, dates as stored strings.
+    """
+
+    restock   = pl.col("restocks") > 0
+    recent    = restock & pl.col("recent")
+    enough    = pl.col("restocks") >= min_restocks
+    last_pass = pl.col("restock_number") == pl.col("restock_number").max()
+
+    return (mass_balance.ledger(db_file, plates)
+        .lazy()
+        .with_columns([
+            restock.cum_sum().cast(pl.Int64).over("transport_plate_number").alias("restock_number"),
+            (pl.col("charged_volume") + pl.col("expected_loss")).alias("volume_out"),
+        ])
+        .with_columns(
+            (pl.col("restock_number") > pl.col("restock_number").max().over("transport_plate_number") - history_restocks).alias("recent")
+        )
+        .group_by("transport_plate_number", maintain_order=True)
+        .agg([
+            pl.col("date").filter(restock).last().alias("last_restock"),
+            pl.col("restocked_volume").filter(restock).last().alias("last_load"),
+            pl.col("date").last().alias("last_day"),
+            recent.sum().cast(pl.Int64).alias("restocks"),
+            pl.col("date").filter(recent).first().alias("first_restock"),
+            pl.col("date").filter(recent).diff().dt.total_days().mean().alias("interval_days"),
+            pl.col("volume_out").filter(pl.col("recent") & (pl.col("restock_number") > 0)).sum().alias("recent_volume_out"),
+            pl.col("volume_out").filter(last_pass & (pl.col("restock_number") > 0)).sum().alias("volume_out_since"),
+        ])
+        .with_columns([
+            pl.when(enough).then(
+                pl.col("recent_volume_out") / ((pl.col("last_day") - pl.col("first_restock")).dt.total_days() + 1)
+            ).alias("volume_per_day"),
+            (pl.col("last_load") - pl.col("volume_out_since")).clip(lower_bound=0).alias("on_board"),
+            pl.when(enough).then(pl.col("interval_days")).alias("interval_days"),
+        ])
+        .with_columns([
+            days_after("last_day", pl.col("on_board") / buffer_forecast.positive("volume_per_day")).alias("next_restock"),
+            days_after("last_restock", pl.col("interval_days")).alias("interval_restock"),
+        ])
+        .with_columns([
+            pl.col(column).dt.strftime(db.date_format) for column in ("last_restock", "last_day", "next_restock", "interval_restock")
+        ])
+        .select(RESTOCK_FORECAST_COLUMNS)
+        .collect()
+    )
+
+
+def write_forecasts(db_file, frame, plates=None):
+    """
+    Replaces the restock_forecast rows of plates, or all of them, in one transaction.
+    """
+
+    conn = db.connect(db_file)
+    try:
+        if plates is None:
+            conn.execute("DELETE FROM restock_forecast")
+        else:
+            conn.execute(
+                "DELETE FROM restock_forecast WHERE transport_plate_number IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(plates)),),
+            )
+        conn.executemany(
+            f"INSERT INTO restock_forecast ({', '.join(RESTOCK_FORECAST_COLUMNS)}) VALUES ({', '.join('?' for _ in RESTOCK_FORECAST_COLUMNS)})",
+            frame.rows(),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def build_forecasts(db_file):
+    frame = forecast_plan(db_file)
+    write_forecasts(db_file, frame)
+    logger.info("restock forecasts built", extra={"db_file": db_file, "transports": frame.height})
+
+
+def refresh_predictions(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) recomputing the forecasts of the transports
+    whose ledger changed, as mass_balance.refresh_balances passes them on after a restock,
+    delivery or customer write: restocks upserted away from a transport included.
+    """
+
+    if db_file not in enabled_databases or table_name != "truck_ledger":
+        return
+
+    plates = sorted({row["transport_plate_number"] for row in rows if row.get("transport_plate_number")})
+    if plates:
+        write_forecasts(db_file, forecast_plan(db_file, plates), plates)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def forecasts(db_file, as_of=None, plates=None):
+    """
+    Reads the forecasts.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        as_of (datetime.date): The day to count the days left from, today when None.
+        plates (list): Optional transports to read, all when None.
+
+    Returns:
+        pl.DataFrame: RESTOCK_FORECAST_COLUMNS with dates as dates, plus days_left (until
+                      next_restock, negative when overdue), soonest restock first, transports
+                      without a forecast last.
+    """
+
+    where  = "" if plates is None else "WHERE transport_plate_number IN (SELECT value FROM json_each(?))"
+    params = () if plates is None else (json.dumps(list(plates)),)
+    rows   = db.query_table(db_file, f"SELECT {', '.join(RESTOCK_FORECAST_COLUMNS)} FROM restock_forecast {where}", params)
+
+    dates  = ("last_restock", "last_day", "next_restock", "interval_restock")
+    schema = {column: pl.Float64 for column in RESTOCK_FORECAST_COLUMNS}
+    schema.update({"transport_plate_number": pl.Utf8, "restocks": pl.Int64})
+    schema.update({column: pl.Utf8 for column in dates})
+    as_of  = as_of or datetime.date.today()
+
+    return (pl.DataFrame(rows, schema=schema, orient="row")
+        .with_columns([pl.col(column).str.to_date(db.date_format) for column in dates])
+        .with_columns((pl.col("next_restock") - pl.lit(as_of)).dt.total_days().alias("days_left"))
+        .sort("next_restock", nulls_last=True)
+    )
+
+
+def enable(db_file, rebuild=True):
+    """
+    Keeps the restock_forecast table of db_file up to date after writes, enabling the mass
+    balances it is computed from first when they are not.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        rebuild (bool): Recompute every forecast first, needed when writes reached the
+                        database without this module listening.
+    """
+
+    if db_file not in mass_balance.enabled_databases:
+        mass_balance.enable(db_file, rebuild=rebuild)
+
+    conn = db.connect(db_file)
+    try:
+        conn.execute(RESTOCK_FORECAST_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if rebuild:
+        build_forecasts(db_file)
+
+    enabled_databases.add(db_file)
+    if refresh_predictions not in db.write_listeners:
+        db.write_listeners.append(refresh_predictions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python restock_forecast.py", description="Forecasts when transports need a restock.")
+    parser.add_argument("--days", type=float, default=None, help="only the transports due within that many days")
+    parser.add_argument("--as-of", default=None, help=f"the day to count from, {db.date_format}, today by default")
+    parser.add_argument("--db", default=db.database_file, help="the SQLite database")
+    args = parser.parse_args(argv)
+
+    logs.configure()
+    enable(args.db)
+    as_of = datetime.datetime.strptime(args.as_of, db.date_format).date() if args.as_of else None
+    frame = forecasts(args.db, as_of)
+    if args.days is not None:
+        frame = frame.filter(pl.col("days_left") <= args.days)
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(frame)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+import os
+import glob
+import json
+import shutil
+import threading
+import contextlib
+from urllib.parse import quote
+import polars as pl
+import database as db
+import logs
+
+try:
+    import fcntl
+except ImportError:     # Windows, where no other process refreshes the snapshot (no gunicorn)
+    fcntl = None
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Columnar snapshot of operation.db for the analytics reads (charge, tracker, recap).
+#
+#   snapshot/delivery/customer_id/month=YYYY-MM/customer_id=<id>/part.parquet
+#   snapshot/delivery/transport_plate_number/month=YYYY-MM/transport_plate_number=<plate>/part.parquet
+#   snapshot/restock/transport_plate_number/month=YYYY-MM/transport_plate_number=<plate>/part.parquet
+#   snapshot/customer/part.parquet
+#
+# Partition values live in the hive paths, every file keeps the SQLite rowid as _rowid
+# so scans return rows in insertion order, exactly like database.scan_table.
+snapshot_dir        = "snapshot"
+
+# table -> layouts as (stored date column giving the month, partition key column),
+# no layout means a single file. Delivery is kept twice: charges read it per customer,
+# the tracker per transport.
+partition_layouts   = {
+    "delivery"  : [("arrival_timestamp", "customer_id"), ("arrival_timestamp", "transport_plate_number")],
+    "restock"   : [("restock_date", "transport_plate_number")],
+    "customer"  : [],
+}
+
+HIVE_NULL           = "__HIVE_DEFAULT_PARTITION__"
+ROWID               = "_rowid"
+
+# db_file -> snapshot root, for every snapshot kept up to date by refresh_snapshot. Gunicorn
+# workers and the gateway refresh the same files, so rewrites also hold an flock on
+# <root>.lock, next to the root as build_snapshot swaps the root directory itself.
+enabled_snapshots   = {}
+refresh_lock        = threading.Lock()
+
+logger              = logs.get_logger("snapshot")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@contextlib.contextmanager
+def locked(root):
+    """
+    Holds the snapshot under root against the rewrites of the other threads and processes,
+    from reading the rows of a partition until its file is replaced.
+    """
+    with refresh_lock:
+        if fcntl is None:
+            yield
+            return
+
+        lock_path = f"{os.path.abspath(root)}.lock"
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def hive_value(value):
+    # quote leaves no glob wildcard unescaped
+    return HIVE_NULL if value is None else quote(str(value), safe="")
+
+
+def partition_path(root, table_name, key_column=None, month=None, key=None):
+    """
+    Returns the Parquet file holding one partition of a table layout.
+    """
+    if key_column is None:
+        return os.path.join(root, table_name, "part.parquet")
+
+    return os.path.join(
+        root,
+        table_name,
+        key_column,
+        f"month={hive_value(month)}",
+        f"{key_column}={hive_value(key)}",
+        "part.parquet",
+    )
+
+
+def read_rows(db_file, table_name, where=None, params=()):
+    """
+    Reads table rows with their rowid, all columns typed as strings as stored.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The table to read, one of partition_layouts.
+        where (str): Optional SQL condition.
+        params (tuple): Parameters of the where condition.
+
+    Returns:
+        pl.DataFrame: _rowid followed by the table columns.
+    """
+
+    columns = db.db_table_columns[table_name]
+    schema  = {ROWID: pl.Int64, **{col: pl.Utf8 for col in columns}}
+    query   = f"SELECT rowid, {', '.join(columns)} FROM {table_name}"
+    if where:
+        query += f" WHERE {where}"
+
+    conn = db.connect(db_file)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    return pl.DataFrame(rows, schema=schema, orient="row")
+
+
+def write_file(frame, path):
+    """
+    Writes a frame to Parquet through a temporary file, so readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    frame.write_parquet(temp_path)
+    os.replace(temp_path, path)
+
+
+def remove_file(root, path):
+    """
+    Removes a partition file and the partition directories it leaves empty.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    directory = os.path.dirname(path)
+    while os.path.abspath(directory) != os.path.abspath(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def write_partitions(root, table_name, layout, frame, touched=None):
+    """
+    Writes the rows of a table as the partition files of one layout. With touched,
+    only those (month, key) partitions are written, and the ones left without rows are removed.
+
+    Args:
+        root (str): The snapshot root directory.
+        table_name (str): The table the rows belong to.
+        layout (tuple): (date column, key column) from partition_layouts.
+        frame (pl.DataFrame): Rows as returned by read_rows.
+        touched (set): Optional (month, key) pairs to rewrite.
+
+    Returns:
+        int: The number of partition files written.
+    """
+
+    date_column, key_column = layout
+    frame   = frame.with_columns(pl.col(date_column).str.slice(0, 7).alias("month"))
+    written = set()
+    for (month, key), part in frame.group_by(["month", key_column]):
+        if touched is not None and (month, key) not in touched:
+            continue
+        write_file(part.drop(["month", key_column]), partition_path(root, table_name, key_column, month, key))
+        written.add((month, key))
+
+    for month, key in (touched or set()) - written:
+        remove_file(os.path.join(root, table_name), partition_path(root, table_name, key_column, month, key))
+
+    return len(written)
+
+
+def write_table(root, table_name, frame):
+    """
+    Writes every layout of a table from all of its rows.
+    """
+    layouts = partition_layouts[table_name]
+    if not layouts:
+        write_file(frame, partition_path(root, table_name))
+        return 1
+
+    return sum(write_partitions(root, table_name, layout, frame) for layout in layouts)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def build_snapshot(db_file, root=snapshot_dir):
+    """
+    Exports delivery, restock and customer to a fresh snapshot. The snapshot is built
+    next to the current one and swapped in once complete.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        root (str): The snapshot root directory.
+
+    Returns:
+        dict: {table_name: number of partition files}.
+    """
+
+    staging = f"{root}.staging"
+    retired = f"{root}.old"
+
+    # held throughout, a refresh between the reads and the swap would be lost with the old root
+    with locked(root):
+        shutil.rmtree(staging, ignore_errors=True)
+        counts  = {}
+        for table_name in partition_layouts:
+            counts[table_name] = write_table(staging, table_name, read_rows(db_file, table_name))
+
+        shutil.rmtree(retired, ignore_errors=True)
+        if os.path.exists(root):
+            os.replace(root, retired)
+        os.replace(staging, root)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    logger.info("snapshot built", extra={"db_file": db_file, "root": root, "files": counts})
+    return counts
+
+
+def refresh_snapshot(db_file, table_name, rows):
+    """
+    Write listener (see database.write_listeners) rewriting only the partitions
+    touched by a committed write. Partitions are re-read from SQLite, so updates
+    from upserts are picked up as well as inserts, and the partition an upsert
+    moved a row away from is emptied of it through the replaced rows.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The written table.
+        rows (list): The written and replaced rows as dictionaries.
+    """
+
+    root = enabled_snapshots.get(db_file)
+    if root is None or table_name not in partition_layouts:
+        return
+
+    layouts = partition_layouts[table_name]
+    with locked(root):
+        if not layouts:
+            write_table(root, table_name, read_rows(db_file, table_name))
+            return
+
+        for date_column, key_column in layouts:
+            touched = {
+                (str(row[date_column])[:7], row[key_column])
+                for row in rows
+                if row.get(date_column) is not None and row.get(key_column) is not None
+            }
+            if not touched:
+                continue
+
+            keys  = sorted({key for _, key in touched})
+            frame = read_rows(db_file, table_name, f"{key_column} IN (SELECT value FROM json_each(?))", (json.dumps(keys),))
+            write_partitions(root, table_name, (date_column, key_column), frame, touched)
+
+
+def scan_snapshot(root, table_name, equals=None):
+    """
+    Lazily scans one table of a snapshot. Only the partitions of the layout matching
+    an equality filter are opened, and Polars memory-maps the Parquet files.
+
+    Args:
+        root (str): The snapshot root directory.
+        table_name (str): The table to scan.
+        equals (dict): Optional {column: value} filters used to pick partitions,
+                       the caller still applies them to the rows.
+
+    Returns:
+        pl.LazyFrame: The stored string columns in insertion order, None if the table is not in the snapshot.
+    """
+
+    if table_name not in partition_layouts:
+        return None
+
+    columns = db.db_table_columns[table_name]
+    layouts = partition_layouts[table_name]
+    if not layouts:
+        path = partition_path(root, table_name)
+        if not os.path.exists(path):
+            return None
+        return pl.scan_parquet(path).sort(ROWID).select(columns)
+
+    equals     = equals or {}
+    key_column = next((key for _, key in layouts if key in equals), layouts[0][1])
+    directory  = os.path.join(root, table_name, key_column)
+    if not os.path.isdir(directory):
+        return None
+
+    key_glob   = hive_value(equals[key_column]) if key_column in equals else "*"
+    files      = sorted(glob.glob(os.path.join(directory, "month=*", f"{key_column}={key_glob}", "part.parquet")))
+    if not files:
+        return pl.LazyFrame(schema={col: pl.Utf8 for col in columns})
+
+    frame = pl.scan_parquet(
+        files,
+        hive_partitioning   = True,
+        hive_schema         = {"month": pl.Utf8, key_column: pl.Utf8},
+    )
+    return frame.sort(ROWID).select(columns)
+
+
+def enable(db_file, root=snapshot_dir, rebuild=True):
+    """
+    Serves the analytics reads of db_file from a snapshot and keeps it up to date after writes.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        root (str): The snapshot root directory.
+        rebuild (bool): Rebuild the snapshot first. An existing snapshot is only reused as is
+                        when no write reached the database without this module listening.
+    """
+
+    if rebuild or not os.path.isdir(root):
+        build_snapshot(db_file, root)
+
+    enabled_snapshots[db_file] = root
+    if refresh_snapshot not in db.write_listeners:
+        db.write_listeners.append(refresh_snapshot)
+
+    def source(table_name, equals):
+        return scan_snapshot(root, table_name, equals)
+
+    db.analytics_sources[db_file] = source
+
+
+def disable(db_file):
+    """
+    Sends the analytics reads of db_file back to SQLite, the snapshot files are kept.
+    """
+    enabled_snapshots.pop(db_file, None)
+    db.analytics_sources.pop(db_file, None)
+
+
+if __name__ == '__main__':
+    logs.configure()
+    build_snapshot(db.database_file)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+import snapshot
+import mass_balance
+import buffer_forecast
+import restock_forecast
+import meter_validation
+import writer
+from benchmark.synthetic import make_database
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# A small synthetic operation.db with the snapshot and the derived tables enabled, as app.py
+# initializes them. Every module keeping per-database state is reset after the test.
+@pytest.fixture
+def derived_db(tmp_path):
+    db_file = str(tmp_path / "operation.db")
+    customers, trucks = make_database(db_file, 400, n_customers=20, n_trucks=4)
+    db.enable_wal(db_file)
+    db.create_key_index(db_file, "restock", deduplicate=True)
+    meter_validation.enable(db_file)
+
+    listeners = list(db.write_listeners)
+    snapshot.enable(db_file, root=str(tmp_path / "snapshot"))
+    buffer_forecast.enable(db_file)
+    restock_forecast.enable(db_file)
+
+    yield db_file, customers, trucks
+
+    writer.close_all()
+    snapshot.disable(db_file)
+    for module in (mass_balance, buffer_forecast, restock_forecast):
+        module.enabled_databases.discard(db_file)
+    db.write_listeners[:] = listeners
@@ -0,0 +1,50 @@
+import datetime
+
+import polars as pl
+
+import database as db
+import buffer_forecast
+import cache
+import dispatch
+import writer
+
+from test_write_listeners import next_delivery
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# The synthetic deliveries end on 2023-02-08, every customer is due again two days later.
+plan_date = datetime.date(2023, 2, 10)
+
+
+def test_plan_visits_every_due_customer_once(derived_db):
+    db_file, _, _ = derived_db
+
+    stops = dispatch.plan(db_file, plan_date)
+
+    assert stops.columns == dispatch.STOP_COLUMNS
+    assert not stops.is_empty()
+    assert stops["customer_id"].is_unique().all()
+    routes = stops.group_by("route").agg([pl.col("stop").sort(), pl.col("volume").sum()])
+    assert all(route_stops.to_list() == list(range(1, len(route_stops) + 1)) for route_stops in routes["stop"])
+
+
+def test_cached_plan_follows_the_buffer_forecasts(derived_db, tmp_path, monkeypatch):
+    db_file, _, _ = derived_db
+    monkeypatch.setattr(cache, "cache_file", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(cache, "enabled_db_file", None)
+    cache.enable(db_file)
+
+    # as in app.py the versions are bumped before the forecasts are refreshed, and a worker
+    # plans in between
+    db.write_listeners.remove(cache.bump_versions)
+    position = db.write_listeners.index(buffer_forecast.refresh_forecasts)
+    db.write_listeners[position:position] = [cache.bump_versions, lambda db_file, table_name, rows: dispatch.plan(db_file, plan_date)]
+
+    served   = dispatch.plan(db_file, plan_date)["customer_id"][0]
+    delivery = next_delivery(db_file, served)
+    delivery.update(arrival_timestamp=f"{plan_date - datetime.timedelta(days=1)} 12:00:00", delivery_id=served + "202302091200")
+    writer.write(db_file, "delivery", [delivery])
+    assert writer.settle(db_file)
+
+    assert served not in dispatch.plan(db_file, plan_date)["customer_id"].to_list()
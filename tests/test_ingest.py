@@ -0,0 +1,60 @@
+import database as db
+import ingest
+import meter_validation
+import writer
+
+from test_write_listeners import assert_stores_match, next_delivery, stored_row
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def statuses(result):
+    return [(record[key], record["status"]) for record in result["records"] for key in record if key.endswith("_id")]
+
+
+def test_delivery_with_null_readings_is_inserted(derived_db):
+    db_file, customers, _ = derived_db
+    delivery = {**next_delivery(db_file, customers[0]), "delivery_id": None, "pre_buffer_pressure": None, "transport_bank_pressure": None}
+
+    result = ingest.ingest(db_file, "delivery", [delivery])
+    assert writer.settle(db_file)
+
+    assert [record["status"] for record in result["records"]] == ["inserted"]
+    assert stored_row(db_file, "delivery", result["records"][0]["delivery_id"])["pre_buffer_pressure"] is None
+    assert_stores_match(db_file)
+
+
+def test_repeated_delivery_exists_and_regression_is_quarantined(derived_db):
+    db_file, customers, _ = derived_db
+    delivery   = next_delivery(db_file, customers[0])
+    regression = {**next_delivery(db_file, customers[1]), "delivery_stand_meter": 1.0}
+
+    ingest.ingest(db_file, "delivery", [delivery])
+    result = ingest.ingest(db_file, "delivery", [delivery, regression])
+    assert writer.settle(db_file)
+
+    assert statuses(result) == [(delivery["delivery_id"], "exists"), (regression["delivery_id"], "quarantined")]
+    assert stored_row(db_file, "delivery", regression["delivery_id"]) is None
+    assert meter_validation.pending(db_file)["delivery_id"].to_list() == [regression["delivery_id"]]
+    assert_stores_match(db_file)
+
+
+def test_restock_statuses(derived_db):
+    db_file, _, trucks = derived_db
+    moved   = stored_row(db_file, "restock", trucks[0] + "20230103")
+    updated = stored_row(db_file, "restock", trucks[0] + "20230105")
+    records = [
+        {**moved, "restock_date": "2023-02-20"},
+        {**updated, "restock_volume": "640"},
+        {"restock_date": "2023-02-12", "transport_plate_number": trucks[1], "restock_volume": "600"},
+        {"restock_date": "2023-02-12", "transport_plate_number": trucks[1], "restock_volume": "-1"},
+    ]
+
+    result = ingest.ingest(db_file, "restock", records)
+    assert writer.settle(db_file)
+
+    assert [record["status"] for record in result["records"]] == ["moved", "updated", "inserted", "rejected"]
+    assert result["records"][0]["reason"] == f"moved from {trucks[0]} 2023-01-03"
+    assert result["moved"] == 1 and result["written"] == 3
+    assert db.query_table(db_file, "SELECT COUNT(*) FROM restock WHERE restock_id = ?", (moved["restock_id"],))[0][0] == 1
+    assert_stores_match(db_file)
@@ -0,0 +1,171 @@
+import datetime
+import sqlite3
+
+import pytest
+import polars as pl
+from polars.testing import assert_frame_equal
+
+import database as db
+import mass_balance
+import buffer_forecast
+import restock_forecast
+import writer
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Writes go through the group-commit writer, writer.settle() waits for the write listeners, and
+# the derived stores are then compared with SQLite, their source of truth, or with a rebuild.
+def restock_days(db_file):
+    """
+    Returns the restocks and restocked volume of every transport and day of the restock table.
+    """
+    rows = db.query_table(db_file, """
+        SELECT transport_plate_number, substr(restock_date, 1, 10), COUNT(*), ROUND(SUM(restock_volume), 6)
+        FROM restock GROUP BY 1, 2 ORDER BY 1, 2
+    """)
+    return [tuple(row) for row in rows]
+
+
+def ledger_restock_days(db_file):
+    rows = db.query_table(db_file, """
+        SELECT transport_plate_number, date, restocks, ROUND(restocked_volume, 6)
+        FROM truck_ledger WHERE restocks > 0 ORDER BY 1, 2
+    """)
+    return [tuple(row) for row in rows]
+
+
+def stored_row(db_file, table_name, key):
+    columns    = db.db_table_columns[table_name]
+    key_column = db.db_table_keys[table_name]
+    rows       = db.query_table(db_file, f"SELECT {', '.join(columns)} FROM {table_name} WHERE {key_column} = ?", (key,))
+    return dict(zip(columns, rows[0])) if rows else None
+
+
+def write(db_file, table_name, rows, upsert=False):
+    writer.write(db_file, table_name, rows, upsert=upsert)
+    assert writer.settle(db_file)
+
+
+def next_delivery(db_file, customer_id, hours=48):
+    """
+    Returns a delivery of customer_id after its last one, as the truck-side app would send it.
+    """
+    last    = stored_row(db_file, "delivery", db.query_table(db_file, """
+        SELECT delivery_id FROM delivery WHERE customer_id = ? ORDER BY arrival_timestamp DESC LIMIT 1
+    """, (customer_id,))[0][0])
+    arrival = datetime.datetime.strptime(last["arrival_timestamp"], db.timestamp_format) + datetime.timedelta(hours=hours)
+    return {
+        **last,
+        "delivery_id"           : customer_id + arrival.strftime("%Y%m%d%H%M"),
+        "arrival_timestamp"     : arrival.strftime(db.timestamp_format),
+        "delivery_stand_meter"  : float(last["delivery_stand_meter"]) + 40.0,
+    }
+
+
+def assert_stores_match(db_file):
+    """
+    Compares the snapshot with SQLite, then the ledger and both forecasts with a rebuild.
+    """
+    for table_name in ("delivery", "restock", "customer"):
+        key_column = db.db_table_keys[table_name]
+        assert_frame_equal(
+            db.scan_analytics(db_file, table_name).collect().sort(key_column),
+            db.scan_table(db_file, table_name).collect().sort(key_column),
+        )
+    assert ledger_restock_days(db_file) == restock_days(db_file)
+
+    as_of    = datetime.datetime(2023, 3, 1)
+    balances = mass_balance.ledger(db_file)
+    buffers  = buffer_forecast.forecasts(db_file, as_of).sort("customer_id")
+    restocks = restock_forecast.forecasts(db_file, as_of.date()).sort("transport_plate_number")
+
+    mass_balance.refresh(db_file, rebuild=True)
+    buffer_forecast.build_forecasts(db_file)
+    restock_forecast.build_forecasts(db_file)
+
+    assert_frame_equal(balances, mass_balance.ledger(db_file), check_exact=False, rtol=1e-9)
+    assert_frame_equal(buffers, buffer_forecast.forecasts(db_file, as_of).sort("customer_id"), check_exact=False, rtol=1e-9)
+    assert_frame_equal(restocks, restock_forecast.forecasts(db_file, as_of.date()).sort("transport_plate_number"), check_exact=False, rtol=1e-9)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def test_delivery_insert(derived_db):
+    db_file, customers, _ = derived_db
+    delivery = next_delivery(db_file, customers[0])
+
+    write(db_file, "delivery", [delivery])
+
+    assert stored_row(db_file, "delivery", delivery["delivery_id"]) is not None
+    assert_stores_match(db_file)
+
+
+def test_duplicate_delivery_is_rolled_back_alone(derived_db):
+    db_file, customers, _ = derived_db
+    first, second = next_delivery(db_file, customers[0]), next_delivery(db_file, customers[1])
+    write(db_file, "delivery", [first])
+
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.write(db_file, "delivery", [second, first])
+    assert writer.settle(db_file)
+
+    assert stored_row(db_file, "delivery", second["delivery_id"]) is None
+    assert_stores_match(db_file)
+
+
+def test_restock_insert_and_update(derived_db):
+    db_file, _, trucks = derived_db
+    restock = {
+        "restock_id"                : trucks[2] + "20230210",
+        "restock_date"              : "2023-02-10",
+        "transport_plate_number"    : trucks[2],
+        "restock_volume"            : 700.0,
+        "gas_station_address"       : "test",
+    }
+
+    write(db_file, "restock", [restock], upsert=True)
+    assert_stores_match(db_file)
+
+    write(db_file, "restock", [{**restock, "restock_volume": 650.0}], upsert=True)
+    assert float(stored_row(db_file, "restock", restock["restock_id"])["restock_volume"]) == 650.0
+    assert_stores_match(db_file)
+
+
+def test_restock_moved_across_months_leaves_its_ledger_day(derived_db):
+    db_file, _, trucks = derived_db
+    moved = stored_row(db_file, "restock", trucks[0] + "20230103")
+
+    write(db_file, "restock", [{**moved, "restock_date": "2023-02-20"}], upsert=True)
+
+    assert ledger_restock_days(db_file) == restock_days(db_file)
+    assert (trucks[0], "2023-01-03") not in {row[:2] for row in ledger_restock_days(db_file)}
+    assert mass_balance.stale_restock_days(db_file, trucks).is_empty()
+    assert_stores_match(db_file)
+
+
+def test_restock_moved_to_another_transport_refreshes_both_forecasts(derived_db):
+    db_file, _, trucks = derived_db
+    moved    = stored_row(db_file, "restock", trucks[0] + "20230103")
+    notified = []
+    db.write_listeners.append(lambda db_file, table_name, rows: notified.extend(
+        row["transport_plate_number"] for row in rows if table_name == "truck_ledger"
+    ))
+
+    write(db_file, "restock", [{**moved, "transport_plate_number": trucks[1]}], upsert=True)
+
+    assert {trucks[0], trucks[1]} <= set(notified)
+    assert_stores_match(db_file)
+
+
+def test_delivery_moved_to_another_customer_and_transport(derived_db):
+    db_file, customers, trucks = derived_db
+    delivery_id = db.query_table(db_file, "SELECT delivery_id FROM delivery WHERE customer_id = ? LIMIT 1", (customers[0],))[0][0]
+    moved       = stored_row(db_file, "delivery", delivery_id)
+    plate       = next(plate for plate in trucks if plate != moved["transport_plate_number"])
+
+    write(db_file, "delivery", [{**moved, "customer_id": customers[1], "transport_plate_number": plate}], upsert=True)
+
+    assert db.scan_analytics(db_file, "delivery", {"customer_id": customers[0]}).filter(
+        pl.col("delivery_id") == delivery_id
+    ).collect().is_empty()
+    assert_stores_match(db_file)
@@ -0,0 +1,348 @@
+import zlib
+import database as db
+import writer
+import logs
+
+# numpy is imported by the functions that use it
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Sensor traces recorded during deliveries, stored outside the row tables.
+#
+# A trace is the (time, value) samples of one sensor during one delivery. It is cut into
+# chunks of at most chunk_samples samples and chunk_span_ms milliseconds, and every chunk is
+# one pressure_chunk row:
+#
+#   times         millisecond timestamps, delta-encoded as little-endian int64, zlib-compressed
+#   values        values quantized to 1 / value_scale, delta-encoded the same way
+#
+# A regularly sampled trace compresses to a few bytes per thousand timestamps and about one
+# byte per value. Every chunk also keeps its bounds, sample count and min/max/sum: range
+# reads only decode the chunks overlapping the range, and downsampled reads take the buckets
+# covering whole chunks from those columns without decoding anything. customer_id and
+# transport_plate_number are copied from the delivery, so the traces of a truck or customer
+# are read through one index.
+PRESSURE_CHUNK_SCHEMA   = (
+    """
+    CREATE TABLE IF NOT EXISTS pressure_chunk (
+        delivery_id             TEXT NOT NULL,
+        customer_id             TEXT,
+        transport_plate_number  TEXT,
+        sensor                  TEXT NOT NULL,
+        start_ms                INTEGER NOT NULL,
+        end_ms                  INTEGER NOT NULL,
+        samples                 INTEGER NOT NULL,
+        min_value               REAL NOT NULL,
+        max_value               REAL NOT NULL,
+        sum_value               REAL NOT NULL,
+        times                   BLOB NOT NULL,
+        value_deltas            BLOB NOT NULL,
+        PRIMARY KEY (delivery_id, sensor, start_ms)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pressure_chunk_transport ON pressure_chunk (transport_plate_number, sensor, start_ms)",
+    "CREATE INDEX IF NOT EXISTS idx_pressure_chunk_customer ON pressure_chunk (customer_id, sensor, start_ms)",
+)
+CHUNK_COLUMNS           = ["start_ms", "end_ms", "samples", "min_value", "max_value", "sum_value", "times", "value_deltas"]
+
+# sensors of the delivery point readings, traces of other sensors are stored all the same
+sensors                 = [
+    "pre_buffer_pressure",
+    "post_buffer_pressure",
+    "transport_bank_pressure",
+    "delivery_pressure",
+    "delivery_temperature",
+]
+
+chunk_samples           = 4_096
+chunk_span_ms           = 10 * 60 * 1000
+value_scale             = 1_000
+
+# the columns a trace can be read by
+key_columns             = ("delivery_id", "customer_id", "transport_plate_number")
+
+logger                  = logs.get_logger("timeseries")
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def to_milliseconds(times):
+    """
+    Converts datetimes, "YYYY-MM-DD HH:MM:SS" strings or datetime64 values to int64 milliseconds.
+    """
+    import numpy as np
+
+    times = np.asarray(times)
+    if times.dtype.kind in "iu":
+        return times.astype(np.int64)
+    return times.astype("datetime64[ms]").astype(np.int64)
+
+
+def encode_chunk(times_ms, values):
+    """
+    Returns the pressure_chunk columns of one chunk, see CHUNK_COLUMNS.
+    """
+    import numpy as np
+
+    ticks = np.rint(values * value_scale).astype(np.int64)
+    return {
+        "start_ms"      : int(times_ms[0]),
+        "end_ms"        : int(times_ms[-1]),
+        "samples"       : len(times_ms),
+        "min_value"     : float(values.min()),
+        "max_value"     : float(values.max()),
+        "sum_value"     : float(values.sum()),
+        "times"         : zlib.compress(np.diff(times_ms, prepend=0).astype("<i8").tobytes(), 1),
+        "value_deltas"  : zlib.compress(np.diff(ticks, prepend=0).astype("<i8").tobytes(), 1),
+    }
+
+
+def decode_chunk(times_blob, values_blob):
+    """
+    Returns the (times_ms, values) arrays of one chunk.
+    """
+    import numpy as np
+
+    times_ms = np.cumsum(np.frombuffer(zlib.decompress(times_blob), dtype="<i8"))
+    values   = np.cumsum(np.frombuffer(zlib.decompress(values_blob), dtype="<i8")) / value_scale
+    return times_ms, values
+
+
+def chunk_bounds(times_ms):
+    """
+    Returns the start index of every chunk of sorted times: windows of chunk_span_ms from
+    the first sample, each cut every chunk_samples samples.
+    """
+    import numpy as np
+
+    index   = np.arange(len(times_ms))
+    window  = (times_ms - times_ms[0]) // chunk_span_ms
+    opens   = np.r_[True, window[1:] != window[:-1]]
+    first   = np.maximum.accumulate(np.where(opens, index, 0))
+    return np.flatnonzero(opens | ((index - first) % chunk_samples == 0)).tolist()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def append_trace(db_file, delivery_id, sensor, times, values):
+    """
+    Stores samples of a sensor during a delivery. Samples are sorted by time, NaN samples
+    (sensor dropouts) are left out, and appending later samples of the same trace adds chunks.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        delivery_id (str): A stored delivery.
+        sensor (str): The sensor name, see sensors.
+        times (array-like): Sample times as datetime64, datetimes, stored timestamps or epoch milliseconds.
+        values (array-like): Sample values, stored to 1 / value_scale.
+
+    Returns:
+        dict: {"samples", "chunks"} written.
+
+    Raises:
+        KeyError: The delivery is not stored.
+        sqlite3.Error: The chunks were rolled back, e.g. when a chunk start is already stored.
+    """
+    import numpy as np
+
+    rows = db.query_table(db_file, "SELECT customer_id, transport_plate_number FROM delivery WHERE delivery_id = ?", (delivery_id,))
+    if not rows:
+        raise KeyError(f"unknown delivery_id {delivery_id}")
+    customer_id, plate_number = rows[0]
+
+    times_ms = to_milliseconds(times)
+    values   = np.asarray(values, dtype=np.float64)
+    if times_ms.shape != values.shape:
+        raise ValueError("times and values differ in length")
+
+    kept     = ~np.isnan(values)
+    order    = np.argsort(times_ms[kept], kind="stable")
+    times_ms = times_ms[kept][order]
+    values   = values[kept][order]
+    if len(times_ms) == 0:
+        return {"samples": 0, "chunks": 0}
+
+    starts = chunk_bounds(times_ms)
+    chunks = [
+        {
+            "delivery_id"            : delivery_id,
+            "customer_id"            : customer_id,
+            "transport_plate_number" : plate_number,
+            "sensor"                 : sensor,
+            **encode_chunk(times_ms[start:stop], values[start:stop]),
+        }
+        for start, stop in zip(starts, starts[1:] + [len(times_ms)])
+    ]
+
+    writer.write(db_file, "pressure_chunk", chunks)
+    logger.debug("trace appended", extra={"delivery_id": delivery_id, "sensor": sensor, "samples": len(times_ms), "chunks": len(chunks)})
+    return {"samples": len(times_ms), "chunks": len(chunks)}
+
+
+def read_chunks(db_file, key_column, key, sensor, start_ms=None, end_ms=None):
+    """
+    Returns the chunk rows overlapping [start_ms, end_ms] as CHUNK_COLUMNS tuples, by start.
+    A chunk never spans more than chunk_span_ms, which bounds the index range to scan.
+    """
+
+    if key_column not in key_columns:
+        raise ValueError(f"traces are read by one of {key_columns}")
+
+    where  = [f"{key_column} = ?", "sensor = ?"]
+    params = [key, sensor]
+    if start_ms is not None:
+        where.append("start_ms >= ? AND end_ms >= ?")
+        params += [start_ms - chunk_span_ms, start_ms]
+    if end_ms is not None:
+        where.append("start_ms <= ?")
+        params.append(end_ms)
+
+    return db.query_table(
+        db_file,
+        f"SELECT {', '.join(CHUNK_COLUMNS)} FROM pressure_chunk WHERE {' AND '.join(where)} ORDER BY start_ms",
+        tuple(params),
+    )
+
+
+def read_trace(db_file, key_column, key, sensor, start=None, end=None):
+    """
+    Reads the samples of a sensor for a delivery, customer or truck within a time range.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        key_column (str): "delivery_id", "customer_id" or "transport_plate_number".
+        key (str): The value of key_column.
+        sensor (str): The sensor name.
+        start: Optional first time, anything to_milliseconds accepts.
+        end: Optional last time, included.
+
+    Returns:
+        tuple: (times, values) as datetime64[ms] and float64 NumPy arrays, sorted by time.
+    """
+    import numpy as np
+
+    start_ms = None if start is None else int(to_milliseconds([start])[0])
+    end_ms   = None if end is None else int(to_milliseconds([end])[0])
+    chunks   = read_chunks(db_file, key_column, key, sensor, start_ms, end_ms)
+    if not chunks:
+        return np.array([], dtype="datetime64[ms]"), np.array([], dtype=np.float64)
+
+    decoded  = [decode_chunk(chunk[6], chunk[7]) for chunk in chunks]
+    times_ms = np.concatenate([times for times, _ in decoded])
+    values   = np.concatenate([values for _, values in decoded])
+
+    # traces of different deliveries may interleave
+    if len(times_ms) > 1 and (np.diff(times_ms) < 0).any():
+        order    = np.argsort(times_ms, kind="stable")
+        times_ms = times_ms[order]
+        values   = values[order]
+
+    mask = np.ones(len(times_ms), dtype=bool)
+    if start_ms is not None:
+        mask &= times_ms >= start_ms
+    if end_ms is not None:
+        mask &= times_ms <= end_ms
+    return times_ms[mask].astype("datetime64[ms]"), values[mask]
+
+
+def read_downsampled(db_file, key_column, key, sensor, bucket_ms, start=None, end=None):
+    """
+    Reads a trace reduced to fixed time buckets, e.g. for plotting a day at one point a minute.
+    Chunks lying within one bucket and within the range are reduced from their stored
+    min/max/sum, only the others are decoded.
+
+    Args:
+        bucket_ms (int): The bucket width in milliseconds, buckets are aligned on the epoch.
+        See read_trace for the other arguments.
+
+    Returns:
+        dict: "time" (bucket starts, datetime64[ms]), "min", "max", "mean" and "samples"
+              NumPy arrays, one entry per non-empty bucket.
+    """
+    import numpy as np
+
+    start_ms = None if start is None else int(to_milliseconds([start])[0])
+    end_ms   = None if end is None else int(to_milliseconds([end])[0])
+
+    # partial reductions as (bucket, min, max, sum, count) arrays
+    parts = []
+    for chunk_start, chunk_end, samples, min_value, max_value, sum_value, times_blob, values_blob in \
+            read_chunks(db_file, key_column, key, sensor, start_ms, end_ms):
+        inside = (start_ms is None or chunk_start >= start_ms) and (end_ms is None or chunk_end <= end_ms)
+        if inside and chunk_start // bucket_ms == chunk_end // bucket_ms:
+            parts.append((np.array([chunk_start // bucket_ms]), np.array([min_value]), np.array([max_value]),
+                          np.array([sum_value]), np.array([samples])))
+            continue
+
+        times_ms, values = decode_chunk(times_blob, values_blob)
+        mask = np.ones(len(times_ms), dtype=bool)
+        if start_ms is not None:
+            mask &= times_ms >= start_ms
+        if end_ms is not None:
+            mask &= times_ms <= end_ms
+        times_ms, values = times_ms[mask], values[mask]
+        if len(times_ms) == 0:
+            continue
+
+        buckets = times_ms // bucket_ms
+        firsts  = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        parts.append((buckets[firsts], np.minimum.reduceat(values, firsts), np.maximum.reduceat(values, firsts),
+                      np.add.reduceat(values, firsts), np.diff(np.r_[firsts, len(values)])))
+
+    if not parts:
+        empty = np.array([], dtype=np.float64)
+        return {"time": np.array([], dtype="datetime64[ms]"), "min": empty, "max": empty, "mean": empty,
+                "samples": np.array([], dtype=np.int64)}
+
+    buckets, mins, maxs, sums, counts = (np.concatenate(column) for column in zip(*parts))
+    order   = np.argsort(buckets, kind="stable")
+    buckets, mins, maxs, sums, counts = buckets[order], mins[order], maxs[order], sums[order], counts[order]
+    firsts  = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    samples = np.add.reduceat(counts, firsts)
+
+    return {
+        "time"      : (buckets[firsts] * bucket_ms).astype("datetime64[ms]"),
+        "min"       : np.minimum.reduceat(mins, firsts),
+        "max"       : np.maximum.reduceat(maxs, firsts),
+        "mean"      : np.add.reduceat(sums, firsts) / samples,
+        "samples"   : samples,
+    }
+
+
+def read_delivery_trace(db_file, delivery_id, sensor, start=None, end=None):
+    return read_trace(db_file, "delivery_id", delivery_id, sensor, start, end)
+
+
+def read_customer_trace(db_file, customer_id, sensor, start=None, end=None):
+    return read_trace(db_file, "customer_id", customer_id, sensor, start, end)
+
+
+def read_transport_trace(db_file, plate_number, sensor, start=None, end=None):
+    return read_trace(db_file, "transport_plate_number", plate_number, sensor, start, end)
+
+
+def trace_summary(db_file, delivery_id):
+    """
+    Returns {sensor: {"start", "end", "samples", "min", "max", "mean"}} of a delivery's
+    traces from the chunk columns alone.
+    """
+    rows = db.query_table(db_file, """
+        SELECT sensor, MIN(start_ms), MAX(end_ms), SUM(samples), MIN(min_value), MAX(max_value), SUM(sum_value)
+        FROM pressure_chunk WHERE delivery_id = ? GROUP BY sensor
+    """, (delivery_id,))
+    return {
+        sensor: {"start": start_ms, "end": end_ms, "samples": samples, "min": min_value, "max": max_value, "mean": sum_value / samples}
+        for sensor, start_ms, end_ms, samples, min_value, max_value, sum_value in rows
+    }
+
+
+def enable(db_file):
+    """
+    Creates the pressure_chunk table and its indexes.
+    """
+    conn = db.connect(db_file)
+    try:
+        for statement in PRESSURE_CHUNK_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
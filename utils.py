@@ -2,10 +2,12 @@ import subprocess
 import os
 import json
 import polars as pl
-import pandas as pd
-import openpyxl
-from openpyxl.utils.dataframe import dataframe_to_rows
 from pathlib import Path  # For robust path handling
+import logs
+
+# pandas and openpyxl are imported by the Excel exports, only when a file is written
+logger = logs.get_logger("utils")
+
 
 def display_string_in_notepad(text):
     """
@@ -26,7 +28,7 @@ def display_string_in_notepad(text):
         subprocess.Popen(["nano", temp_file])  # Use Popen to run Notepad in the background
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception("could not open the text in an editor")
 
 
 def dict_to_string(obj):
@@ -66,6 +68,9 @@ def export_polars_to_excel(df: pl.DataFrame, filepath: str) -> None:
         filepath: The path to the Excel file to create (e.g., "output.xlsx").
     """
 
+    import openpyxl
+    from openpyxl.utils.dataframe import dataframe_to_rows
+
     # Ensure filepath is a string
     if not isinstance(filepath, str):
         raise TypeError("filepath must be a string")
@@ -100,7 +105,7 @@ def export_polars_to_excel(df: pl.DataFrame, filepath: str) -> None:
                         if cell_length > max_length:
                             max_length = cell_length
                 except Exception as e:
-                    print(f"Error getting length of cell value: {e}")
+                    logger.warning("could not measure cell value", extra={"cell": cell.coordinate, "error": str(e)})
 
             adjusted_width = (max_length + 2)  # Add some padding
             worksheet.column_dimensions[column].width = adjusted_width
@@ -109,10 +114,10 @@ def export_polars_to_excel(df: pl.DataFrame, filepath: str) -> None:
         # Save the workbook to the Excel file
         workbook.save(filepath)
 
-        print(f"DataFrame successfully exported to: {filepath}")
+        logger.info("dataframe exported", extra={"path": str(filepath), "rows": len(df)})
 
     except Exception as e:
-        print(f"An error occurred during export: {e}")
+        logger.exception("dataframe export failed", extra={"path": str(filepath)})
         raise  # Re-raise the exception to signal failure to the caller
 
 
@@ -157,6 +162,8 @@ def remove_df_underscore(df):
 
 
 def write_df_to_excel(df, output):
+    import pandas as pd
+
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         # Convert the DataFrame to an Excel file
         df.to_excel(writer, sheet_name='Sheet1')
@@ -0,0 +1,306 @@
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import Future
+import database as db
+import logs
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Single writer per process with group commit.
+#
+# Callbacks submit rows to a queue and wait on a future. A writer thread takes everything that
+# queued up while it was busy, up to max_batch rows, and commits it in one transaction: one
+# fsync for the whole group. Every submission runs in its own SAVEPOINT, so a failing one (e.g. a
+# duplicate key) is rolled back and acknowledged alone while the rest of the group commits.
+#
+# The write listeners (snapshot, cache, rollup, balances, forecasts) run on a second thread, after
+# the acknowledgements, so a group commit never waits for them: derived tables and cached results
+# lag the commit briefly, reads of the written tables themselves do not. Writes that queued up
+# while the listeners ran are passed on together, in one call per table. settle() waits for them.
+#
+# The gunicorn workers each have their own writer. They serialize on the SQLite write lock:
+# WAL (see database.enable_wal) lets readers go on during a commit, and the busy timeout makes a
+# writer wait for the lock instead of failing with "database is locked".
+max_batch           = 2_000
+busy_timeout        = 30.0
+
+# (db_file, pid) -> GroupCommitWriter
+writers             = {}
+writers_lock        = threading.Lock()
+
+logger              = logs.get_logger("writer")
+
+
+class Submission:
+    __slots__ = ("table_name", "rows", "upsert", "previous", "future", "submitted")
+
+    def __init__(self, table_name, rows, upsert):
+        self.table_name = table_name
+        self.rows       = rows
+        self.upsert     = upsert
+        # the stored rows an upsert replaced, passed on to the write listeners with rows
+        self.previous   = []
+        self.future     = Future()
+        self.submitted  = time.perf_counter()
+
+
+class GroupCommitWriter:
+    """
+    Writer thread committing the submissions queued for one database in groups.
+    """
+
+    def __init__(self, db_file):
+        self.db_file      = db_file
+        self.queue        = queue.SimpleQueue()
+        self.conn         = None
+        self.upsert_ready = set()
+        self.listened     = queue.SimpleQueue()
+        self.thread       = threading.Thread(target=self.run, name=f"writer-{os.path.basename(db_file)}", daemon=True)
+        self.listener     = threading.Thread(target=self.listen, name=f"listener-{os.path.basename(db_file)}", daemon=True)
+        self.thread.start()
+        self.listener.start()
+
+    def submit(self, table_name, rows, upsert=False):
+        """
+        Queues rows for one all-or-nothing write.
+
+        Returns:
+            Future: Resolves to the acknowledgement, see write, or raises the write error.
+        """
+        submission = Submission(table_name, rows, upsert)
+        self.queue.put(submission)
+        return submission.future
+
+    def settle(self, timeout=None):
+        """
+        Waits until the listeners have run for every write acknowledged so far.
+
+        Returns:
+            bool: False when timeout passed first.
+        """
+        settled = threading.Event()
+        self.listened.put(settled)
+        return settled.wait(timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.listened.put(None)
+        self.listener.join()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+
+            # whatever queued up during the previous commit joins this one
+            rows     = len(batch[0].rows)
+            stopping = False
+            while rows < max_batch:
+                try:
+                    submission = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if submission is None:
+                    stopping = True
+                    break
+                batch.append(submission)
+                rows += len(submission.rows)
+
+            self.commit(batch)
+            if stopping:
+                break
+
+        if self.conn is not None:
+            self.conn.close()
+
+    def listen(self):
+        """
+        Runs the write listeners of the committed writes, in commit order.
+        """
+        stopping = False
+        while not stopping:
+            items    = [self.listened.get()]
+            while True:
+                try:
+                    items.append(self.listened.get_nowait())
+                except queue.Empty:
+                    break
+
+            # the tables in the order they were first written, settle events after their writes
+            written, settled = {}, []
+            for item in items:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    settled.append(item)
+                else:
+                    table_name, rows = item
+                    written.setdefault(table_name, []).extend(rows)
+
+            for table_name, rows in written.items():
+                db.notify_write(self.db_file, table_name, rows)
+            for event in settled:
+                event.set()
+
+    def connection(self):
+        if self.conn is None:
+            # autocommit mode, transactions and savepoints are issued explicitly
+            self.conn = db.connect(self.db_file, timeout=busy_timeout, isolation_level=None)
+        return self.conn
+
+    def statement(self, submission):
+        keys = list(submission.rows[0].keys())
+        if not submission.upsert:
+            return db.insert_sql(submission.table_name, keys), keys
+
+        # ON CONFLICT needs a unique index on the key column
+        if submission.table_name not in self.upsert_ready:
+            if not db.create_key_index(self.db_file, submission.table_name, deduplicate=True):
+                raise sqlite3.OperationalError(f"no unique key index on {submission.table_name}")
+            self.upsert_ready.add(submission.table_name)
+        return db.upsert_sql(submission.table_name, keys), keys
+
+    def commit(self, batch):
+        """
+        Commits a group of submissions in one transaction, then queues the rows for the
+        write listeners, once per table, and acknowledges every submission.
+        """
+
+        start     = time.perf_counter()
+        committed = []
+        failed    = []
+
+        # statements are prepared first: creating a key index takes the write lock itself
+        prepared = []
+        for submission in batch:
+            try:
+                sql, keys = self.statement(submission)
+                prepared.append((submission, sql, [tuple(row[key] for key in keys) for row in submission.rows]))
+            except (sqlite3.Error, KeyError) as e:
+                failed.append((submission, e))
+
+        try:
+            conn = self.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            for index, (submission, sql, values) in enumerate(prepared):
+                conn.execute(f"SAVEPOINT submission_{index}")
+                try:
+                    if submission.upsert:
+                        submission.previous = db.stored_rows(conn, submission.table_name, submission.rows)
+                    conn.executemany(sql, values)
+                    committed.append(submission)
+                except sqlite3.Error as e:
+                    conn.execute(f"ROLLBACK TO submission_{index}")
+                    failed.append((submission, e))
+                conn.execute(f"RELEASE submission_{index}")
+            conn.execute("COMMIT")
+
+        except sqlite3.Error as e:
+            logger.error("group commit failed", extra={"db_file": self.db_file, "submissions": len(batch), "error": str(e)})
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            for submission, _, _ in prepared:
+                submission.future.set_exception(e)
+            for submission, error in failed:
+                if not submission.future.done():
+                    submission.future.set_exception(error)
+            return
+
+        batch_rows = sum(len(submission.rows) for submission in committed)
+        logger.info("group committed", extra={
+            "db_file"       : self.db_file,
+            "submissions"   : len(batch),
+            "rows"          : batch_rows,
+            "failed"        : len(failed),
+            "seconds"       : round(time.perf_counter() - start, 4),
+        })
+
+        # queued before the acknowledgements, so settle() after write() covers the rows
+        written = {}
+        for submission in committed:
+            written.setdefault(submission.table_name, []).extend(submission.rows)
+            written[submission.table_name].extend(submission.previous)
+        for table_name, rows in written.items():
+            self.listened.put((table_name, rows))
+
+        now = time.perf_counter()
+        for submission in committed:
+            seconds = now - submission.submitted
+            submission.future.set_result({
+                "rows"              : len(submission.rows),
+                "seconds"           : seconds,
+                "rows_per_second"   : len(submission.rows) / seconds if seconds > 0 else float(len(submission.rows)),
+                "batch_rows"        : batch_rows,
+            })
+        for submission, error in failed:
+            logger.error("submission rolled back", extra={"table": submission.table_name, "rows": len(submission.rows), "error": str(error)})
+            submission.future.set_exception(error)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def get_writer(db_file):
+    """
+    Returns the writer of db_file in this process, started on first use.
+    A writer inherited from a forking parent has no thread and is not reused.
+    """
+    key = (db_file, os.getpid())
+    with writers_lock:
+        writer = writers.get(key)
+        if writer is None:
+            writer = writers[key] = GroupCommitWriter(db_file)
+    return writer
+
+
+def write(db_file, table_name, rows, upsert=False, timeout=busy_timeout * 2):
+    """
+    Writes rows through the group-commit writer and waits for their acknowledgement.
+
+    Args:
+        db_file (str): The path to the SQLite database file.
+        table_name (str): The table to write to.
+        rows (list): Dictionaries sharing the same keys, written all together or not at all.
+        upsert (bool): Update the rows whose table key exists (see db_table_keys) instead of failing.
+        timeout (float): Seconds to wait for the acknowledgement.
+
+    Returns:
+        dict: {"rows", "seconds", "rows_per_second", "batch_rows"}, seconds from submission to
+              acknowledgement and batch_rows the rows committed with them.
+
+    Raises:
+        sqlite3.Error: The rows were rolled back, e.g. on a duplicate key.
+    """
+
+    if not rows:
+        return {"rows": 0, "seconds": 0.0, "rows_per_second": 0.0, "batch_rows": 0}
+    return get_writer(db_file).submit(table_name, rows, upsert).result(timeout)
+
+
+def settle(db_file, timeout=busy_timeout * 2):
+    """
+    Waits until the write listeners have run for every write this process had acknowledged
+    on db_file, so derived tables, the snapshot and the result cache reflect them.
+
+    Returns:
+        bool: False when timeout passed first.
+    """
+    return get_writer(db_file).settle(timeout)
+
+
+def close_all():
+    with writers_lock:
+        current = [writer for (_, pid), writer in writers.items() if pid == os.getpid()]
+        writers.clear()
+    for writer in current:
+        writer.close()
+
+
+atexit.register(close_all)